@@ -1,14 +1,36 @@
 # Admin actions
 # https://docs.djangoproject.com/en/3.0/ref/contrib/admin/actions/
+from django.db import transaction
 from django.utils.timezone import now
 
+from books import cache
+from books.events import publish, book_groups, PayloadEvent
+from books.models import BOOK_EDITED, BOOK_REMOVED
+
 
 def make_published(modeladmin, request, queryset):
-    return queryset.filter(published=None).update(published=now())
+    with transaction.atomic():
+        books = list(queryset.filter(published=None).select_for_update())
+        published = now()
+        updated = queryset.model.objects.filter(pk__in=[book.pk for book in books]).update(published=published)
+        # `update()` fires no `post_save`: subscribers are notified, and the catalogue cache
+        # invalidated here, once committed
+        for book in books:
+            book.published = published
+            publish(PayloadEvent(operation=BOOK_EDITED, instance=book, changed=['published']), book_groups(book.pk))
+        cache.invalidate()
+    return updated
 
 
 def make_unpublished(modeladmin, request, queryset):
-    return queryset.update(published=None)
+    with transaction.atomic():
+        books = list(queryset.exclude(published=None).select_for_update())
+        updated = queryset.model.objects.filter(pk__in=[book.pk for book in books]).update(published=None)
+        for book in books:
+            book.published = None
+            publish(PayloadEvent(operation=BOOK_REMOVED, instance=book, changed=['published']), book_groups(book.pk))
+        cache.invalidate()
+    return updated
 
 
 make_published.short_description = 'Publish selected books'
@@ -1,7 +1,7 @@
 from django.contrib import admin
 
 from books.admin.actions import make_published, make_unpublished
-from books.models import Book, Loan, Store
+from books.models import Book, Loan, Store, TaskRun
 
 
 class LoanInline(admin.TabularInline):
@@ -15,9 +15,10 @@ class LoanInline(admin.TabularInline):
 class BookAdmin(admin.ModelAdmin):
     inlines = [LoanInline]
     list_display = (
-        '_is_published', '_preview_created',
+        '_is_published', '_preview_created', 'preview_status',
         'isbn', 'publication_date', 'feature', 'title', '_authors_pretty', '_topics_pretty')
     list_editable = ('feature',)
+    readonly_fields = ('preview_status',)
     actions = [make_published, make_unpublished]
 
     def _authors_pretty(self, obj):
@@ -39,6 +40,18 @@ class BookAdmin(admin.ModelAdmin):
     _preview_created.short_description = 'Preview ∃!'
 
 
+class TaskRunAdmin(admin.ModelAdmin):
+    list_display = ('task', 'started', 'duration', 'status', 'failures')
+    list_filter = ('task', 'status')
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
 admin.site.register(Book, BookAdmin)
 admin.site.register(Store)
+admin.site.register(TaskRun, TaskRunAdmin)
 
@@ -0,0 +1,119 @@
+"""
+Cache of the book catalogue: pages of the `books` query and single books of the `book` query.
+
+Entries hold the books' compact payloads (cf. `books.payloads`), with related objects
+and file URLs precomputed, so that cached books resolve without database queries.
+Entries are versioned: any change to the catalogue bumps the version (`invalidate()`,
+cf. `books.signals` and `books.admin.actions`), which makes all entries stale at once,
+left to expire from the cache.
+
+Entries are stored in the Django cache `BOOKS_CATALOGUE_CACHE_ALIAS`: a local-memory cache
+only suits a single process (others keep serving their entries until `BOOKS_CATALOGUE_CACHE_TIMEOUT`),
+a shared cache (eg. memcached) is needed for invalidation to reach all processes.
+"""
+import hashlib
+import threading
+import time
+from collections import Counter
+
+from django.core.cache import caches
+from django.db import transaction
+
+from books.payloads import pack, unpack, dump_instance, load_instance
+from books.settings import get_setting
+
+VERSION_CACHE_KEY = 'books:catalogue:version'
+ENTRY_CACHE_KEY = 'books:catalogue:{version}:{name}:{args}'
+
+
+class CatalogueCache:
+
+    def __init__(self):
+        self.stats = Counter()
+        self.lock = threading.Lock()
+
+    @property
+    def cache(self):
+        return caches[get_setting('CATALOGUE_CACHE_ALIAS')]
+
+    @property
+    def enabled(self):
+        return bool(get_setting('CATALOGUE_CACHE_TIMEOUT'))
+
+    def get_version(self):
+        version = self.cache.get(VERSION_CACHE_KEY)
+        if version is None:
+            # never reuse the versions of entries still cached, were the version evicted
+            self.cache.add(VERSION_CACHE_KEY, int(time.time() * 1000), timeout=None)
+            version = self.cache.get(VERSION_CACHE_KEY)
+        return version
+
+    def bump_version(self):
+        try:
+            self.cache.incr(VERSION_CACHE_KEY)
+        except ValueError:
+            self.get_version()
+        self._count('invalidations')
+
+    def get_books(self, name, args, get_books):
+        """
+        Books cached under `name` and `args`, or else got from `get_books()` and cached.
+        :param get_books: returns the list of books, with their related objects joined or prefetched.
+        """
+        return self._get_or_set(
+            name, args, get_books,
+            dump=lambda books: [dump_instance(book) for book in books],
+            load=lambda payloads: [load_instance(payload) for payload in payloads],
+        )
+
+    def get_book(self, name, args, get_book):
+        """
+        Same as `get_books()`, for a single book, not cached if None.
+        """
+        return self._get_or_set(name, args, get_book, dump=dump_instance, load=load_instance)
+
+    def get_stats(self):
+        """
+        Hits, misses and invalidations counted by this process, and hit rate.
+        """
+        with self.lock:
+            stats = dict(hits=self.stats['hits'], misses=self.stats['misses'],
+                         invalidations=self.stats['invalidations'])
+        requests = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / requests if requests else None
+        return stats
+
+    def _get_or_set(self, name, args, get_value, dump, load):
+        if not self.enabled:
+            return get_value()
+
+        key = ENTRY_CACHE_KEY.format(version=self.get_version(), name=name, args=self._digest(args))
+        packed = self.cache.get(key)
+        if packed is not None:
+            self._count('hits')
+            return load(unpack(packed))
+
+        self._count('misses')
+        value = get_value()
+        if value is not None:
+            self.cache.set(key, pack(dump(value)), timeout=get_setting('CATALOGUE_CACHE_TIMEOUT'))
+        return value
+
+    def _count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    @staticmethod
+    def _digest(args):
+        return hashlib.md5(repr(sorted(args.items())).encode()).hexdigest()
+
+
+catalogue_cache = CatalogueCache()
+
+
+def invalidate():
+    """
+    Make all catalogue cache entries stale, once the current transaction commits
+    (before, concurrent requests could cache the data being changed again).
+    """
+    transaction.on_commit(catalogue_cache.bump_version)
@@ -0,0 +1,174 @@
+"""
+GraphQL subscriptions over websockets (graphql-ws protocol), routed by channel groups.
+
+Unlike `graphene_subscriptions.consumers.GraphqlSubscriptionConsumer`, which joins every client
+to one global group and feeds every event to every subscription, subscription resolvers here
+join only the channel groups of the events they need, eg. the subscriber's loans:
+
+    def resolve_book_borrowed(root, info):
+        stream = info.context.subscribe(user_group(info.context.user.pk))
+        ...
+
+so that an event is delivered to the interested clients only, cf. `books.events.publish()`.
+
+Clients authenticate with the JWT sent in the `connection_init` payload, as `authToken`
+or as an `Authorization: JWT <token>` header, which sets `user` in the connection scope.
+"""
+import functools
+import json
+from collections import Counter
+
+from asgiref.sync import async_to_sync
+from channels.consumer import SyncConsumer
+from channels.exceptions import StopConsumer
+from django.contrib.auth.models import AnonymousUser
+from graphene_django.settings import graphene_settings
+from graphene_subscriptions.events import SubscriptionEvent
+from graphql_jwt.exceptions import JSONWebTokenError
+from graphql_jwt.settings import jwt_settings
+from graphql_jwt.shortcuts import get_user_by_token
+from rx.subjects import Subject
+
+from books.schema.loaders import clear_loaders
+
+
+class SubscriptionContext:
+    """
+    `info.context` of subscription resolvers: the connection scope (eg. `user`),
+    and `subscribe()` to join channel groups.
+    """
+
+    def __init__(self, consumer):
+        self.consumer = consumer
+        self.groups = set()
+
+    def __getattr__(self, item):
+        return self.consumer.scope.get(item)
+
+    def subscribe(self, group):
+        """
+        Join channel `group` for this subscription.
+        :return: observable of the events received from `group`, each resolved
+            with loaders of its own (cf. `books.schema.loaders`), not with objects
+            cached while resolving previous events.
+        """
+        self.groups.add(group)
+        return self.consumer.join(group).tap(lambda event: clear_loaders(self))
+
+
+class SubscriptionConsumer(SyncConsumer):
+
+    def websocket_connect(self, message):
+        self.streams = {}           # group => events received from group
+        self.group_refs = Counter()  # group => subscriptions that joined it
+        self.subscriptions = {}     # operation id => (disposable, groups)
+        self.scope.setdefault('user', AnonymousUser())
+        self.send({'type': 'websocket.accept', 'subprotocol': 'graphql-ws'})
+
+    def websocket_disconnect(self, message):
+        for group in list(self.streams):
+            async_to_sync(self.channel_layer.group_discard)(group, self.channel_name)
+        raise StopConsumer()
+
+    def websocket_receive(self, message):
+        request = json.loads(message['text'])
+        id = request.get('id')
+
+        if request['type'] == 'connection_init':
+            try:
+                self._authenticate(request.get('payload') or {})
+            except JSONWebTokenError as e:
+                self._send_message(None, 'connection_error', {'message': str(e)})
+                self.send({'type': 'websocket.close', 'code': 4401})
+                return
+            self._send_message(None, 'connection_ack')
+
+        elif request['type'] == 'start':
+            self._stop(id)
+            self._start(id, request['payload'])
+
+        elif request['type'] == 'stop':
+            self._stop(id)
+            self._send_message(id, 'complete')
+
+        elif request['type'] == 'connection_terminate':
+            self.send({'type': 'websocket.close', 'code': 1000})
+            self.websocket_disconnect(message)
+
+    def _authenticate(self, payload):
+        """
+        Authenticate the connection with the JWT of the `connection_init` payload, if any.
+        Connections without token keep the scope's user (eg. from a session), anonymous otherwise.
+        :raise JSONWebTokenError: invalid or expired token, or token of a user deleted or disabled since.
+        """
+        token = payload.get('authToken')
+        header = payload.get('Authorization') or payload.get('authorization') or ''
+        prefix, _, value = header.partition(' ')
+        if not token and prefix.lower() == jwt_settings.JWT_AUTH_HEADER_PREFIX.lower():
+            token = value
+        if token:
+            user = get_user_by_token(token)
+            if user is None:
+                raise JSONWebTokenError('User not found')
+            self.scope['user'] = user
+
+    def signal_fired(self, message):
+        """
+        Event received from one of the groups joined, cf. `books.events.send()`.
+        """
+        stream = self.streams.get(message.get('group'))
+        if stream is not None:
+            stream.on_next(SubscriptionEvent.from_dict(message['event']))
+
+    def join(self, group):
+        if group not in self.streams:
+            async_to_sync(self.channel_layer.group_add)(group, self.channel_name)
+            self.streams[group] = Subject()
+        return self.streams[group]
+
+    def leave(self, groups):
+        for group in groups:
+            self.group_refs[group] -= 1
+            if self.group_refs[group] <= 0:
+                del self.group_refs[group]
+                self.streams.pop(group, None)
+                async_to_sync(self.channel_layer.group_discard)(group, self.channel_name)
+
+    def _start(self, id, payload):
+        context = SubscriptionContext(self)
+        result = graphene_settings.SCHEMA.execute(
+            payload['query'],
+            operation_name=payload.get('operationName'),
+            variables=payload.get('variables'),
+            context=context,
+            allow_subscriptions=True,
+        )
+        self.group_refs.update(context.groups)
+
+        if hasattr(result, 'subscribe'):
+            disposable = result.subscribe(functools.partial(self._send_result, id))
+            self.subscriptions[id] = (disposable, context.groups)
+        else:
+            self.leave(context.groups)
+            self._send_result(id, result)
+
+    def _stop(self, id):
+        disposable, groups = self.subscriptions.pop(id, (None, ()))
+        if disposable is not None:
+            disposable.dispose()
+        self.leave(groups)
+
+    def _send_result(self, id, result):
+        errors = result.errors
+        self._send_message(id, 'data', {
+            'data': result.data,
+            'errors': list(map(str, errors)) if errors else None,
+        })
+
+    def _send_message(self, id, type, payload=None):
+        message = dict(type=type)
+        if id is not None:
+            message['id'] = id
+        if payload is not None:
+            message['payload'] = payload
+        self.send({'type': 'websocket.send', 'text': json.dumps(message)})
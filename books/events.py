@@ -0,0 +1,208 @@
+"""
+Batched publishing of subscription events (graphene-subscriptions).
+
+Events published inside a transaction are gathered, then sent once the transaction commits,
+as one `EventBatch` message over the channel layer instead of one message per event.
+Subscribers thus receive a burst of events (eg. a mass expiry of loans) in a few messages,
+and unpack them with `select_events()`. Events of a rolled back transaction are never sent.
+Outside of a transaction, events are sent right away, as before.
+
+Events are sent to the channel groups of their subscribers only (eg. the loans' owner),
+instead of being broadcast to every websocket client.
+"""
+import threading
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+from graphene_subscriptions.events import SubscriptionEvent
+
+from books.payloads import pack, unpack, dump_instance, load_instance
+from books.settings import get_setting
+
+BATCH = 'batch'
+
+# Channel groups events are published to, cf. `books.consumers.SubscriptionConsumer`:
+# per user for loans, per book and catalogue-wide for books.
+GROUP_PREFIX = 'books'
+CATALOGUE_GROUP = f'{GROUP_PREFIX}.catalogue'
+
+# Batches of the current transaction by savepoint, per thread (as are database connections)
+_local = threading.local()
+
+
+class EventBatch(SubscriptionEvent):
+    """
+    Events sent as one channel layer message.
+    Serialized (`to_dict()`) as the list of its events serialized,
+    which `SubscriptionEvent.from_dict()` hands back to `__init__()` on reception.
+    """
+
+    def __init__(self, operation=BATCH, instance=None):
+        events = [
+            SubscriptionEvent.from_dict(event) if isinstance(event, dict) else event
+            for event in instance or []
+        ]
+        super().__init__(operation=operation, instance=events)
+
+    @property
+    def events(self):
+        return self.instance
+
+    def to_dict(self):
+        _dict = super().to_dict()
+        _dict['instance'] = [event.to_dict() for event in self.events]
+        return _dict
+
+
+class PayloadEvent(SubscriptionEvent):
+    """
+    Event on a model instance, sent as its compact payload (cf. `books.payloads`),
+    packed once however many groups and subscribers it is sent to.
+    Received back as an instance resolving the common fields without database queries.
+    """
+
+    def __init__(self, operation=None, instance=None, changed=None):
+        self.packed = None
+        if isinstance(instance, bytes):
+            self.packed = instance
+            payload = unpack(instance)
+            instance, changed = load_instance(payload), payload['changed']
+        super().__init__(operation=operation, instance=instance)
+        self.changed = changed
+
+    def to_dict(self):
+        if self.packed is None:
+            self.packed = pack(dump_instance(self.instance, self.changed))
+        _dict = super().to_dict()
+        _dict['instance'] = self.packed
+        return _dict
+
+
+class _Batch:
+    """
+    Events published in a transaction (or savepoint), sent by this on commit callback.
+    """
+
+    def __init__(self):
+        self.events = {}
+
+    def add(self, event, groups):
+        for group in groups:
+            self.events.setdefault(group, []).append(event)
+
+    def __call__(self):
+        send_messages([
+            message
+            for group, events in self.events.items()
+            for message in get_batch_messages(events, group)
+        ])
+
+
+def user_group(user_id):
+    """
+    Channel group of the events on the loans of user `user_id`.
+    """
+    return f'{GROUP_PREFIX}.user.{user_id}'
+
+
+def book_group(book_id):
+    """
+    Channel group of the events on book `book_id`.
+    """
+    return f'{GROUP_PREFIX}.book.{book_id}'
+
+
+def book_groups(book_id):
+    """
+    Channel groups an event on book `book_id` is published to.
+    """
+    return [CATALOGUE_GROUP, book_group(book_id)]
+
+
+def publish(event, groups):
+    """
+    Send `event` to channel `groups` once the current transaction commits,
+    batched with the transaction's other events, or right away if not in a transaction.
+    Events are gathered per savepoint, so that those of a savepoint rolled back
+    are dropped alongside it (ie. Django drops its on commit callbacks).
+    :param event: `SubscriptionEvent`
+    :param groups: names of the channel groups subscribers of `event` joined,
+        eg. `user_group(loan.user_id)`.
+    """
+    connection = transaction.get_connection()
+    if not connection.in_atomic_block:
+        send(event, groups)
+        return
+
+    # forget batches sent already, or rolled back with their transaction or savepoint
+    batches = _local.__dict__.setdefault('batches', {})
+    callbacks = [func for _, func in connection.run_on_commit]
+    for key, batch in list(batches.items()):
+        if not any(func is batch for func in callbacks):
+            del batches[key]
+
+    key = tuple(connection.savepoint_ids)
+    batch = batches.get(key)
+    if batch is None:
+        batch = batches[key] = _Batch()
+        transaction.on_commit(batch)
+    batch.add(event, groups)
+
+
+def send(event, groups):
+    """
+    Send `event` to channel `groups`, serialized once.
+    Replaces `SubscriptionEvent.send()`, which broadcasts to every subscriber.
+    """
+    send_messages(get_messages(event, groups))
+
+
+def get_messages(event, groups):
+    """
+    Channel layer messages of `event`, as (group, message) pairs.
+    """
+    message = dict(type='signal.fired', event=event.to_dict())
+    return [(group, dict(message, group=group)) for group in groups]
+
+
+def get_batch_messages(events, group):
+    """
+    Messages of `events` to channel `group`, in batches of at most `BOOKS_EVENT_BATCH_SIZE` events,
+    a single event being sent as is.
+    """
+    batch_size = get_setting('EVENT_BATCH_SIZE')
+    messages = []
+    for i in range(0, len(events), batch_size):
+        batch = events[i:i + batch_size]
+        messages += get_messages(batch[0] if len(batch) == 1 else EventBatch(instance=batch), [group])
+    return messages
+
+
+def send_messages(messages):
+    """
+    Send (group, message) pairs, all at once from sync code (eg. on commit, celery tasks).
+    Nota: each `async_to_sync()` call from sync code runs its own event loop, and the Redis layer
+    pools its connections per event loop: sending in one call reuses one connection.
+    """
+    if messages:
+        async_to_sync(group_send_all)(get_channel_layer(), messages)
+
+
+async def group_send_all(channel_layer, messages):
+    for group, message in messages:
+        await channel_layer.group_send(group, message)
+
+
+def select_events(stream, operations, model):
+    """
+    Stream of the subscription events of `operations` on `model` instances,
+    the events of batches being emitted one by one.
+    Batches are filtered as a whole, with one callback per message received.
+    :param stream: observable of events, eg. `info.context.subscribe(group)`.
+    """
+    def select(event):
+        events = event.events if isinstance(event, EventBatch) else [event]
+        return [ev for ev in events if ev.operation in operations and isinstance(ev.instance, model)]
+
+    return stream.flat_map(select)
@@ -0,0 +1,29 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils.timezone import now
+
+from books.models import ArchivedLoan
+from books.settings import get_setting
+
+
+class Command(BaseCommand):
+    help = "Move loans ended long ago and their leases to the archive tables, cf. `ArchivedLoan`."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=get_setting('ARCHIVE_AFTER_DAYS'),
+            help='Archive loans ended more than this many days ago.')
+        parser.add_argument(
+            '--batch-size', type=int, default=get_setting('ARCHIVE_BATCH_SIZE'),
+            help='Loans archived per transaction.')
+        parser.add_argument('--max-batches', type=int, help='Stop after this many batches. Unbounded by default.')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        counts = ArchivedLoan.objects.archive(
+            now() - timedelta(days=options['days']), options['batch_size'], options['max_batches'])
+        self.stdout.write(self.style.SUCCESS(
+            'Archived {loans_archived} loans and {leases_archived} leases'.format(**counts) +
+            f' in {time.perf_counter() - started:.1f}s.'))
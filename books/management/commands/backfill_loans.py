@@ -0,0 +1,19 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from books.models import Loan, Lease
+
+
+class Command(BaseCommand):
+    help = (
+        "Backfill `Lease.expires_at` and `Loan.ended` of rows created before they existed. "
+        "Run once after upgrading, rather than by every lease expiry run."
+    )
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        leases = Lease.objects.backfill_expires_at(active_only=False)
+        loans = Loan.objects.backfill_ended()
+        self.stdout.write(self.style.SUCCESS(
+            f'Backfilled {leases} leases and {loans} loans in {time.perf_counter() - started:.1f}s.'))
@@ -0,0 +1,131 @@
+import random
+import time
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils.timezone import now
+
+from books.models import Book, Loan, Lease, chunks
+
+
+class Command(BaseCommand):
+    help = (
+        "Show query plans and timings of the loan and lease state queries, "
+        "on a generated dataset (rolled back unless --keep)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--leases', type=int, default=1000000, help='Leases to generate, 2 per loan.')
+        parser.add_argument('--users', type=int, default=1000, help='Users to generate.')
+        parser.add_argument('--books', type=int, default=1000, help='Books to generate.')
+        parser.add_argument('--active', type=float, default=.1, help='Share of active loans.')
+        parser.add_argument('--repeat', type=int, default=5, help='Runs per query, best is kept.')
+        parser.add_argument('--keep', action='store_true', help='Keep the generated dataset.')
+        parser.add_argument('--batch-size', type=int, default=10000, help='Rows per INSERT.')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            started = time.perf_counter()
+            loan_ids = self._generate(options)
+            self.stdout.write(f'Generated {len(loan_ids) * 2} leases in {time.perf_counter() - started:.1f}s.')
+
+            sample = random.Random(0).sample(loan_ids, min(options['repeat'], len(loan_ids)))
+            loans = list(Loan.objects.filter(pk__in=sample))
+            for name, queryset, run in self._queries(loans):
+                best = min(self._time(run, loan) for loan in loans)
+                self.stdout.write(self.style.SUCCESS(f'{name}: {best * 1000:.2f} ms'))
+                if queryset is not None:
+                    self.stdout.write('    ' + queryset(loans[0]).explain().replace('\n', '\n    '))
+
+            if not options['keep']:
+                transaction.set_rollback(True)
+
+    @staticmethod
+    def _queries(loans):
+        """
+        (name, queryset to explain, run) of the queries benchmarked, given a loan.
+        """
+        since = now() - timedelta(days=7)
+        return [
+            ('active loan of (user, book)',
+             lambda loan: Loan.objects.active().filter(user_id=loan.user_id, book_id=loan.book_id),
+             lambda loan: Loan.objects.active().filter(user_id=loan.user_id, book_id=loan.book_id).first()),
+            ('ended loans of user',
+             lambda loan: Loan.objects.ended().filter(user_id=loan.user_id),
+             lambda loan: list(Loan.objects.ended().filter(user_id=loan.user_id))),
+            ('active leases of loan',
+             lambda loan: Lease.objects.by_loan(loan),
+             lambda loan: list(Lease.objects.by_loan(loan))),
+            ('duration of loan', None, lambda loan: Lease.objects.duration(loan)),
+            ('active leases started last week',
+             lambda loan: Lease.objects.active().filter(started__gte=since),
+             lambda loan: Lease.objects.active().filter(started__gte=since).count()),
+            ('timed out leases',
+             lambda loan: Lease.objects.active().timed_out(),
+             lambda loan: Lease.objects.active().timed_out().count()),
+            ('cancel leases of loan (rolled back)', None, Command._cancel),
+        ]
+
+    @staticmethod
+    def _cancel(loan):
+        with transaction.atomic():
+            Lease.objects.cancel(loan)
+            transaction.set_rollback(True)
+
+    @staticmethod
+    def _time(run, loan):
+        started = time.perf_counter()
+        run(loan)
+        return time.perf_counter() - started
+
+    def _generate(self, options):
+        """
+        Generate users, books, loans and 2 leases per loan, (user, book) pairs being unique.
+        Loans are active, expired or cancelled, alongside their leases.
+        :return: generated loan ids.
+        """
+        batch_size = options['batch_size']
+        rand = random.Random(0)
+        tag = int(time.time())
+
+        users = get_user_model().objects.bulk_create([
+            get_user_model()(username=f'bench-{tag}-{i}', password='!') for i in range(options['users'])
+        ], batch_size=batch_size)
+        if not users[0].pk:
+            users = list(get_user_model().objects.filter(username__startswith=f'bench-{tag}-'))
+        # bulk_create(): no post_save signals queuing celery tasks (preview, search index)
+        books = Book.objects.bulk_create([
+            Book(title=f'Bench {i}', abstract='', isbn=f'bench-{i}', page_count=100, publication_date=2020)
+            for i in range(options['books'])
+        ], batch_size=batch_size)
+        if not books[0].pk:
+            books = list(Book.objects.filter(isbn__startswith='bench-').order_by('-pk')[:options['books']])
+
+        n_loans = min(options['leases'] // 2, len(users) * len(books))
+        loan_ids = []
+        for batch in chunks(range(n_loans), batch_size):
+            loans, leases = [], []
+            for i in batch:
+                status = Loan.ONGOING if rand.random() < options['active'] else \
+                    rand.choice([Loan.EXPIRED, Loan.EXPIRED, Loan.EXPIRED, Loan.CANCELLED])
+                started = now() - timedelta(days=rand.randint(0, 365))
+                loan = Loan(
+                    user=users[i % len(users)], book=books[(i // len(users)) % len(books)], status=status,
+                    ended=None if status == Loan.ONGOING else started + timedelta(days=14),
+                )
+                loans.append(loan)
+                for duration in (7, 7):
+                    # loan ids are UUIDs set before insertion: unlike users' and books' ids,
+                    # known whether or not the backend returns rows from bulk inserts
+                    lease = Lease(loan_id=loan.pk, started=started, duration=duration, status=status)
+                    lease.expires_at = lease.get_expires_at()
+                    leases.append(lease)
+                    started += timedelta(days=duration)
+            Loan.objects.bulk_create(loans)
+            Lease.objects.bulk_create(leases)
+            loan_ids += [loan.pk for loan in loans]
+            self.stdout.write(f'{len(loan_ids) * 2} leases generated')
+
+        return loan_ids
@@ -0,0 +1,83 @@
+import glob
+import os
+import tempfile
+import time
+
+import fitz
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from books.pdf import parse_pages, get_valid_preview_pages, copy_pages, PREVIEW_SAVE_OPTIONS
+
+
+def make_preview_per_page(input, pages, out_path):
+    """
+    Preview as built formerly, copying pages one at a time.
+    """
+    output = fitz.open()
+    for p in pages:
+        output.insertPDF(input, from_page=p-1, to_page=p-1)
+    output.save(out_path)
+
+
+def make_preview_per_run(input, pages, out_path):
+    """
+    Preview as built by `books.pdf.make_pdf_preview()`.
+    """
+    output = fitz.open()
+    copy_pages(input, output, pages)
+    output.save(out_path, **PREVIEW_SAVE_OPTIONS)
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare PDF preview build times and output sizes, "
+        "copying pages one at a time (former) vs. by contiguous runs (current)."
+    )
+
+    builders = (
+        ('per page', make_preview_per_page),
+        ('per run', make_preview_per_run),
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'paths', nargs='*',
+            help='PDF files to build previews from. Defaults to the PDFs in MEDIA_ROOT/filer_public.')
+        parser.add_argument('--pages', default='1-10', help="Preview page ranges, eg. '1-10, 20-25'.")
+        parser.add_argument('--repeat', type=int, default=3, help='Builds per file and method, best is kept.')
+
+    def handle(self, *args, **options):
+        paths = options['paths'] or sorted(
+            path for path in glob.glob(os.path.join(settings.MEDIA_ROOT, 'filer_public', '**', '*.pdf'),
+                                       recursive=True)
+            if not path.endswith('-preview.pdf')
+        )
+        totals = {name: [0, 0] for name, _ in self.builders}
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for path in paths:
+                input = fitz.open(path)
+                pages, _ = get_valid_preview_pages(parse_pages(options['pages']), input.pageCount)
+                results = []
+                for name, builder in self.builders:
+                    out_path = os.path.join(tmp_dir, name.replace(' ', '-') + '.pdf')
+                    best = min(self._time(builder, input, pages, out_path) for _ in range(options['repeat']))
+                    size = os.path.getsize(out_path)
+                    totals[name][0] += best
+                    totals[name][1] += size
+                    results.append(f'{name}: {best * 1000:8.1f} ms {size / 1024:8.1f} KiB')
+
+                self.stdout.write(f'{os.path.basename(path)} ({len(pages)} of {input.pageCount} pages)')
+                self.stdout.write('    ' + ' | '.join(results))
+
+        self.stdout.write(self.style.SUCCESS('Total over {} files: {}'.format(len(paths), ' | '.join(
+            f'{name}: {seconds * 1000:.1f} ms {size / 1024:.1f} KiB'
+            for name, (seconds, size) in totals.items()
+        ))))
+
+    @staticmethod
+    def _time(builder, input, pages, out_path):
+        start = time.perf_counter()
+        builder(input, pages, out_path)
+        return time.perf_counter() - start
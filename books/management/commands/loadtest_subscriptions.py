@@ -0,0 +1,125 @@
+import asyncio
+import statistics
+import time
+
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+from django.utils.timezone import now
+
+from books.events import PayloadEvent, get_messages, group_send_all, CATALOGUE_GROUP, book_groups
+from books.models import Book, BOOK_EDITED
+
+SUBSCRIPTION = 'subscription { bookEdited { id title } }'
+
+
+class Command(BaseCommand):
+    help = (
+        "Load test delivery of subscription events to websocket clients of `graphql/`, "
+        "over the in-memory or the Redis channel layer (eg. a local `redis-server --save ''` stand-in). "
+        "Events are published as by `books.events`, and carry their send time to measure latency."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=1000, help='Concurrent websocket subscribers.')
+        parser.add_argument('--events', type=int, default=50, help='Book events published.')
+        parser.add_argument('--rate', type=float, default=0, help='Events published per second, 0 for no limit.')
+        parser.add_argument(
+            '--layer', choices=sorted(settings.CHANNEL_LAYER_PROFILES), default=settings.CHANNEL_LAYER,
+            help='Channel layer profile, cf. `CHANNEL_LAYER_PROFILES`.')
+        parser.add_argument('--redis-url', default=settings.REDIS_URL, help='Redis for the `redis` profile.')
+        parser.add_argument('--timeout', type=float, default=60, help='Seconds to wait for all deliveries.')
+
+    def handle(self, *args, **options):
+        layer = dict(settings.CHANNEL_LAYER_PROFILES[options['layer']])
+        if options['layer'] == 'redis':
+            layer['CONFIG'] = dict(layer['CONFIG'], hosts=[options['redis_url']], prefix='welearn-loadtest')
+
+        # overriding CHANNEL_LAYERS resets the layers loaded already
+        with override_settings(CHANNEL_LAYERS={'default': layer}):
+            results = asyncio.run(self.run(options))
+
+        self.report(options, **results)
+
+    async def run(self, options):
+        from welearn.routing import application
+
+        started = time.perf_counter()
+        clients = await asyncio.gather(*(self.connect(application) for _ in range(options['clients'])))
+        if not all(clients):
+            raise CommandError(f'{clients.count(None)} clients failed to subscribe.')
+        connected = time.perf_counter() - started
+
+        latencies = []
+        receivers = [
+            asyncio.ensure_future(self.receive(client, options['events'], latencies))
+            for client in clients
+        ]
+        started = time.perf_counter()
+        await self.publish(options['events'], options['rate'])
+        published = time.perf_counter() - started
+
+        done, pending = await asyncio.wait(receivers, timeout=options['timeout'])
+        delivered = time.perf_counter() - started
+        for receiver in pending:
+            receiver.cancel()
+        await asyncio.gather(*(client.disconnect() for client in clients), return_exceptions=True)
+
+        return dict(connected=connected, published=published, delivered=delivered, latencies=latencies)
+
+    @staticmethod
+    async def connect(application):
+        client = WebsocketCommunicator(application, 'graphql/', subprotocols=['graphql-ws'])
+        connected, _ = await client.connect()
+        if not connected:
+            return None
+        await client.send_json_to(dict(type='connection_init', payload={}))
+        await client.receive_json_from(timeout=30)
+        await client.send_json_to(dict(type='start', id='1', payload=dict(query=SUBSCRIPTION, variables={})))
+        # acknowledged once the subscription started (ie. joined its group), messages being handled in order
+        await client.send_json_to(dict(type='connection_init', payload={}))
+        await client.receive_json_from(timeout=30)
+        return client
+
+    @staticmethod
+    async def receive(client, count, latencies):
+        for _ in range(count):
+            message = await client.receive_json_from(timeout=None)
+            sent = float(message['payload']['data']['bookEdited']['title'])
+            latencies.append(time.time() - sent)
+
+    @staticmethod
+    async def publish(count, rate):
+        """
+        Publish `count` book events, as `books.events.send()` does.
+        Books are not saved: their payloads need no database queries.
+        """
+        channel_layer = get_channel_layer()
+        for i in range(count):
+            book = Book(pk=i + 1, title=f'{time.time():.6f}', published=now(), page_count=0)
+            event = PayloadEvent(operation=BOOK_EDITED, instance=book)
+            await group_send_all(channel_layer, get_messages(event, book_groups(book.pk)))
+            if rate:
+                await asyncio.sleep(1 / rate)
+
+    def report(self, options, connected, published, delivered, latencies):
+        expected = options['clients'] * options['events']
+        self.stdout.write(
+            f"{options['clients']} clients subscribed to {CATALOGUE_GROUP} in {connected:.2f}s, "
+            f"over the {options['layer']} channel layer")
+        self.stdout.write(f"{options['events']} events published in {published:.2f}s")
+        if not latencies:
+            raise CommandError('No event delivered.')
+
+        latencies.sort()
+        percentile = lambda p: latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000
+        self.stdout.write(
+            f'Latency (ms): mean {statistics.mean(latencies) * 1000:.1f} | p50 {percentile(.5):.1f} | '
+            f'p95 {percentile(.95):.1f} | p99 {percentile(.99):.1f} | max {latencies[-1] * 1000:.1f}')
+
+        style = self.style.SUCCESS if len(latencies) == expected else self.style.WARNING
+        self.stdout.write(style(
+            f'Delivered {len(latencies)}/{expected} events in {delivered:.2f}s, '
+            f'{len(latencies) / delivered:.0f} deliveries/s'))
@@ -0,0 +1,153 @@
+import json
+import os
+import time
+from multiprocessing import Pool
+
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+from tess_core.helpers import get_or_create_filer_obj
+
+from books import cache
+from books.models import Book
+from books.pdf import make_preview_filename, remove_tmp_path
+from books.previews import make_cached_pdf_preview
+from books.settings import get_setting
+
+
+def build_preview(job):
+    """
+    Build a book preview in a worker process. No database access here.
+    :param job: tuple of book id, and `make_cached_pdf_preview()` args.
+    :return: tuple of book id, path of the preview built (if succeeded), error (if failed).
+    """
+    book_id, in_path, filename, preview_pages, sha1 = job
+    try:
+        out_path, _ = make_cached_pdf_preview(in_path, filename, preview_pages, sha1)
+        return book_id, out_path, None
+    except Exception as e:
+        return book_id, None, str(getattr(e, 'error', e))
+
+
+def is_preview_stale(book):
+    """
+    Whether the book's preview is missing, or named or filed under outdated settings
+    (`BOOKS_PREVIEW_PREFIX`, `BOOKS_PREVIEW_FOLDER`).
+    """
+    preview = book.file_preview
+    if not preview:
+        return True
+    folder = preview.folder
+    return preview.label != make_preview_filename(book.file.label) or \
+        not folder or folder.name != get_setting('PREVIEW_FOLDER')
+
+
+class Command(BaseCommand):
+    help = (
+        "(Re)create missing or stale book previews, in a pool of worker processes. "
+        "Progress is checkpointed, so that an interrupted run can be resumed."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Rebuild all previews, not only missing or stale ones.')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Worker processes.')
+        parser.add_argument(
+            '--max-tasks-per-child', type=int, default=20,
+            help='Previews built by a worker before it is replaced, bounding its memory.')
+        parser.add_argument('--batch-size', type=int, default=50, help='Previews registered in filer per transaction.')
+        parser.add_argument(
+            '--checkpoint', default=os.path.join(get_setting('TMP_DIR'), 'rebuild_previews.json'),
+            help='File recording the books processed so far.')
+        parser.add_argument(
+            '--resume', action='store_true',
+            help='Skip books built by the checkpointed run, retrying those that failed.')
+
+    def handle(self, *args, **options):
+        checkpoint = self._load_checkpoint(options['checkpoint']) if options['resume'] \
+            else dict(done=[], failed={})
+        skipped = set(checkpoint['done'])
+
+        books = Book.objects.filter(file__isnull=False) \
+            .select_related('file', 'file_preview', 'file_preview__folder')
+        jobs = [
+            (book.pk, book.file.path, make_preview_filename(book.file.label), book.preview_pages, book.file.sha1)
+            for book in books.iterator()
+            if book.pk not in skipped and (options['all'] or is_preview_stale(book))
+        ]
+        self.stdout.write(
+            f'{len(jobs)} previews to build, {len(skipped)} skipped from checkpoint, '
+            f'{len(checkpoint["failed"])} failed formerly to retry.')
+        if not jobs:
+            return
+
+        # workers are forked, and must not share the database connections
+        connections.close_all()
+        started, built, failed = time.perf_counter(), 0, 0
+        with Pool(options['workers'], maxtasksperchild=options['max_tasks_per_child']) as pool:
+            results = pool.imap_unordered(build_preview, jobs)
+            for batch in self._batches(results, options['batch_size']):
+                self._register(batch)
+                for book_id, out_path, error in batch:
+                    if error:
+                        failed += 1
+                        checkpoint['failed'][str(book_id)] = error
+                        self.stderr.write(f'Book #{book_id}: {error}')
+                    else:
+                        built += 1
+                        checkpoint['done'].append(book_id)
+                        checkpoint['failed'].pop(str(book_id), None)
+                self._save_checkpoint(options['checkpoint'], checkpoint)
+
+                elapsed = time.perf_counter() - started
+                self.stdout.write(
+                    f'{built + failed}/{len(jobs)} processed, {failed} failed, '
+                    f'{(built + failed) / elapsed:.1f} previews/s')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Built {built} previews, {failed} failed in {time.perf_counter() - started:.1f}s. '
+            f'Checkpoint: {options["checkpoint"]}'))
+
+    @staticmethod
+    def _batches(results, size):
+        batch = []
+        for result in results:
+            batch.append(result)
+            if len(batch) == size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    @staticmethod
+    def _register(batch):
+        """
+        Register built previews in filer, and link them to their books, in one transaction.
+        Updated with querysets, so as not to queue previews again from `post_save`.
+        Built previews are removed once copied to filer's storage, or left behind by a failure.
+        """
+        try:
+            with transaction.atomic():
+                for book_id, out_path, error in batch:
+                    if error:
+                        Book.objects.filter(pk=book_id).update(preview_status=Book.PREVIEW_FAILED)
+                        continue
+                    file, created = get_or_create_filer_obj('File', out_path, get_setting('PREVIEW_FOLDER'))
+                    Book.objects.filter(pk=book_id).update(file_preview=file, preview_status=Book.PREVIEW_READY)
+                cache.invalidate()
+        finally:
+            for book_id, out_path, error in batch:
+                remove_tmp_path(out_path)
+
+    @staticmethod
+    def _load_checkpoint(path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return dict(done=[], failed={})
+
+    @staticmethod
+    def _save_checkpoint(path, checkpoint):
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp_path, path)
@@ -0,0 +1,33 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from books.models import Book
+from books.search import get_search_backend, get_book_document
+
+
+class Command(BaseCommand):
+    help = "Rebuild the full-text search index of books, cf. `books.search`."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--no-content', action='store_true',
+            help="Index titles, abstracts, ISBNs and authors only, not the text of PDF files.")
+
+    def handle(self, *args, **options):
+        backend = get_search_backend()
+        started, indexed = time.perf_counter(), 0
+
+        books = Book.objects.select_related('file')
+        with transaction.atomic():
+            backend.setup()
+            backend.clear()
+            for book in books.iterator(chunk_size=100):
+                backend.index(book.pk, get_book_document(book, with_content=not options['no_content']))
+                indexed += 1
+                if indexed % 100 == 0:
+                    self.stdout.write(f'{indexed} books indexed')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Indexed {indexed} books with {type(backend).__name__} in {time.perf_counter() - started:.1f}s.'))
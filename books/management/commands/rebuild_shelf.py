@@ -0,0 +1,15 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from books.models import ShelfItem
+
+
+class Command(BaseCommand):
+    help = "Rebuild users' shelves (`ShelfItem`) from the active loans and their leases."
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        count = ShelfItem.objects.rebuild()
+        self.stdout.write(self.style.SUCCESS(
+            f'Rebuilt {count} shelf items in {time.perf_counter() - started:.1f}s.'))
@@ -1,20 +1,23 @@
 import uuid
+from datetime import timedelta
 
 from django.core.validators import MinValueValidator, MaxValueValidator
-from django.db.models.functions import Now
 from django.shortcuts import get_object_or_404
 from django.utils.text import slugify
 from django.utils.timezone import now
 from django.utils.translation import ugettext_lazy as _
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction, IntegrityError
 from filer.fields.image import FilerImageField, FilerFileField
-from graphene_subscriptions.events import SubscriptionEvent
+from jsonfield import JSONField
 from tess_core.helpers import get_or_create_filer_obj
 from tess_core.models import ModelSubscriptionMixin
 
+from books import cache, runs
+from books.events import publish, user_group, PayloadEvent
 from books.settings import get_setting
-from books.pdf import make_pdf_preview, make_preview_filename
+from books.pdf import make_preview_filename, remove_tmp_path, pdf_info
+from books.previews import make_cached_pdf_preview
 
 # Custom GraphQL event subscriptions (graphene-subscriptions)
 # match loan management status: (resp.) ONGOING, EXPIRED, CANCELLED,
@@ -29,6 +32,15 @@ BOOK_EDITED = 'book_created_updated_or_published'
 BOOK_REMOVED = 'book_deleted_or_unpublished'
 
 
+def chunks(items, size):
+    """
+    Split `items` (list) into successive lists of at most `size` items,
+    eg. to keep `pk__in` lookups under the database's max query parameters.
+    """
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
 def get_default_cover_img():
     file, created = get_or_create_filer_obj(
         'Image', get_setting('COVER_PLACEHOLDER_IMG'), get_setting('COVERS_FOLDER')
@@ -40,9 +52,35 @@ class BookQuerySet(models.QuerySet):
     def published(self):
         return self.filter(published__isnull=False)
 
+    def with_pdf_page_count(self):
+        """
+        Annotate books with the page count of their file introspected (`PDFInfo`), if any.
+        """
+        page_count = PDFInfo.objects.filter(file_id=models.OuterRef('file_id')).values('page_count')[:1]
+        return self.annotate(pdf_page_count=models.Subquery(page_count))
+
+    def for_events(self):
+        """
+        Books with all the values of their payloads (cf. `Book.get_event_payload()`),
+        ie. their files joined and PDF page count, so that dumping them
+        (eg. into catalogue cache entries) runs no query per book.
+        """
+        return self.with_pdf_page_count().select_related('file', 'file_preview', 'cover_img', 'back_img')
+
 
 class Book(ModelSubscriptionMixin, tess_core_models.BaseMedium):
 
+    PREVIEW_PENDING = 'pending'
+    PREVIEW_READY = 'ready'
+    PREVIEW_FAILED = 'failed'
+    PREVIEW_SKIPPED = 'skipped'
+    PREVIEW_STATUS_CHOICES = [
+        (PREVIEW_PENDING, 'Pending - Queued for (re)creation'),
+        (PREVIEW_READY, 'Ready - Created from `preview_pages`'),
+        (PREVIEW_FAILED, 'Failed - Could not be created'),
+        (PREVIEW_SKIPPED, 'Skipped - No file to create it from'),
+    ]
+
     # META ===================
     title = models.CharField(max_length=255)
     abstract = models.TextField()
@@ -66,6 +104,9 @@ class Book(ModelSubscriptionMixin, tess_core_models.BaseMedium):
     file_preview = FilerFileField(
         null=True, blank=True, related_name="book_preview_files", on_delete=models.SET_NULL,
         help_text='File for public preview. Generated automatically from `preview_pages`.')
+    preview_status = models.CharField(
+        max_length=10, choices=PREVIEW_STATUS_CHOICES, null=True, blank=True, editable=False,
+        help_text='Status of `file_preview`, created in the background.')
     cover_img = FilerImageField(
         null=True, related_name="book_covers", on_delete=models.SET(get_default_cover_img),
         help_text='Front cover image.')
@@ -78,6 +119,15 @@ class Book(ModelSubscriptionMixin, tess_core_models.BaseMedium):
     def __str__(self):
         return 'ISDN #{} ({} pages) {}'.format(self.isbn, self.page_count, self.title)
 
+    def clean(self):
+        """
+        Sync `page_count` with the actual page count of `file`, if already introspected.
+        """
+        super().clean()
+        page_count = PDFInfo.objects.get_page_count(self.file_id)
+        if page_count:
+            self.page_count = page_count
+
     def get_title(self):
         return self.title
 
@@ -106,22 +156,134 @@ class Book(ModelSubscriptionMixin, tess_core_models.BaseMedium):
     def authors_pretty(self):
         return ', '.join([str(a) for a in self.authors.all()[:3]])
 
+    def get_event_payload(self):
+        """
+        Values of subscription events (and cached catalogue entries) on this book,
+        resolved by `BookType` without queries. cf. `books.payloads`.
+        """
+        url = lambda file: file.canonical_url if file else None
+        pdf_page_count = self.pdf_page_count if hasattr(self, 'pdf_page_count') \
+            else PDFInfo.objects.get_page_count(self.file_id)
+        return dict(
+            extra=dict(
+                file_url=url(self.file),
+                file_preview_url=url(self.file_preview),
+                cover_img_url=url(self.cover_img),
+                back_img_url=url(self.back_img),
+                pdf_page_count=pdf_page_count,
+            ),
+            # related objects already joined or prefetched only
+            related={
+                name: getattr(self, name) for name in ('publisher', 'language')
+                if self._meta.get_field(name).is_cached(self)
+            },
+            many={
+                name: list(objects) for name, objects in getattr(self, '_prefetched_objects_cache', {}).items()
+            },
+        )
+
     def get_or_create_file_preview(self, force_create=False):
         """
         Create publicly accessible preview of `preview_pages` extracted
         from the file associated with this book, inside pre-configured folder.
+        Previews previously made from identical files and pages are reused, cf. `books.previews`.
         https://gist.github.com/stefanfoulis/715194
         """
         if not self.file_preview or force_create:
             filename = make_preview_filename(self.file.label)
-            pdf, pages = make_pdf_preview(self.file.path, filename, self.preview_pages)
+            pdf, pages = make_cached_pdf_preview(
+                self.file.path, filename, self.preview_pages, self.file.sha1,
+                PDFInfo.objects.get_page_count(self.file_id)
+            )
             if pdf:
-                self.file_preview, created = get_or_create_filer_obj('File', pdf, get_setting('PREVIEW_FOLDER'))
-                self.save()
+                try:
+                    self.file_preview, created = get_or_create_filer_obj('File', pdf, get_setting('PREVIEW_FOLDER'))
+                finally:
+                    # copied to filer's storage
+                    remove_tmp_path(pdf)
+                self.preview_status = Book.PREVIEW_READY
+                self.save(update_fields=['file_preview', 'preview_status'])
 
         return self.file_preview
 
 
+class PDFInfoManager(models.Manager):
+
+    def get_page_count(self, file_id):
+        """
+        Page count of filer file `file_id` if introspected already, None otherwise.
+        """
+        if file_id is None:
+            return None
+        return self.filter(file_id=file_id).values_list('page_count', flat=True).first()
+
+    def extract(self, file):
+        """
+        Introspect the PDF `file` (filer), unless done already for its current content.
+        Also syncs the page count of the books with that file.
+        """
+        info = self.filter(file=file).first()
+        if info and info.sha1 == file.sha1:
+            return info
+
+        info, created = self.update_or_create(file=file, defaults=dict(sha1=file.sha1, **pdf_info(file.path)))
+        Book.objects.filter(file=file).exclude(page_count=info.page_count).update(page_count=info.page_count)
+        cache.invalidate()
+        return info
+
+
+class PDFInfo(models.Model):
+    """
+    Introspection of a PDF file uploaded to filer, extracted once at upload,
+    so that the document needs not be opened again to read these. cf. `books.pdf.pdf_info()`
+    """
+    file = models.OneToOneField('filer.File', primary_key=True, on_delete=models.CASCADE, related_name='pdf_info')
+    sha1 = models.CharField(max_length=40, help_text=_("Hash of the file content introspected."))
+    page_count = models.PositiveIntegerField()
+    metadata = JSONField(default=dict)
+    toc = JSONField(default=list, help_text=_("Table of contents, as [level, title, page] entries."))
+    text_lengths = JSONField(default=list, help_text=_("Text length (chars) of every page."))
+
+    objects = PDFInfoManager()
+
+    def __str__(self):
+        return '{} ({} pages)'.format(self.file, self.page_count)
+
+
+class BookSearchTermQuerySet(models.QuerySet):
+
+    def ranked(self, terms, prefix=None):
+        """
+        Books having all `terms`, and a term starting with `prefix` if given,
+        as {book_id, rank} rows, best ranked first.
+        """
+        exact, prefixed = models.Q(term__in=terms), models.Q(term__startswith=prefix)
+        rows = self.filter(exact | prefixed if prefix else exact).values('book_id')
+        if terms:
+            rows = rows.annotate(matched=models.Count('term', filter=exact)).filter(matched=len(terms))
+        if prefix:
+            rows = rows.annotate(prefix_matched=models.Count('term', filter=prefixed)).filter(prefix_matched__gt=0)
+        return rows.annotate(rank=models.Sum('weight')).order_by('-rank', 'book_id')
+
+
+class BookSearchTerm(models.Model):
+    """
+    Inverted index of books' words for full-text search on databases without FTS5,
+    cf. `books.search.TermsSearchBackend`.
+    """
+    term = models.CharField(max_length=64)
+    book = models.ForeignKey('Book', on_delete=models.CASCADE, related_name='+')
+    weight = models.PositiveIntegerField(help_text=_("Occurrences of the term, weighted by field."))
+
+    objects = BookSearchTermQuerySet.as_manager()
+
+    class Meta:
+        unique_together = ('term', 'book')
+
+    def __str__(self):
+        return '{} ({})'.format(self.term, self.book_id)
+
+
 class LoanQuerySet(models.QuerySet):
 
     def active(self):
@@ -129,8 +291,101 @@ class LoanQuerySet(models.QuerySet):
         return self.filter(active_query, status=Loan.ONGOING)
 
     def ended(self):
-        ended_query = models.Q(status=Loan.EXPIRED) | models.Q(status=Loan.CANCELLED)
-        return self.exclude(ended_query).distinct()
+        return self.filter(status__in=[Loan.EXPIRED, Loan.CANCELLED])
+
+    def backfill_ended(self):
+        """
+        Set `ended` of loans ended before it was set on cancellation, to the expiry of their last lease.
+        Leases' `expires_at` is backfilled first, as it is computed lazily (cf. `backfill_expires_at()`).
+        :return: number of loans updated.
+        """
+        Lease.objects.filter(loan__in=self.ended().filter(ended__isnull=True)).backfill_expires_at(active_only=False)
+        last_expiry = Lease.objects.filter(loan=models.OuterRef('pk')).order_by('-expires_at')
+        return self.ended().filter(ended__isnull=True) \
+            .update(ended=models.Subquery(last_expiry.values('expires_at')[:1]))
+
+    def with_lease_stats(self):
+        """
+        Annotate loans with the total duration, earliest start and latest expiry
+        of their active leases, computed in the loans query itself,
+        instead of one query per loan and property. cf. `Loan.duration`, `Loan.started`, `Loan.expires_at`.
+        """
+        active = models.Q(leases__status=Lease.ONGOING)
+        return self.annotate(
+            active_duration=models.Sum('leases__duration', filter=active),
+            active_started=models.Min('leases__started', filter=active),
+            active_expires_at=models.Max('leases__expires_at', filter=active),
+        )
+
+    def for_events(self):
+        """
+        Loans with all the values of their event payloads (cf. `Loan.get_event_payload()`),
+        ie. active lease stats, book and its files joined, and PDF page count,
+        so that publishing events runs no query per loan.
+        """
+        page_count = PDFInfo.objects.filter(file_id=models.OuterRef('book__file_id')).values('page_count')[:1]
+        return self.with_lease_stats() \
+            .select_related('book__file', 'book__file_preview', 'book__cover_img', 'book__back_img') \
+            .annotate(book_pdf_page_count=models.Subquery(page_count))
+
+    def expire_ended(self, at=None, with_totals=False):
+        """
+        Set-based counterpart of `Loan.expire_ended()`, over all active loans of this queryset.
+        Timed out leases are found in a single query, then revoked alongside their
+        parent loans (those left with no more active lease) in a few bulk UPDATEs,
+        inside one transaction. LOAN_EXPIRED events are sent once committed, in batches.
+        :param at: reference time for expiry, defaults to now. Fixed for the whole run,
+            so that leases timing out while the job runs are left to the next one.
+        Only the leases due are scanned, `expires_at` of older leases being backfilled once
+        (cf. `backfill_loans` command).
+        :param with_totals: also count all active leases and loans, as `Loan.expire_ended()` run on every
+            active loan would have. Costs a scan of all of them, eg. for the periodic run only.
+        :return: counts of leases due, expired leases and loans, and events sent,
+            plus active leases and loans `with_totals`.
+        """
+        at = at or now()
+        batch_size = get_setting('BULK_BATCH_SIZE')
+        loans = self.active()
+        leases = Lease.objects.active().filter(loan__in=loans)
+
+        with transaction.atomic():
+            if with_totals:
+                with runs.phase('totals'):
+                    totals = dict(leases_active=leases.count(), loans_active=loans.count())
+            with runs.phase('scan'):
+                timed_out = list(leases.timed_out(at).values_list('pk', 'loan_id'))
+                counts = dict(leases_due=len(timed_out), leases_expired=0, loans_expired=0)
+                lease_ids = [pk for pk, _ in timed_out]
+                loan_ids = list({loan_id for _, loan_id in timed_out})
+
+            with runs.phase('update'):
+                for batch in chunks(lease_ids, batch_size):
+                    counts['leases_expired'] += Lease.objects \
+                        .filter(pk__in=batch, status=Lease.ONGOING).update(status=Lease.EXPIRED)
+
+                expired = []
+                for batch in chunks(loan_ids, batch_size):
+                    # locked, lest loans cancelled meanwhile be expired (and their events sent)
+                    ended_ids = list(loans.filter(pk__in=batch).exclude(leases__status=Lease.ONGOING)
+                                     .select_for_update().values_list('pk', flat=True))
+                    ended = list(Loan.objects.filter(pk__in=ended_ids).for_events())
+                    counts['loans_expired'] += Loan.objects \
+                        .filter(pk__in=ended_ids, status=Loan.ONGOING) \
+                        .update(status=Loan.EXPIRED, ended=at)
+                    expired.extend(ended)
+
+                ShelfItem.objects.sync(loan_ids)
+
+            # sent on commit, batched
+            with runs.phase('publish'):
+                for loan in expired:
+                    loan.status, loan.ended = Loan.EXPIRED, at
+                    loan.create_subscription(operation=LOAN_EXPIRED)
+                counts['events'] = len(expired)
+
+        if with_totals:
+            counts.update(totals)
+        return counts
 
 
 class LoanManager(models.Manager):
@@ -163,6 +418,20 @@ class Loan(models.Model):
 
     objects = LoanManager.from_queryset(LoanQuerySet)()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'book', 'status']),
+            # ended loans due for archival, cf. `ArchivedLoanQuerySet.archive()`
+            models.Index(fields=['status', 'ended']),
+        ]
+        constraints = [
+            # cf. `LoanQuerySet.active()`
+            models.UniqueConstraint(
+                fields=['user', 'book'], name='books_loan_unique_active',
+                condition=models.Q(status='ongoing', ended__isnull=True, archived__isnull=True),
+            ),
+        ]
+
     @classmethod
     def borrow_book(cls, user, book_id: int, duration: int):
         """
@@ -171,20 +440,152 @@ class Loan(models.Model):
          - extending an existing loan's duration (ie. adding new leases to it).
         If no active loan exist for this book yet, create a new loan and first lease,
         otherwise extend the loan with a new lease.
+
+        Safe under concurrent borrows of the same book by the same user: the unique constraint
+        on active loans lets a single INSERT win, others extending the winner's loan instead.
+        The active loan is locked until committed, so that a concurrent cancellation or expiry
+        can't end it while extended: borrows read it once ended, and create a new loan instead.
         """
         book = get_object_or_404(Book, pk=book_id)
-        loan = cls.objects.active().filter(user=user, book=book).first()
-        if not loan:
-            loan = cls.objects.create(user=user, book=book)
-        Lease.objects.create(loan, duration)
-        loan.create_subscription(operation=BOOK_BORROWED)
+
+        with transaction.atomic():
+            loan = cls.objects.active().select_for_update().filter(user=user, book=book).first()
+            if loan is None:
+                try:
+                    with transaction.atomic():
+                        loan = cls.objects.create(user=user, book=book)
+                except IntegrityError:
+                    # a concurrent borrow created the active loan meanwhile
+                    loan = cls.objects.active().select_for_update().get(user=user, book=book)
+            loan.book = book
+
+            Lease.objects.create(loan, duration)
+            ShelfItem.objects.sync([loan.pk])
+            loan.create_subscription(operation=BOOK_BORROWED)
+
         return loan
 
+    @classmethod
+    def borrow_books(cls, user, items):
+        """
+        Set-based counterpart of `borrow_book()`, eg. for a term's reading list:
+        books are read in one query, then new loans and all leases are bulk inserted,
+        in one transaction. BOOK_BORROWED events are sent once committed, in one batch.
+        Loans created concurrently for the same books (unique active loans) are extended instead.
+        Active loans are locked until committed, as by `borrow_book()`.
+        :param items: list of (book_id, duration) tuples. A book listed twice gets two leases.
+        :return: list of (loan, error) tuples, in the order of `items`.
+        """
+        from books.tasks import schedule_lease_expiry
+
+        batch_size = get_setting('BULK_BATCH_SIZE')
+        books = {}
+        for batch in chunks(list({book_id for book_id, _ in items}), batch_size):
+            books.update((book.pk, book) for book in Book.objects.filter(pk__in=batch))
+
+        errors = [
+            'No Book matches the given query.' if book_id not in books else
+            'Lease duration must be a positive number of days.' if duration is None or duration < 1 else None
+            for book_id, duration in items
+        ]
+        book_ids = list({book_id for (book_id, _), error in zip(items, errors) if not error})
+
+        def lock_active_loans(book_ids):
+            for batch in chunks(book_ids, batch_size):
+                for loan in cls.objects.active().select_for_update().filter(user=user, book_id__in=batch):
+                    loan.book = books[loan.book_id]
+                    loans[loan.book_id] = loan
+
+        with transaction.atomic():
+            loans = {}
+            lock_active_loans(book_ids)
+            new_loans = [cls(user=user, book=books[book_id]) for book_id in book_ids if book_id not in loans]
+            cls.objects.bulk_create(new_loans, batch_size=batch_size, ignore_conflicts=True)
+
+            # loans created above, or concurrently (conflicts ignored)
+            lock_active_loans([loan.book_id for loan in new_loans])
+            errors = [
+                'The active loan of this book ended meanwhile, please retry.'
+                if not error and book_id not in loans else error
+                for (book_id, _), error in zip(items, errors)
+            ]
+
+            results, leases = [], []
+            for (book_id, duration), error in zip(items, errors):
+                if error:
+                    results.append((None, error))
+                    continue
+                lease = Lease(loan=loans[book_id], duration=duration, status=Lease.ONGOING)
+                lease.expires_at = lease.get_expires_at()
+                leases.append(lease)
+                results.append((loans[book_id], None))
+            Lease.objects.bulk_create(leases, batch_size=batch_size)
+            loan_ids = list({loan.pk for loan, error in results if loan})
+            ShelfItem.objects.sync(loan_ids)
+
+            # reloaded with the values of their events, instead of queries per loan
+            borrowed = {}
+            for batch in chunks(loan_ids, batch_size):
+                borrowed.update((loan.pk, loan) for loan in cls.objects.filter(pk__in=batch).for_events())
+            results = [(borrowed[loan.pk] if loan else None, error) for loan, error in results]
+
+            # sent on commit, batched
+            for loan in borrowed.values():
+                loan.create_subscription(operation=BOOK_BORROWED)
+            if leases:
+                eta = min(lease.expires_at for lease in leases)
+                transaction.on_commit(lambda: schedule_lease_expiry(eta))
+
+        return results
+
+    @classmethod
+    def cancel_loans(cls, user, loan_ids):
+        """
+        Set-based counterpart of `cancel()`: the active loans of `user` among `loan_ids`
+        are cancelled alongside their leases in a few UPDATEs, in one transaction.
+        LOAN_CANCELLED events are sent once committed, in one batch.
+        :param loan_ids: loan ids (strings).
+        :return: list of (loan, error) tuples, in the order of `loan_ids`.
+        """
+        at = now()
+        batch_size = get_setting('BULK_BATCH_SIZE')
+        pks = {}
+        for loan_id in loan_ids:
+            try:
+                pks[loan_id] = uuid.UUID(str(loan_id))
+            except ValueError:
+                pass
+
+        with transaction.atomic():
+            loans = {}
+            for batch in chunks(list(set(pks.values())), batch_size):
+                active = cls.objects.active().filter(user=user, pk__in=batch).select_for_update()
+                loans.update((loan.pk, loan) for loan in active)
+
+            for batch in chunks(list(loans), batch_size):
+                Lease.objects.active().filter(loan_id__in=batch).update(status=Lease.CANCELLED)
+                cls.objects.filter(pk__in=batch).update(status=Loan.CANCELLED, ended=at)
+                # reloaded with the values of their events, instead of queries per loan
+                loans.update((loan.pk, loan) for loan in cls.objects.filter(pk__in=batch).for_events())
+            ShelfItem.objects.remove(loans)
+
+            # sent on commit, batched
+            for loan in loans.values():
+                loan.create_subscription(operation=LOAN_CANCELLED)
+
+        results = []
+        for loan_id in loan_ids:
+            loan = loans.get(pks.get(loan_id))
+            results.append((loan, None) if loan else (None, 'No active Loan matches the given query.'))
+        return results
+
     @property
     def started(self):
         """
         Lease start time.
         """
+        if hasattr(self, 'active_started'):
+            return self.active_started
         return self.leases.by_loan(self).earliest('started').started
 
     @property
@@ -193,42 +594,94 @@ class Loan(models.Model):
         Total number of days this loan is initially valid for.
         This is the initial value of the loan expiry counting down.
         """
+        if hasattr(self, 'active_duration'):
+            return self.active_duration or 0
         return self.leases.duration(self)
 
+    @property
+    def expires_at(self):
+        """
+        Time the last active lease of this loan is due.
+        """
+        if hasattr(self, 'active_expires_at'):
+            return self.active_expires_at
+        return self.leases.expires_at(self)
+
     def expire_ended(self):
         """
         Expire all timed out leases on this loan,
         Also mark loan as expired if it has no more lease active.
         Eventually fires LOAN_EXPIRED signal (caught by graphene-subscriptions)
+        Nota: as with `LoanQuerySet.expire_ended()`, a loan is expired once its last lease is,
+        those without active lease to expire (never borrowed through `borrow_book()`) are left as is.
         """
         active = self.leases.active().count()
         expired = self.leases.expire(self, expired_only=True)
-        if expired == active:
+        if expired and expired == active:
             self.status = Loan.EXPIRED
             self.ended = now()
             self.save()
             self.create_subscription(operation=LOAN_EXPIRED)
+        if expired:
+            ShelfItem.objects.sync([self.pk])
 
         lease_counts = dict(expired=expired, active=active)
         return lease_counts
 
     def cancel(self):
         """
-        Cancel this loan, alongside associated active leases.
+        Cancel this loan, alongside associated active leases, in one transaction.
+        The loan is locked meanwhile, as by `borrow_book()`, so that a concurrent borrow
+        never extends it with a lease once cancelled.
+        Loans ended already (expired, or cancelled) are left as is, and reloaded.
+        :return: whether the loan was cancelled.
         """
-        self.leases.cancel(self)
-        self.status = Loan.CANCELLED
-        self.save()
-        self.create_subscription(operation=LOAN_CANCELLED)
+        with transaction.atomic():
+            locked = Loan.objects.active().select_for_update().filter(pk=self.pk).values_list('pk', flat=True)
+            if not list(locked):
+                self.refresh_from_db(fields=['status', 'ended'])
+                return False
+
+            self.leases.cancel(self)
+            self.status = Loan.CANCELLED
+            self.ended = now()
+            self.save(update_fields=['status', 'ended'])
+            ShelfItem.objects.remove([self.pk])
+            # sent on commit
+            self.create_subscription(operation=LOAN_CANCELLED)
+        return True
+
+    def get_event_payload(self):
+        """
+        Values of subscription events on this loan, resolved by `LoanType` without queries:
+        stats of its active leases (as annotated by `LoanQuerySet.with_lease_stats()`), and its book.
+        cf. `books.payloads`.
+        """
+        if hasattr(self, 'book_pdf_page_count'):
+            # cf. `LoanQuerySet.for_events()`
+            self.book.pdf_page_count = self.book_pdf_page_count
+        if hasattr(self, 'active_duration'):
+            stats = dict(
+                active_duration=self.active_duration,
+                active_started=self.active_started,
+                active_expires_at=self.active_expires_at,
+            )
+        else:
+            stats = self.leases.active().aggregate(
+                active_duration=models.Sum('duration'),
+                active_started=models.Min('started'),
+                active_expires_at=models.Max('expires_at'),
+            )
+        return dict(extra=stats, related=dict(book=self.book))
 
     def create_subscription(self, operation):
         """
-        Publish event (graphene-subscriptions)
+        Publish event (graphene-subscriptions) to the loan's user, batched with the current transaction's,
+        cf. `books.events`.
         :param operation: LOAN_CREATED|LOAN_EXPIRED|LOAN_CANCELLED
         :return: None
         """
-        event = SubscriptionEvent(operation=operation, instance=self)
-        event.send()
+        publish(PayloadEvent(operation=operation, instance=self), [user_group(self.user_id)])
 
 
 class LeaseQuerySet(models.QuerySet):
@@ -236,6 +689,34 @@ class LeaseQuerySet(models.QuerySet):
     def active(self):
         return self.filter(status=Lease.ONGOING)
 
+    def timed_out(self, at=None):
+        """
+        Active leases whose duration has elapsed, ie. where (lease.expires_at <= at) == True
+        Served by the index on `expires_at`, so that its cost depends on the leases due only.
+        :param at: reference time, defaults to now.
+        """
+        return self.active().filter(expires_at__lte=at or now())
+
+    def next_expiry(self):
+        """
+        Time the next active lease of an active loan is due, if any.
+        """
+        return self.active() \
+            .filter(loan__in=Loan.objects.active()) \
+            .aggregate(next_expiry=models.Min('expires_at')) \
+            .get('next_expiry')
+
+    def backfill_expires_at(self, active_only=True):
+        """
+        Compute `expires_at` of (active) leases created before it existed.
+        :return: number of leases updated.
+        """
+        leases = list((self.active() if active_only else self).filter(expires_at__isnull=True))
+        for lease in leases:
+            lease.expires_at = lease.get_expires_at()
+        self.bulk_update(leases, ['expires_at'], batch_size=get_setting('BULK_BATCH_SIZE'))
+        return len(leases)
+
     def expired(self):
         return self.filter(status=Lease.EXPIRED)
 
@@ -252,12 +733,16 @@ class LeaseManager(models.Manager):
         return self.active().filter(loan=loan)
 
     def cancel(self, loan):
-        return self._revoke(Lease.CANCELLED)
+        """
+        Cancel all active leases of a loan, in one UPDATE.
+        :return: number of leases cancelled.
+        """
+        return self._revoke(Lease.CANCELLED, self.by_loan(loan))
 
     def expire(self, loan, expired_only=True):
         """
         Expire ended leases for any given loan.
-        ie. where (lease.started < now() - lease.duration) == True
+        ie. where (lease.expires_at <= now()) == True
         :param loan:
         :param expired_only: should revoke only ended leases (default)? or all of them?.
         :return: number of leases that have actually been expired
@@ -265,9 +750,7 @@ class LeaseManager(models.Manager):
         to_revoke = self.active().filter(loan=loan)
 
         if expired_only:
-            db_expr = models.ExpressionWrapper(Now() - models.F('started'), output_field=models.DurationField())
-            to_revoke = to_revoke.annotate(elapsed=db_expr) \
-                .filter(elapsed__gt=models.F('duration'))
+            to_revoke = to_revoke.timed_out()
 
         return self._revoke(Lease.EXPIRED, to_revoke)
 
@@ -279,6 +762,14 @@ class LeaseManager(models.Manager):
                    .aggregate(duration=models.Sum('duration')) \
                    .get('duration') or 0
 
+    def expires_at(self, loan):
+        """
+        Latest expiry time of all associated leases.
+        """
+        return self.by_loan(loan) \
+            .aggregate(expires_at=models.Max('expires_at')) \
+            .get('expires_at')
+
     def create(self, loan, duration):
         """
         Manager method override
@@ -291,8 +782,8 @@ class LeaseManager(models.Manager):
         Revoke all leases in given queryset,
         ie. update their status (reason for revoking: expired|cancelled).
         """
-        if not queryset:
-            return
+        if queryset is None:
+            return 0
         return queryset.update(status=reason)
 
 
@@ -312,8 +803,11 @@ class Lease(models.Model):
     ]
 
     loan = models.ForeignKey(Loan, on_delete=models.CASCADE, related_name='leases')
-    started = models.DateTimeField(auto_now_add=True, blank=True)
+    started = models.DateTimeField(default=now, blank=True)
     duration = models.PositiveIntegerField(help_text=_("Initial lease duration (days)"))
+    expires_at = models.DateTimeField(
+        null=True, blank=True, editable=False, db_index=True,
+        help_text=_("Time this lease is due, ie. `started` + `duration`. Computed on save."))
     status = models.CharField(
         max_length=32,
         choices=LEASE_STATUS_CHOICES,
@@ -322,6 +816,216 @@ class Lease(models.Model):
 
     objects = LeaseManager.from_queryset(LeaseQuerySet)()
 
+    class Meta:
+        indexes = [
+            # active leases of a loan, cf. `LeaseManager.by_loan()`
+            models.Index(fields=['loan', 'status']),
+            models.Index(fields=['status', 'started']),
+        ]
+
+    def get_expires_at(self):
+        return self.started + timedelta(days=self.duration)
+
+    def save(self, *args, **kwargs):
+        self.expires_at = self.get_expires_at()
+        super().save(*args, **kwargs)
+
+
+class ShelfItemQuerySet(models.QuerySet):
+
+    def sync(self, loan_ids):
+        """
+        Re-derive the shelf items of loans `loan_ids` from the loans and their active leases,
+        ie. (re)insert the items of loans still active, and remove the others.
+        Loans are locked meanwhile, so that concurrent borrows extending them sync in turn.
+        """
+        batch_size = get_setting('BULK_BATCH_SIZE')
+        with transaction.atomic():
+            for batch in chunks(list(loan_ids), batch_size):
+                list(Loan.objects.select_for_update().filter(pk__in=batch).values_list('pk', flat=True))
+                loans = Loan.objects.active().filter(pk__in=batch) \
+                    .with_lease_stats().select_related('book__cover_img')
+                ShelfItem.objects.filter(loan_id__in=batch).delete()
+                ShelfItem.objects.bulk_create([ShelfItem.from_loan(loan) for loan in loans])
+
+    def remove(self, loan_ids):
+        for batch in chunks(list(loan_ids), get_setting('BULK_BATCH_SIZE')):
+            self.filter(loan_id__in=batch).delete()
+
+    def sync_book(self, book):
+        """
+        Update the book details copied to shelf items, eg. once its title or cover changed.
+        """
+        return self.filter(book=book).update(title=book.title, cover_img_url=ShelfItem.get_cover_img_url(book))
+
+    def rebuild(self):
+        """
+        Re-derive all shelf items from the active loans.
+        :return: count of shelf items.
+        """
+        batch_size = get_setting('BULK_BATCH_SIZE')
+        loans = Loan.objects.active().with_lease_stats().select_related('book__cover_img')
+        count = 0
+        with transaction.atomic():
+            ShelfItem.objects.all().delete()
+            # one batch of items in memory at a time
+            batch = []
+            for loan in loans.iterator(chunk_size=batch_size):
+                batch.append(ShelfItem.from_loan(loan))
+                if len(batch) >= batch_size:
+                    count += len(ShelfItem.objects.bulk_create(batch))
+                    batch = []
+            if batch:
+                count += len(ShelfItem.objects.bulk_create(batch))
+        return count
+
+
+class ShelfItem(models.Model):
+    """
+    Active loan as shown on its user's shelf, denormalized from `Loan`, `Lease` and `Book`,
+    so that a user's shelf is read with a single indexed scan.
+    Kept up to date by the borrow, expire and cancel paths of `Loan`, and on book changes.
+    cf. `ShelfItemQuerySet.sync()`, `rebuild_shelf` command.
+    """
+    loan = models.OneToOneField(Loan, primary_key=True, on_delete=models.CASCADE, related_name='shelf_item')
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='+')
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='+')
+    title = models.CharField(max_length=255)
+    cover_img_url = models.CharField(max_length=500, null=True, blank=True)
+    duration = models.PositiveIntegerField(help_text=_("Total duration of the active leases (days)."))
+    started = models.DateTimeField(null=True)
+    expires_at = models.DateTimeField(null=True)
+
+    objects = ShelfItemQuerySet.as_manager()
+
+    class Meta:
+        indexes = [models.Index(fields=['user', 'expires_at'])]
+
+    def __str__(self):
+        return '{} ({})'.format(self.title, self.user_id)
+
+    @classmethod
+    def from_loan(cls, loan):
+        """
+        :param loan: active loan annotated with `LoanQuerySet.with_lease_stats()`, and its book.
+        """
+        return cls(
+            loan=loan, user_id=loan.user_id, book_id=loan.book_id,
+            title=loan.book.title, cover_img_url=cls.get_cover_img_url(loan.book),
+            duration=loan.duration or 0, started=loan.started, expires_at=loan.expires_at,
+        )
+
+    @staticmethod
+    def get_cover_img_url(book):
+        return book.cover_img.canonical_url if book.cover_img else None
+
+
+class ArchivedLoanQuerySet(models.QuerySet):
+
+    def archive(self, before, batch_size=None, max_batches=None):
+        """
+        Move loans ended before `before` out of the `Loan` and `Lease` tables, alongside their leases,
+        into `ArchivedLoan` and `ArchivedLease`, in batches of `batch_size` loans (one transaction each),
+        so that the tables of active loans stay about the size of the active loans.
+        :param max_batches: stop after this many batches, eg. to bound the run time. Unbounded if None.
+        :return: counts of loans and leases archived.
+        """
+        batch_size = batch_size or get_setting('ARCHIVE_BATCH_SIZE')
+        counts = dict(loans_archived=0, leases_archived=0)
+        with runs.phase('backfill'):
+            Loan.objects.backfill_ended()
+
+        batches = 0
+        while max_batches is None or batches < max_batches:
+            with transaction.atomic():
+                with runs.phase('copy'):
+                    loans = list(Loan.objects.ended().filter(ended__lt=before)
+                                 .order_by('ended').select_for_update()[:batch_size])
+                    if not loans:
+                        break
+                    loan_ids = [loan.pk for loan in loans]
+                    leases = list(Lease.objects.filter(loan_id__in=loan_ids))
+                    at = now()
+                    ArchivedLoan.objects.bulk_create([ArchivedLoan.from_loan(loan, at) for loan in loans])
+                    ArchivedLease.objects.bulk_create([ArchivedLease.from_lease(lease) for lease in leases])
+
+                with runs.phase('delete'):
+                    Lease.objects.filter(loan_id__in=loan_ids).delete()
+                    ShelfItem.objects.filter(loan_id__in=loan_ids).delete()
+                    Loan.objects.filter(pk__in=loan_ids).delete()
+
+            counts['loans_archived'] += len(loans)
+            counts['leases_archived'] += len(leases)
+            batches += 1
+
+        return counts
+
+    def history(self, user):
+        """
+        Archived loans of `user`, most recently ended first.
+        """
+        return self.filter(user=user).order_by(models.F('ended').desc(nulls_last=True))
+
+
+class ArchivedLoan(models.Model):
+    """
+    Loan ended long ago, moved out of `Loan` alongside its leases (`ArchivedLease`),
+    cf. `ArchivedLoanQuerySet.archive()`. Same ids as the former loans.
+    """
+    id = models.UUIDField(primary_key=True, editable=False)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='+')
+    book = models.ForeignKey('books.Book', on_delete=models.CASCADE, related_name='+')
+    ended = models.DateTimeField(null=True, blank=True)
+    archived = models.DateTimeField(default=now)
+    status = models.CharField(max_length=10, choices=Loan.LOAN_STATUS_CHOICES)
+
+    objects = ArchivedLoanQuerySet.as_manager()
+
+    class Meta:
+        indexes = [models.Index(fields=['user', 'ended'])]
+
+    def __str__(self):
+        return '{} ({}, archived)'.format(self.pk, self.status)
+
+    @classmethod
+    def from_loan(cls, loan, archived):
+        return cls(
+            id=loan.pk, user_id=loan.user_id, book_id=loan.book_id,
+            ended=loan.ended, archived=archived, status=loan.status,
+        )
+
+    def to_loan(self):
+        """
+        Former loan (not saved), as resolved by `LoanType`. Annotated as loans
+        by `LoanQuerySet.with_lease_stats()`, ie. without active lease.
+        """
+        loan = Loan(
+            id=self.pk, user_id=self.user_id, book_id=self.book_id,
+            ended=self.ended, archived=self.archived, status=self.status,
+        )
+        loan._state.adding = False
+        loan.active_duration = loan.active_started = loan.active_expires_at = None
+        return loan
+
+
+class ArchivedLease(models.Model):
+    """
+    Lease of an archived loan. Same ids as the former leases.
+    """
+    id = models.IntegerField(primary_key=True)
+    loan = models.ForeignKey(ArchivedLoan, on_delete=models.CASCADE, related_name='leases')
+    started = models.DateTimeField()
+    duration = models.PositiveIntegerField()
+    expires_at = models.DateTimeField(null=True)
+    status = models.CharField(max_length=32, choices=Lease.LEASE_STATUS_CHOICES)
+
+    @classmethod
+    def from_lease(cls, lease):
+        return cls(
+            id=lease.pk, loan_id=lease.loan_id, started=lease.started, duration=lease.duration,
+            expires_at=lease.expires_at, status=lease.status,
+        )
+
 
 class Store(models.Model):
     """
@@ -332,3 +1036,59 @@ class Store(models.Model):
 
     def __str__(self):
         return '{} ({} books)'.format(self.name, self.books.count())
+
+
+class TaskRunQuerySet(models.QuerySet):
+
+    def latest_by_task(self):
+        """
+        Last run of every task.
+        """
+        latest = TaskRun.objects.filter(task=models.OuterRef('task')).order_by('-started')
+        return self.filter(pk=models.Subquery(latest.values('pk')[:1]))
+
+    def failed_by_task(self):
+        """
+        Count of failed runs, by task name.
+        """
+        failed = self.filter(status=TaskRun.FAILED).values('task').annotate(count=models.Count('pk'))
+        return {row['task']: row['count'] for row in failed.order_by()}
+
+    def prune(self, task, keep):
+        """
+        Delete the runs of `task` but the last `keep` ones.
+        """
+        stale = self.filter(task=task).order_by('-started').values_list('pk', flat=True)[keep:]
+        return self.filter(pk__in=list(stale)).delete()
+
+
+class TaskRun(models.Model):
+    """
+    Run of a background task, as recorded by `books.runs.track_run()`:
+    duration, per-phase timings (seconds) and counters (eg. rows scanned, updated, events sent).
+    """
+
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (SUCCEEDED, 'Succeeded'),
+        (FAILED, 'Failed'),
+    ]
+
+    task = models.CharField(max_length=100)
+    started = models.DateTimeField(default=now)
+    duration = models.FloatField(help_text=_("Wall time of the run (seconds)."))
+    status = models.CharField(max_length=32, choices=STATUS_CHOICES, default=SUCCEEDED)
+    counters = JSONField(default=dict)
+    phases = JSONField(default=dict, help_text=_("Wall time of the run's phases (seconds)."))
+    failures = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+
+    objects = TaskRunQuerySet.as_manager()
+
+    class Meta:
+        ordering = ['-started']
+        indexes = [models.Index(fields=['task', '-started'])]
+
+    def __str__(self):
+        return '{} at {} ({:.3f}s, {})'.format(self.task, self.started, self.duration, self.status)
@@ -0,0 +1,120 @@
+"""
+Compact, versioned payloads of model instances for subscription events, cf. `books.events.PayloadEvent`.
+
+A payload holds the instance's concrete field values, the values its subscribers would
+otherwise query for (eg. file URLs, lease stats), and related instances' payloads:
+
+    {'v': 1, 'model': 'books.loan', 'pk': ..., 'fields': {...}, 'extra': {...},
+     'related': {'book': {...}}, 'many': {'authors': [{...}]}, 'changed': [...]}
+
+Models provide `extra`, `related` (FKs) and `many` (multi-valued relations, loaded as if prefetched)
+with `get_event_payload()`.
+Payloads are packed with msgpack once by the publisher, and loaded by subscribers
+into instances resolving the common fields without database queries.
+"""
+import datetime
+import decimal
+import uuid
+
+import msgpack
+from django.apps import apps
+from django.db import DEFAULT_DB_ALIAS
+
+PAYLOAD_VERSION = 1
+
+# msgpack extension types of values from model fields
+EXT_DATETIME, EXT_DATE, EXT_TIME, EXT_UUID, EXT_DECIMAL = range(1, 6)
+
+
+def _encode(value):
+    if isinstance(value, datetime.datetime):
+        return msgpack.ExtType(EXT_DATETIME, value.isoformat().encode())
+    if isinstance(value, datetime.date):
+        return msgpack.ExtType(EXT_DATE, value.isoformat().encode())
+    if isinstance(value, datetime.time):
+        return msgpack.ExtType(EXT_TIME, value.isoformat().encode())
+    if isinstance(value, uuid.UUID):
+        return msgpack.ExtType(EXT_UUID, value.bytes)
+    if isinstance(value, decimal.Decimal):
+        return msgpack.ExtType(EXT_DECIMAL, str(value).encode())
+    # eg. field files, by name
+    return str(value)
+
+
+def _decode(code, data):
+    if code == EXT_DATETIME:
+        return datetime.datetime.fromisoformat(data.decode())
+    if code == EXT_DATE:
+        return datetime.date.fromisoformat(data.decode())
+    if code == EXT_TIME:
+        return datetime.time.fromisoformat(data.decode())
+    if code == EXT_UUID:
+        return uuid.UUID(bytes=data)
+    if code == EXT_DECIMAL:
+        return decimal.Decimal(data.decode())
+    return msgpack.ExtType(code, data)
+
+
+def pack(payload):
+    return msgpack.packb(payload, default=_encode, use_bin_type=True)
+
+
+def unpack(data):
+    return msgpack.unpackb(data, ext_hook=_decode, raw=False)
+
+
+def dump_instance(instance, changed=None):
+    """
+    Payload of model `instance`.
+    :param changed: names of the fields that changed, if known (eg. `update_fields`).
+    """
+    opts = instance._meta
+    payload = dict(
+        v=PAYLOAD_VERSION,
+        model=opts.label_lower,
+        pk=instance.pk,
+        fields={field.attname: field.value_from_object(instance) for field in opts.concrete_fields},
+        changed=list(changed) if changed else None,
+    )
+
+    get_event_payload = getattr(instance, 'get_event_payload', None)
+    extra = get_event_payload() if get_event_payload else {}
+    payload['extra'] = extra.get('extra', {})
+    payload['related'] = {
+        name: dump_instance(related) for name, related in extra.get('related', {}).items()
+        if related is not None
+    }
+    payload['many'] = {
+        name: [dump_instance(related) for related in objects]
+        for name, objects in extra.get('many', {}).items()
+    }
+    return payload
+
+
+def load_instance(payload):
+    """
+    Model instance from `payload`, as if loaded from the database (but for `extra` attributes),
+    or loaded from the database indeed if `payload` is of another version (eg. while deploying).
+    """
+    model = apps.get_model(payload['model'])
+    if payload.get('v') != PAYLOAD_VERSION:
+        return model._base_manager.filter(pk=payload['pk']).first()
+
+    fields = payload['fields']
+    names = [field.attname for field in model._meta.concrete_fields if field.attname in fields]
+    instance = model.from_db(DEFAULT_DB_ALIAS, names, [fields[name] for name in names])
+
+    for name, value in payload['extra'].items():
+        setattr(instance, name, value)
+    for name, related in payload['related'].items():
+        model._meta.get_field(name).set_cached_value(instance, load_instance(related))
+    if payload.get('many'):
+        # as `prefetch_related_objects()` does: querysets of the related manager, with their results set
+        instance._prefetched_objects_cache = {}
+        for name, objects in payload['many'].items():
+            queryset = getattr(instance, name).get_queryset()
+            queryset._result_cache = [load_instance(related) for related in objects]
+            queryset._prefetch_done = True
+            instance._prefetched_objects_cache[name] = queryset
+
+    return instance
@@ -1,7 +1,18 @@
+import logging
+import os
+import shutil
+import tempfile
+
 import fitz
 
 from books.settings import get_setting
 
+logger = logging.getLogger(__name__)
+
+# Save previews with objects unused or duplicated by copied pages (eg. shared fonts and images)
+# garbage collected, and streams compressed.
+PREVIEW_SAVE_OPTIONS = dict(garbage=4, deflate=True)
+
 
 def make_pdf_preview(in_path, filename, page_ranges):
     """
@@ -22,19 +33,66 @@ def make_pdf_preview(in_path, filename, page_ranges):
         input = fitz.open(in_path)
         output = fitz.open()
         pages, _ = get_valid_preview_pages(pages, input.pageCount)
-        for p in pages:
-            output.insertPDF(input, from_page=p-1, to_page=p-1)
+        copy_pages(input, output, pages)
 
     except Exception as e:
         raise PreviewPDFException(filename, e)
 
     else:
-        out_path = f"{get_setting('TMP_DIR')}/{filename}"
-        output.save(out_path)
+        out_path = make_tmp_path(filename)
+        try:
+            output.save(out_path, **PREVIEW_SAVE_OPTIONS)
+        except Exception:
+            remove_tmp_path(out_path)
+            raise
 
     return out_path, pages
 
 
+def copy_pages(input, output, pages):
+    """
+    Append `pages` of `input` to `output`, one contiguous run of pages at a time.
+    Objects copied by several runs (fonts, images, etc.) are deduplicated when saving,
+    cf. `PREVIEW_SAVE_OPTIONS`.
+    :param pages: page numbers, sorted in natural order.
+    """
+    for first, last in get_page_runs(pages):
+        output.insertPDF(input, from_page=first-1, to_page=last-1)
+
+
+def get_page_runs(pages):
+    """
+    Group sorted page numbers into contiguous runs of (first, last) pages.
+    eg. [1,2,3, 5, 7,8] => [(1, 3), (5, 5), (7, 8)]
+    """
+    runs = []
+    for p in pages:
+        if runs and p == runs[-1][1] + 1:
+            runs[-1][1] = p
+        else:
+            runs.append([p, p])
+
+    return [tuple(run) for run in runs]
+
+
+def make_tmp_path(filename):
+    """
+    Path of a new file named `filename`, in a directory of its own under `TMP_DIR`,
+    so that concurrent jobs (eg. `rebuild_previews` workers) never write the same file,
+    while the file keeps its name (eg. for filer).
+    The caller owns the file, and removes it with `remove_tmp_path()` once done.
+    """
+    return os.path.join(tempfile.mkdtemp(dir=get_setting('TMP_DIR')), filename)
+
+
+def remove_tmp_path(path):
+    """
+    Remove a file made by `make_tmp_path()`, alongside its directory.
+    """
+    if path:
+        shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+
+
 def make_preview_filename(filename):
     """
     File name including extension, but no path, eg. `deeplearningbook-preview.pdf`
@@ -62,13 +120,35 @@ def parse_pages(s: str):
 
 
 def pdf_info(path):
+    """
+    Introspect the PDF at `path`: page count, metadata, table of contents,
+    and text length (chars) of every page.
+    Opens and reads the whole document, cf. `books.models.PDFInfo` for stored results.
+    """
+    with fitz.open(path) as pdf:
+        return dict(
+            page_count=pdf.pageCount,
+            metadata=pdf.metadata,
+            toc=pdf.getToC(),
+            text_lengths=[len(page.getText()) for page in pdf],
+        )
+
+
+def pdf_text(path, max_chars=None):
+    """
+    Text of the PDF at `path`, page after page, for full-text indexing.
+    :param max_chars: stop extracting once that many chars were read, if given.
+    """
+    text, length = [], 0
+    with fitz.open(path) as pdf:
+        for page in pdf:
+            page_text = page.getText()
+            text.append(page_text)
+            length += len(page_text)
+            if max_chars and length >= max_chars:
+                break
 
-    pdf = fitz.open(path)
-    return dict(
-        page_count=pdf.pageCount,
-        metadata=pdf.metadata,
-        toc=pdf.toc
-    )
+    return '\n'.join(text)[:max_chars]
 
 
 def get_valid_preview_pages(preview_pages, page_count):
@@ -81,7 +161,6 @@ def get_valid_preview_pages(preview_pages, page_count):
     closest_value = min(preview_pages, key=lambda x: abs(x - page_count))
     valid_pages = preview_pages[:preview_pages.index(closest_value) + 1]
 
-    # some logging # TODO: some syslogging
     preview_last_page = preview_pages[len(preview_pages) - 1]
     valid = preview_last_page > page_count
     if valid:
@@ -89,7 +168,7 @@ def get_valid_preview_pages(preview_pages, page_count):
             f'Preview page number {preview_last_page} of {page_count} pages out of bounds. ' 
             f'Truncating to pages {",".join([str(p) for p in valid_pages])}.'
         )
-        print(msg)
+        logger.warning(msg)
 
     return valid_pages, valid
 
@@ -102,5 +181,5 @@ class PreviewPDFException(Exception):
         self.filename = filename
         self.error = error
         self.msg = f"Unrecoverable error creating PDF preview from {filename}"
-        print(self.msg)
+        logger.error(self.msg)
         super().__init__(*args,  **kwargs)
@@ -0,0 +1,182 @@
+"""
+Content-addressed store of PDF previews.
+
+A preview is fully determined by the source file's content, the preview's page list
+and the PyMuPDF version building it. Previews are stored under a key hashed from these,
+so that saving a book again or re-uploading an identical file reuses the stored preview
+(a file copy) instead of parsing the whole source PDF again.
+The store is bounded in size, least recently used previews being evicted first.
+The store's size is tracked as previews are put, the store being scanned (and evicted)
+only once full, or every `BOOKS_PREVIEW_CACHE_SCAN_INTERVAL` seconds, to account for
+previews put by other processes.
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import fitz
+
+from books import runs
+from books.pdf import make_pdf_preview, make_tmp_path, remove_tmp_path, parse_pages, get_valid_preview_pages
+from books.settings import get_setting
+
+
+class PreviewStore:
+    """
+    Previews on disk, as `<root>/<key[:2]>/<key>.pdf`.
+    Files' modification time records their last use, for LRU eviction.
+    """
+
+    def __init__(self, root, max_size, scan_interval=None):
+        """
+        :param root: directory to store previews in.
+        :param max_size: max total size of stored previews (bytes).
+        :param scan_interval: max time between scans of the whole store (seconds).
+        """
+        self.root = root
+        self.max_size = max_size
+        self.scan_interval = scan_interval
+        # total size of previews as of the last scan, plus those put since, by this process
+        self.size = None
+        self.scanned = None
+        self.lock = threading.Lock()
+
+    def get_path(self, key):
+        return os.path.join(self.root, key[:2], f'{key}.pdf')
+
+    def get(self, key, out_path):
+        """
+        Copy the preview stored under `key` to `out_path`.
+        :return: False if missing, eg. evicted meanwhile by another process.
+        """
+        path = self.get_path(key)
+        try:
+            os.utime(path)
+            shutil.copyfile(path, out_path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def put(self, key, path):
+        """
+        Store a copy of the preview at `path` under `key`, then evict previews if needed.
+        """
+        store_path = self.get_path(key)
+        os.makedirs(os.path.dirname(store_path), exist_ok=True)
+
+        # copy then rename, so that concurrent readers never get a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(store_path), suffix='.tmp')
+        os.close(fd)
+        shutil.copyfile(path, tmp_path)
+        try:
+            replaced = os.path.getsize(store_path)
+        except FileNotFoundError:
+            replaced = 0
+        os.replace(tmp_path, store_path)
+        self._grow(os.path.getsize(store_path) - replaced)
+
+    def _grow(self, size):
+        with self.lock:
+            scan_due = self.size is None or \
+                (self.scan_interval and time.monotonic() - self.scanned >= self.scan_interval)
+            if not scan_due:
+                self.size += size
+            if scan_due or self.size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        """
+        Delete least recently used previews, until the store fits in `max_size`.
+        Scans the whole store.
+        """
+        entries = []
+        for dir_path, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.endswith('.pdf'):
+                    try:
+                        stat = os.stat(os.path.join(dir_path, filename))
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, os.path.join(dir_path, filename)))
+
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, path in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+        self.size, self.scanned = size, time.monotonic()
+
+
+# stores by root directory, kept per process so as to track their size
+_stores = {}
+
+
+def get_preview_store():
+    root = get_setting('PREVIEW_CACHE_DIR')
+    store = _stores.get(root)
+    if store is None or store.max_size != get_setting('PREVIEW_CACHE_MAX_SIZE'):
+        store = _stores[root] = PreviewStore(
+            root, get_setting('PREVIEW_CACHE_MAX_SIZE'), get_setting('PREVIEW_CACHE_SCAN_INTERVAL'))
+    return store
+
+
+def get_preview_key(sha1, pages):
+    """
+    Key of a preview of `pages` from a source file whose hash is `sha1`.
+    """
+    source = '{}:{}:{}'.format(sha1, ','.join(str(p) for p in pages), fitz.VersionBind)
+    return hashlib.sha256(source.encode()).hexdigest()
+
+
+def get_file_sha1(path, chunk_size=1024 * 1024):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def make_cached_pdf_preview(in_path, filename, page_ranges, sha1=None, page_count=None):
+    """
+    Same as `books.pdf.make_pdf_preview()`, reusing the stored preview if any.
+    :param sha1: hash of the input file's content, eg. filer's `File.sha1`.
+        Computed from the file if not given.
+    :param page_count: page count of the input file if known, eg. from `PDFInfo`.
+    :return: tuple of output file path and page list the preview was requested from,
+        truncated to the page count of the input file if given.
+        The caller removes the output file once done, cf. `books.pdf.remove_tmp_path()`.
+    """
+    pages = parse_pages(page_ranges)
+    if page_count:
+        pages, _ = get_valid_preview_pages(pages, page_count)
+    if not get_setting('PREVIEW_CACHE_MAX_SIZE'):
+        return make_pdf_preview(in_path, filename, page_ranges)
+
+    store = get_preview_store()
+    with runs.phase('cache'):
+        key = get_preview_key(sha1 or get_file_sha1(in_path), pages)
+        out_path = make_tmp_path(filename)
+        stored = store.get(key, out_path)
+        if not stored:
+            remove_tmp_path(out_path)
+    if stored:
+        runs.count(cache_hits=1)
+        return out_path, pages
+
+    with runs.phase('render'):
+        out_path, valid_pages = make_pdf_preview(in_path, filename, page_ranges)
+    with runs.phase('cache'):
+        try:
+            store.put(key, out_path)
+        except Exception:
+            remove_tmp_path(out_path)
+            raise
+    runs.count(cache_misses=1)
+    return out_path, pages
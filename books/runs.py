@@ -0,0 +1,173 @@
+"""
+Instrumentation of background tasks (lease expiry, previews, ...).
+
+`track_run()` times a task run, alongside its phases (`phase()`) and counters (`count()`),
+eg. rows scanned and updated, events sent. Runs are logged, and recorded as `TaskRun` rows,
+the last `TASK_RUN_HISTORY` runs of every task being kept. Unlike in-process metrics,
+these are shared by celery workers and web processes, which export them (cf. `expose()`).
+
+Code called by tasks records phases and counters of the current run, if any, eg.:
+
+    with runs.phase('scan'):
+        ...
+    runs.count(rows_scanned=n)
+"""
+import logging
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+
+from celery.exceptions import Retry
+from django.utils.timezone import now
+
+from books.settings import get_setting
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class Run:
+    """
+    Metrics of a task run in progress.
+    """
+
+    def __init__(self, task, interval=None):
+        """
+        :param task: task name.
+        :param interval: time budget of runs (seconds), eg. the interval they are scheduled at.
+        """
+        self.task = task
+        self.interval = interval
+        self.started = now()
+        self.counters = Counter()
+        self.phases = Counter()
+        self.failures = 0
+        self.error = ''
+        self.duration = None
+        self._started = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Time a phase of this run, summed up if entered several times.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] += time.perf_counter() - started
+
+    def count(self, **counts):
+        self.counters.update(counts)
+
+    def fail(self, error):
+        self.failures += 1
+        self.error = f'{type(error).__name__}: {error}'
+
+    def finish(self):
+        self.duration = time.perf_counter() - self._started
+        phases = ', '.join(f'{name} {seconds:.3f}s' for name, seconds in self.phases.items())
+        counters = ', '.join(f'{name}={count}' for name, count in self.counters.items())
+        logger.info(f'{self.task} ran in {self.duration:.3f}s ({phases}): {counters or "-"}')
+        if self.failures:
+            logger.error(f'{self.task} run failed {self.failures} time(s): {self.error}')
+        if self.interval and self.duration > self.interval * get_setting('TASK_RUN_WARN_RATIO'):
+            logger.warning(f'{self.task} ran in {self.duration:.3f}s, close to its {self.interval}s interval')
+
+    def save(self):
+        from books.models import TaskRun
+
+        TaskRun.objects.create(
+            task=self.task,
+            started=self.started,
+            duration=self.duration,
+            status=TaskRun.FAILED if self.failures else TaskRun.SUCCEEDED,
+            counters=dict(self.counters),
+            phases={name: round(seconds, 6) for name, seconds in self.phases.items()},
+            failures=self.failures,
+            error=self.error,
+        )
+        TaskRun.objects.prune(self.task, get_setting('TASK_RUN_HISTORY'))
+
+
+@contextmanager
+def track_run(task, interval=None):
+    """
+    Track a task run, recorded once done (failed if an exception is raised,
+    but for celery's `Retry`: the run is counted as retried instead, cf. `retries` counter).
+    :param task: task name.
+    :param interval: time budget of runs (seconds), a warning being logged when nearly exceeded.
+    """
+    run = Run(task, interval)
+    previous, _local.run = getattr(_local, 'run', None), run
+    try:
+        yield run
+    except Retry:
+        run.count(retries=1)
+        raise
+    except Exception as e:
+        run.fail(e)
+        raise
+    finally:
+        _local.run = previous
+        run.finish()
+        try:
+            run.save()
+        except Exception as e:
+            # never mask the task's own outcome
+            logger.exception(f'could not record {task} run: {e}')
+
+
+def get_current_run():
+    return getattr(_local, 'run', None)
+
+
+def phase(name):
+    """
+    Time a phase of the current run, if any.
+    """
+    run = get_current_run()
+    return run.phase(name) if run else nullcontext()
+
+
+def count(**counts):
+    """
+    Add to the counters of the current run, if any.
+    """
+    run = get_current_run()
+    if run:
+        run.count(**counts)
+
+
+def expose():
+    """
+    Metrics of the last run of every task, plus failed runs within the history,
+    in the Prometheus text format (lines).
+    """
+    from books.models import TaskRun
+
+    runs = list(TaskRun.objects.latest_by_task().order_by('task'))
+    failed = TaskRun.objects.failed_by_task()
+
+    lines = [
+        '# HELP books_task_last_run_seconds Duration of the last run of background tasks.',
+        '# TYPE books_task_last_run_seconds gauge',
+    ]
+    lines += [f'books_task_last_run_seconds{{task="{run.task}"}} {run.duration}' for run in runs]
+    lines += ['# TYPE books_task_last_run_timestamp_seconds gauge']
+    lines += [f'books_task_last_run_timestamp_seconds{{task="{run.task}"}} {run.started.timestamp()}'
+              for run in runs]
+    lines += ['# TYPE books_task_last_run_phase_seconds gauge']
+    lines += [f'books_task_last_run_phase_seconds{{task="{run.task}",phase="{name}"}} {seconds}'
+              for run in runs for name, seconds in sorted(run.phases.items())]
+    lines += ['# TYPE books_task_last_run_count gauge']
+    lines += [f'books_task_last_run_count{{task="{run.task}",counter="{name}"}} {value}'
+              for run in runs for name, value in sorted(run.counters.items())]
+    lines += [
+        '# HELP books_task_failed_runs Failed runs of background tasks, within the runs history kept.',
+        '# TYPE books_task_failed_runs gauge',
+    ]
+    lines += [f'books_task_failed_runs{{task="{run.task}"}} {failed.get(run.task, 0)}' for run in runs]
+    return lines
@@ -1,50 +1,147 @@
+import logging
+
 import graphene
+from django.db.models import F
+from django.http import Http404
 from django.shortcuts import get_object_or_404
-from graphql_jwt.decorators import login_required, superuser_required
+from graphql import GraphQLError
+from graphql_jwt.decorators import login_required
 
-from books.schema.fields import CreateBookLoan, CancelBookLoan, LoanType, BookType
+from books.schema.fields import (
+    CreateBookLoan, CancelBookLoan, BorrowBooks, CancelBookLoans, LoanType, BookType, ShelfItemType,
+    BookConnection, LoanConnection
+)
+from books.cache import catalogue_cache
+from books.events import select_events, user_group, book_group, CATALOGUE_GROUP
+from books.schema.optimize import optimize_queryset, optimize_queryset_fully, BOOK_LOOKUPS, LOAN_LOOKUPS
+from books.schema.pagination import paginate, get_page_bounds
+from books.search import search_books
+from books.settings import get_setting
 from books.models import (
-    Book, Loan,
+    Book, Loan, ShelfItem, ArchivedLoan,
     BOOK_BORROWED, LOAN_EXPIRED, LOAN_CANCELLED,
     BOOK_EDITED, BOOK_REMOVED
 )
 
 __all__ = [
     'Query', 'Mutation', 'Subscription',
-    'CreateBookLoan', 'CancelBookLoan', 'LoanType', 'BookType'
+    'CreateBookLoan', 'CancelBookLoan', 'BorrowBooks', 'CancelBookLoans', 'LoanType', 'BookType', 'ShelfItemType',
+    'BookConnection', 'LoanConnection'
 ]
 
 from tess_core.schema import SearchQuery
 
+logger = logging.getLogger(__name__)
+
 
 class Query(SearchQuery):
 
-    books = graphene.List(BookType)
+    # published books: all of them in default order, or pages of them if `first` or `offset` are given,
+    # newest first, or best matches of `search` first (cf. `search_books`)
+    books = graphene.List(BookType, first=graphene.Int(), offset=graphene.Int(), search=graphene.String())
     loans = graphene.List(LoanType)
+    # active loans of the user, denormalized (cf. `ShelfItem`), soonest due first
+    shelf = graphene.List(ShelfItemType)
 
     book = graphene.Field(BookType, book_id=graphene.Int())
     loan = graphene.Field(LoanType, loan_id=graphene.String())
 
-    def resolve_books(self, info, **kwargs):
-        qs = Book.objects.published()
-        return Query.search(qs, **kwargs)
+    # ended loans of the user, including archived ones (cf. `ArchivedLoan`), most recently ended first
+    loan_history = graphene.List(LoanType, first=graphene.Int(), offset=graphene.Int())
+
+    # cursor paginated, newest books first
+    books_connection = graphene.relay.ConnectionField(BookConnection)
+    loans_connection = graphene.relay.ConnectionField(LoanConnection)
+
+    # full-text search of published books, best matches first
+    search_books = graphene.List(
+        BookType, query=graphene.String(required=True), first=graphene.Int(), offset=graphene.Int())
+
+    # Nota: `books`, and `book` are served from the catalogue cache (cf. `books.cache`).
+    # Books are cached with the related objects selected by the query that cached them,
+    # others being batch loaded (cf. `books.schema.loaders`).
+
+    def resolve_books(self, info, first=None, offset=None, search=None, **kwargs):
+        qs = optimize_queryset(Book.objects.published(), info, BOOK_LOOKUPS)
+        if catalogue_cache.enabled:
+            # dumped into cache entries on misses, with all the values of their payloads
+            qs = qs.for_events()
+        paged = search or first is not None or offset is not None
+        offset, limit = get_page_bounds(first, offset) if paged else (None, None)
+        if search:
+            get_books = lambda: search_books(search, offset, limit, queryset=qs)
+        elif paged:
+            qs = Query.search(qs.order_by('-published', '-id'), **kwargs)
+            get_books = lambda: list(qs[offset:offset + limit])
+        else:
+            # all published books, in default order, as ever
+            qs = Query.search(qs, **kwargs)
+            get_books = lambda: list(qs)
+        args = dict(kwargs, offset=offset, limit=limit, search=search)
+        return catalogue_cache.get_books('books', args, get_books)
+
+    def resolve_books_connection(self, info, **kwargs):
+        qs = optimize_queryset(Book.objects.published(), info, BOOK_LOOKUPS, path=('edges', 'node'))
+        return paginate(qs, ('-published', '-id'), BookConnection, **kwargs)
+
+    def resolve_search_books(self, info, query, first=None, offset=0, **kwargs):
+        offset, limit = get_page_bounds(first, offset)
+        qs = optimize_queryset(Book.objects.all(), info, BOOK_LOOKUPS)
+        return search_books(query, offset, limit, queryset=qs)
 
     def resolve_book(self, info, book_id, **kwargs):
-        return get_object_or_404(Book, id=book_id)
+        qs = optimize_queryset_fully(Book.objects.with_pdf_page_count(), BOOK_LOOKUPS)
+        book = catalogue_cache.get_book('book', dict(book_id=book_id), lambda: qs.filter(id=book_id).first())
+        if book is None:
+            raise Http404('No Book matches the given query.')
+        return book
 
     @login_required
     def resolve_loans(self, info, **kwargs):
-        qs = Loan.objects.active().filter(user=info.context.user)
+        qs = Loan.objects.active().filter(user=info.context.user).with_lease_stats()
+        qs = optimize_queryset(qs, info, LOAN_LOOKUPS)
         return Query.search(qs, **kwargs)
 
+    @login_required
+    def resolve_shelf(self, info, **kwargs):
+        return ShelfItem.objects.filter(user=info.context.user).order_by('expires_at')
+
+    @login_required
+    def resolve_loans_connection(self, info, **kwargs):
+        qs = Loan.objects.active().filter(user=info.context.user).with_lease_stats()
+        qs = optimize_queryset(qs, info, LOAN_LOOKUPS, path=('edges', 'node'))
+        return paginate(qs, ('id',), LoanConnection, **kwargs)
+
     @login_required
     def resolve_loan(self, info, loan_id, **kwargs):
-        return get_object_or_404(Loan, user=info.context.user, id=loan_id)
+        qs = optimize_queryset(Loan.objects.with_lease_stats(), info, LOAN_LOOKUPS)
+        loan = qs.filter(user=info.context.user, id=loan_id).first()
+        if loan is None:
+            # ended long ago, and archived since
+            loan = get_object_or_404(ArchivedLoan, user=info.context.user, id=loan_id).to_loan()
+        return loan
+
+    @login_required
+    def resolve_loan_history(self, info, first=None, offset=0, **kwargs):
+        offset, limit = get_page_bounds(first, offset)
+        if offset > get_setting('HISTORY_OFFSET_MAX'):
+            raise GraphQLError('Argument `offset` must be at most {}.'.format(get_setting('HISTORY_OFFSET_MAX')))
+
+        user, end = info.context.user, offset + limit
+        # loans without `ended` last, as in the merge below (PostgreSQL sorts NULLs first otherwise)
+        qs = Loan.objects.ended().filter(user=user).with_lease_stats().order_by(F('ended').desc(nulls_last=True))
+        loans = list(optimize_queryset(qs, info, LOAN_LOOKUPS)[:end])
+        loans += [loan.to_loan() for loan in ArchivedLoan.objects.history(user)[:end]]
+        loans.sort(key=lambda loan: (loan.ended is not None, loan.ended or 0), reverse=True)
+        return loans[offset:end]
 
 
 class Mutation:
     borrow_book = CreateBookLoan.Field()
     cancel_book_loan = CancelBookLoan.Field()
+    # batches, in one transaction each
+    borrow_books = BorrowBooks.Field()
+    cancel_book_loans = CancelBookLoans.Field()
 
 
 class Subscription:
@@ -52,52 +149,48 @@ class Subscription:
     Using graphene-subscriptions to stitch together the async-based pattern that Django Channels uses
      with the Observable-based pattern used in graphene.
     Each subscription field resolver must return an observable which emits values matching the field's type.
+    Resolvers join the channel groups of the events they need (`info.context.subscribe()`),
+    instead of filtering every event published, cf. `books.consumers`.
     https://github.com/jaydenwindle/graphene-subscriptions
     """
     book_borrowed = graphene.Field(LoanType)
     loan_revoked = graphene.Field(LoanType)
-    book_edited = graphene.Field(BookType)
-    book_removed = graphene.Field(BookType)
+    # events on one book if `book_id` is given, on the whole catalogue otherwise
+    book_edited = graphene.Field(BookType, book_id=graphene.Int())
+    book_removed = graphene.Field(BookType, book_id=graphene.Int())
 
     # FIXME: seems instance 'undefined' still pushed to client
 
+    @login_required
     def resolve_book_borrowed(root, info):
-        print('---- custom subscription: book_borrowed SUBSCRIBED  ----')
-
-        return root \
-            .filter(
-                lambda ev:
-                    ev.operation == BOOK_BORROWED and
-                    isinstance(ev.instance, Loan)
-        ) \
-            .tap(lambda ev: print('---- custom subscription: book_borrowed EVENT :', ev.operation, ev.instance)) \
+        logger.debug('book_borrowed subscribed')
+
+        stream = info.context.subscribe(user_group(info.context.user.pk))
+        return select_events(stream, (BOOK_BORROWED,), Loan) \
+            .tap(lambda ev: logger.debug('book_borrowed event: %s %r', ev.operation, ev.instance)) \
             .map(lambda event: event.instance)
 
+    @login_required
     def resolve_loan_revoked(root, info):
-        print('---- custom subscription: loan_revoked SUBSCRIBED  ----')
-
-        return root \
-            .filter(
-                lambda ev:
-                   ev.operation == LOAN_EXPIRED or
-                   ev.operation == LOAN_CANCELLED and
-                   isinstance(ev.instance, Loan)
-        ) \
-            .tap(lambda ev: print('---- custom subscription: loan_revoked EVENT :', ev.operation, ev.instance)) \
+        logger.debug('loan_revoked subscribed')
+
+        stream = info.context.subscribe(user_group(info.context.user.pk))
+        return select_events(stream, (LOAN_EXPIRED, LOAN_CANCELLED), Loan) \
+            .tap(lambda ev: logger.debug('loan_revoked event: %s %r', ev.operation, ev.instance)) \
             .map(lambda event: event.instance)
 
-    def resolve_book_edited(root, info):
-        print('---- model subscription: book_edited SUBSCRIBED  ----')
+    def resolve_book_edited(root, info, book_id=None):
+        logger.debug('book_edited subscribed')
 
-        return root.filter(
-            lambda ev: ev.operation == BOOK_EDITED and isinstance(ev.instance, Book)) \
-            .tap(lambda ev: print('---- custom subscription: book_edited EVENT :', ev.operation, ev.instance)) \
+        stream = info.context.subscribe(book_group(book_id) if book_id else CATALOGUE_GROUP)
+        return select_events(stream, (BOOK_EDITED,), Book) \
+            .tap(lambda ev: logger.debug('book_edited event: %s %r', ev.operation, ev.instance)) \
             .map(lambda ev: ev.instance)
 
-    def resolve_book_removed(root, info):
-        print('---- model subscription: book_removed SUBSCRIBED  ----')
+    def resolve_book_removed(root, info, book_id=None):
+        logger.debug('book_removed subscribed')
 
-        return root.filter(
-            lambda ev: ev.operation == BOOK_REMOVED and isinstance(ev.instance, Book)) \
-            .tap(lambda ev: print('---- custom subscription: book_removed EVENT :', ev.operation, ev.instance)) \
+        stream = info.context.subscribe(book_group(book_id) if book_id else CATALOGUE_GROUP)
+        return select_events(stream, (BOOK_REMOVED,), Book) \
+            .tap(lambda ev: logger.debug('book_removed event: %s %r', ev.operation, ev.instance)) \
             .map(lambda ev: ev.instance)
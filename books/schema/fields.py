@@ -1,58 +1,163 @@
 import graphene
+from graphene import relay
+from promise import Promise
 from django.shortcuts import get_object_or_404
 from graphene_django import DjangoObjectType
+from graphql import GraphQLError
 from graphql_jwt.decorators import login_required, superuser_required
 
 from books.settings import get_setting
-from books.models import Book, Loan
+from books.models import Book, Loan, PDFInfo, ShelfItem
+from books.schema.loaders import get_loader, load_related, load_many_related, LeasesLoader, ModelLoader
 from tess_core.schema.fields import MediumType
 
 
+def canonical_url(file):
+    return file.canonical_url if file else None
+
+
 class BookType(DjangoObjectType, MediumType):
 
     file_url = graphene.String()
     file_preview_url = graphene.String()
     cover_img_url = graphene.String()
     back_img_url = graphene.String()
+    toc = graphene.JSONString()
+    pdf_metadata = graphene.JSONString()
 
     class Meta:
         model = Book
         exclude = ('file', 'file_preview', 'cover_img', 'back_img')
 
+    # Nota: related objects below are batch loaded with sibling books
+    # (cf. `books.schema.loaders`), unless joined or prefetched already.
+    # Books from subscription events carry their URLs (cf. `Book.get_event_payload()`).
+
     @staticmethod
     def resolve_file_url(root, info, **kwargs):
-        return root.file.canonical_url if root.file else None
+        return BookType._resolve_url(root, info, 'file')
 
     @staticmethod
     def resolve_file_preview_url(root, info, **kwargs):
-        return root.file_preview.canonical_url if root.file_preview else None
+        return BookType._resolve_url(root, info, 'file_preview')
 
     @staticmethod
     def resolve_cover_img_url(root, info, **kwargs):
-        return root.get_img_url()
+        return BookType._resolve_url(root, info, 'cover_img')
 
     @staticmethod
     def resolve_back_img_url(root, info, **kwargs):
-        if root.back_img:
-            return root.back_img.canonical_url if root.back_img else None
+        return BookType._resolve_url(root, info, 'back_img')
+
+    @staticmethod
+    def _resolve_url(root, info, field_name):
+        url_name = f'{field_name}_url'
+        if hasattr(root, url_name):
+            return getattr(root, url_name)
+        return load_related(info.context, root, field_name).then(canonical_url)
+
+    # Nota: below read from the PDF introspected at upload (`PDFInfo`), if any.
+
+    @staticmethod
+    def resolve_page_count(root, info, **kwargs):
+        if hasattr(root, 'pdf_page_count'):
+            return root.pdf_page_count or root.page_count
+        return BookType._load_pdf_info(root, info) \
+            .then(lambda pdf_info: pdf_info.page_count if pdf_info else root.page_count)
+
+    @staticmethod
+    def resolve_toc(root, info, **kwargs):
+        return BookType._load_pdf_info(root, info) \
+            .then(lambda pdf_info: pdf_info.toc if pdf_info else None)
+
+    @staticmethod
+    def resolve_pdf_metadata(root, info, **kwargs):
+        return BookType._load_pdf_info(root, info) \
+            .then(lambda pdf_info: pdf_info.metadata if pdf_info else None)
+
+    @staticmethod
+    def _load_pdf_info(root, info):
+        if root.file_id is None:
+            return Promise.resolve(None)
+        return get_loader(info.context, ModelLoader, PDFInfo).load(root.file_id)
+
+    @staticmethod
+    def resolve_authors(root, info, **kwargs):
+        return load_many_related(info.context, root, 'authors')
+
+    @staticmethod
+    def resolve_topics(root, info, **kwargs):
+        return load_many_related(info.context, root, 'topics')
 
 
 class LoanType(DjangoObjectType):
 
     duration = graphene.Int()
     started = graphene.DateTime()
+    expires_at = graphene.DateTime()
     book = graphene.Field(BookType)
 
     class Meta:
         model = Loan
 
+    # Nota: loans annotated with `LoanQuerySet.with_lease_stats()`
+    # resolve the below without further queries, others batch load their leases.
+
     @staticmethod
     def resolve_duration(root, info, **kwargs):
-        return root.duration
+        if hasattr(root, 'active_duration'):
+            return root.duration
+        return LoanType._load_leases(root, info) \
+            .then(lambda leases: sum(lease.duration for lease in leases))
 
     @staticmethod
     def resolve_started(root, info, **kwargs):
-        return root.started
+        if hasattr(root, 'active_started'):
+            return root.started
+        return LoanType._load_leases(root, info) \
+            .then(lambda leases: min((lease.started for lease in leases), default=None))
+
+    @staticmethod
+    def resolve_expires_at(root, info, **kwargs):
+        if hasattr(root, 'active_expires_at'):
+            return root.expires_at
+        return LoanType._load_leases(root, info) \
+            .then(lambda leases: max((lease.expires_at for lease in leases), default=None))
+
+    @staticmethod
+    def resolve_book(root, info, **kwargs):
+        return load_related(info.context, root, 'book')
+
+    @staticmethod
+    def _load_leases(root, info):
+        return get_loader(info.context, LeasesLoader).load(root.pk)
+
+
+class ShelfItemType(DjangoObjectType):
+    """
+    Active loan, with the book details shown on the user's shelf, cf. `ShelfItem`.
+    """
+
+    loan_id = graphene.String()
+    book_id = graphene.Int()
+
+    class Meta:
+        model = ShelfItem
+        exclude = ('loan', 'book', 'user')
+
+    @staticmethod
+    def resolve_loan_id(root, info, **kwargs):
+        return str(root.loan_id)
+
+
+class BookConnection(relay.Connection):
+    class Meta:
+        node = BookType
+
+
+class LoanConnection(relay.Connection):
+    class Meta:
+        node = LoanType
 
 
 class CreateBookLoan(graphene.Mutation):
@@ -82,3 +187,57 @@ class CancelBookLoan(graphene.Mutation):
         loan.cancel()
         return CancelBookLoan(loan=loan)
 
+
+class BookLoanInput(graphene.InputObjectType):
+    book_id = graphene.Int(required=True)
+    duration = graphene.Int()
+
+
+class BookLoanResult(graphene.ObjectType):
+    """
+    Outcome of one item of a batch mutation: the loan, or why it failed.
+    """
+    loan = graphene.Field(LoanType)
+    error = graphene.String()
+
+
+def check_batch_size(items):
+    if len(items) > get_setting('BULK_MUTATION_MAX_ITEMS'):
+        raise GraphQLError('At most {} items per batch.'.format(get_setting('BULK_MUTATION_MAX_ITEMS')))
+
+
+class BorrowBooks(graphene.Mutation):
+    """
+    Borrow several books at once, eg. a term's reading list, cf. `Loan.borrow_books()`.
+    Results are in the order of `loans`.
+    """
+
+    results = graphene.List(BookLoanResult)
+
+    class Arguments:
+        loans = graphene.List(graphene.NonNull(BookLoanInput), required=True)
+
+    @superuser_required
+    def mutate(self, info, loans):
+        check_batch_size(loans)
+        items = [(item.book_id, item.get('duration', get_setting('LEASE_DURATION'))) for item in loans]
+        results = Loan.borrow_books(info.context.user, items)
+        return BorrowBooks(results=[BookLoanResult(loan=loan, error=error) for loan, error in results])
+
+
+class CancelBookLoans(graphene.Mutation):
+    """
+    Cancel several loans at once, cf. `Loan.cancel_loans()`.
+    Results are in the order of `loan_ids`.
+    """
+
+    results = graphene.List(BookLoanResult)
+
+    class Arguments:
+        loan_ids = graphene.List(graphene.NonNull(graphene.String), required=True)
+
+    @login_required
+    def mutate(self, info, loan_ids):
+        check_batch_size(loan_ids)
+        results = Loan.cancel_loans(info.context.user, loan_ids)
+        return CancelBookLoans(results=[BookLoanResult(loan=loan, error=error) for loan, error in results])
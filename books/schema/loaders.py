@@ -0,0 +1,120 @@
+"""
+Per-request DataLoaders (promise based) for the books schema.
+
+Sibling resolvers of a GraphQL request, eg. the book of every loan of a shelf,
+each ask their loader for one object; loaders then fetch all requested objects
+at once with a single `pk__in` query per relation, instead of one query each.
+Loaders live on the request context, so that nothing is cached across requests.
+Subscriptions keep their context for the whole subscription: their loaders are cleared
+on every event received (cf. `books.consumers.SubscriptionContext`).
+"""
+from collections import defaultdict
+
+from promise import Promise
+from promise.dataloader import DataLoader
+
+from books.models import Lease
+
+
+class ModelLoader(DataLoader):
+    """
+    Load `model` instances by primary key, None for missing ones.
+    eg. Book, Loan, or filer File and Image.
+    """
+
+    def __init__(self, model, *args, **kwargs):
+        self.model = model
+        super().__init__(*args, **kwargs)
+
+    def batch_load_fn(self, keys):
+        instances = self.model._base_manager.in_bulk(keys)
+        return Promise.resolve([instances.get(key) for key in keys])
+
+
+class ManyToManyLoader(DataLoader):
+    """
+    Load the objects related to `model` instances (by primary key)
+    through many-to-many field `field_name`, eg. a book's authors.
+    """
+
+    def __init__(self, model, field_name, *args, **kwargs):
+        self.through = getattr(model, field_name).through
+        self.source = model._meta.get_field(field_name).m2m_field_name()
+        self.target = model._meta.get_field(field_name).m2m_reverse_field_name()
+        super().__init__(*args, **kwargs)
+
+    def batch_load_fn(self, keys):
+        related = defaultdict(list)
+        rows = self.through.objects \
+            .filter(**{'%s__in' % self.source: keys}) \
+            .select_related(self.target)
+        for row in rows:
+            related[getattr(row, '%s_id' % self.source)].append(getattr(row, self.target))
+        return Promise.resolve([related[key] for key in keys])
+
+
+class LeasesLoader(DataLoader):
+    """
+    Load the active leases of loans, by loan id.
+    """
+
+    def batch_load_fn(self, keys):
+        leases = defaultdict(list)
+        for lease in Lease.objects.active().filter(loan__in=keys):
+            leases[lease.loan_id].append(lease)
+        return Promise.resolve([leases[key] for key in keys])
+
+
+def get_loader(context, loader_class, *args):
+    """
+    Loader of the current request (GraphQL context), created on first use.
+    :param loader_class: DataLoader subclass
+    :param args: loader arguments, eg. the model for `ModelLoader`.
+    """
+    loaders = getattr(context, 'books_loaders', None)
+    if loaders is None:
+        loaders = {}
+        setattr(context, 'books_loaders', loaders)
+
+    key = (loader_class,) + args
+    if key not in loaders:
+        loaders[key] = loader_class(*args)
+    return loaders[key]
+
+
+def clear_loaders(context):
+    """
+    Drop the loaders of `context`, and the objects they cached.
+    """
+    if getattr(context, 'books_loaders', None):
+        setattr(context, 'books_loaders', {})
+
+
+def load_related(context, instance, field_name):
+    """
+    Object related to `instance` through FK `field_name`:
+    the cached one if joined already (cf. `optimize_queryset()`), or else batch loaded.
+    :return: Promise
+    """
+    field = instance._meta.get_field(field_name)
+    if field.is_cached(instance):
+        return Promise.resolve(getattr(instance, field_name))
+
+    pk = getattr(instance, field.attname)
+    if pk is None:
+        return Promise.resolve(None)
+    return get_loader(context, ModelLoader, field.related_model).load(pk)
+
+
+def load_many_related(context, instance, field_name):
+    """
+    Objects related to `instance` through m2m field `field_name`:
+    the prefetched ones if any (cf. `optimize_queryset()`), or else batch loaded.
+    :return: Promise
+    """
+    prefetched = getattr(instance, '_prefetched_objects_cache', {})
+    if field_name in prefetched:
+        return Promise.resolve(list(prefetched[field_name]))
+
+    loader = get_loader(context, ManyToManyLoader, type(instance), field_name)
+    return loader.load(instance.pk)
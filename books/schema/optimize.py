@@ -0,0 +1,106 @@
+"""
+Query optimization driven by the GraphQL selection.
+
+Resolvers of the books schema read related objects (filer files, authors, topics, ...),
+which Django would otherwise lazy-load row by row (N+1 queries). Given the fields
+selected by the client, `optimize_queryset()` adds only the `select_related()`
+and `prefetch_related()` lookups that these fields actually need.
+"""
+from graphene.utils.str_converters import to_snake_case
+from graphql.language import ast
+
+
+# GraphQL field => related lookups read by its resolver,
+# ie. FKs to `select` (SQL join), and multi-valued relations to `prefetch` (one query each).
+# `nested` lookups apply to the sub-selection of a FK, relative to it.
+BOOK_LOOKUPS = {
+    'file_url': dict(select=['file']),
+    'file_preview_url': dict(select=['file_preview']),
+    'cover_img_url': dict(select=['cover_img']),
+    'back_img_url': dict(select=['back_img']),
+    'publisher': dict(select=['publisher']),
+    'language': dict(select=['language']),
+    'authors': dict(prefetch=['authors']),
+    'topics': dict(prefetch=['topics']),
+    'levels': dict(prefetch=['levels']),
+}
+
+LOAN_LOOKUPS = {
+    'book': dict(select=['book'], nested=BOOK_LOOKUPS),
+    'user': dict(select=['user']),
+}
+
+
+def optimize_queryset(queryset, info, lookups, path=()):
+    """
+    Join or prefetch the relations needed to resolve the fields selected under `info`.
+    :param queryset: queryset of the model resolved by `info`'s field.
+    :param info: graphene resolve info.
+    :param lookups: GraphQL field => related lookups map, eg. `BOOK_LOOKUPS`.
+    :param path: fields leading to the model's selection, eg. ('edges', 'node') for connections.
+    """
+    selections = get_selections(info)
+    for name in path:
+        selections = selections.get(name, {})
+
+    select, prefetch = get_related_lookups(selections, lookups)
+    if select:
+        queryset = queryset.select_related(*select)
+    if prefetch:
+        queryset = queryset.prefetch_related(*prefetch)
+    return queryset
+
+
+def optimize_queryset_fully(queryset, lookups):
+    """
+    Join or prefetch all the relations of `lookups`, whatever the selection,
+    eg. to cache results for any query (cf. `books.cache`).
+    """
+    select, prefetch = get_related_lookups({name: {} for name in lookups}, lookups)
+    return queryset.select_related(*select).prefetch_related(*prefetch)
+
+
+def get_related_lookups(selections, lookups, prefix=''):
+    """
+    Related lookups (select, prefetch) needed by the selected fields.
+    :param selections: selected fields tree, as returned by `get_selections()`.
+    :param prefix: path of the FK `selections` are nested under, eg. 'book__'.
+    """
+    select, prefetch = [], []
+    for name, sub_selections in selections.items():
+        lookup = lookups.get(name, {})
+        select += [prefix + related for related in lookup.get('select', [])]
+        prefetch += [prefix + related for related in lookup.get('prefetch', [])]
+        if 'nested' in lookup:
+            nested_prefix = '{}{}__'.format(prefix, lookup['select'][0])
+            nested_select, nested_prefetch = get_related_lookups(
+                sub_selections, lookup['nested'], nested_prefix)
+            select += nested_select
+            prefetch += nested_prefetch
+
+    return select, prefetch
+
+
+def get_selections(info):
+    """
+    Tree of fields selected under the field being resolved, with fragments expanded,
+    eg. {'title': {}, 'authors': {'first_name': {}}}. Field names are snake cased.
+    """
+    selections = {}
+    for field_ast in info.field_asts:
+        if field_ast.selection_set:
+            _collect_selections(info, field_ast.selection_set.selections, selections)
+    return selections
+
+
+def _collect_selections(info, nodes, selections):
+    for node in nodes:
+        if isinstance(node, ast.FragmentSpread):
+            fragment = info.fragments[node.name.value]
+            _collect_selections(info, fragment.selection_set.selections, selections)
+        elif isinstance(node, ast.InlineFragment):
+            _collect_selections(info, node.selection_set.selections, selections)
+        else:
+            sub_selections = selections.setdefault(to_snake_case(node.name.value), {})
+            if node.selection_set:
+                _collect_selections(info, node.selection_set.selections, sub_selections)
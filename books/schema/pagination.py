@@ -0,0 +1,97 @@
+"""
+Keyset (cursor) pagination for Relay connections.
+
+Pages are selected with a `WHERE (a, b) > (cursor_a, cursor_b)` like filter over a
+stable ordering, instead of OFFSET: each page costs the same no matter how deep
+the client browses, and only one page is ever loaded in memory.
+"""
+import base64
+import json
+from datetime import datetime
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from graphene import relay
+from graphql import GraphQLError
+
+from books.settings import get_setting
+
+
+def paginate(queryset, ordering, connection_type, first=None, after=None, last=None, before=None, **kwargs):
+    """
+    Build a page of `connection_type` from `queryset`, forward only.
+    :param ordering: fields to order by, with a unique one last, eg. ('-published', '-id').
+    :param first: page size, bounded by `BOOKS_PAGE_SIZE_MAX`.
+    :param after: cursor of the last node of the previous page.
+    """
+    if last is not None or before is not None:
+        raise GraphQLError('Backward pagination (`last`, `before`) is not supported.')
+    if first is not None and first < 0:
+        raise GraphQLError('Argument `first` must be a non-negative integer.')
+
+    page_size = min(get_setting('PAGE_SIZE') if first is None else first, get_setting('PAGE_SIZE_MAX'))
+    queryset = queryset.order_by(*ordering)
+    if after:
+        queryset = queryset.filter(keyset_filter(ordering, decode_cursor(after)))
+
+    nodes = list(queryset[:page_size + 1])
+    has_next_page = len(nodes) > page_size
+    edges = [
+        connection_type.Edge(node=node, cursor=encode_cursor(get_cursor_values(node, ordering)))
+        for node in nodes[:page_size]
+    ]
+
+    return connection_type(
+        edges=edges,
+        page_info=relay.PageInfo(
+            start_cursor=edges[0].cursor if edges else None,
+            end_cursor=edges[-1].cursor if edges else None,
+            has_previous_page=bool(after),
+            has_next_page=has_next_page,
+        )
+    )
+
+
+def get_page_bounds(first=None, offset=None):
+    """
+    Offset and size of a page selected by `first` and `offset` arguments,
+    the size being bounded by `BOOKS_PAGE_SIZE_MAX`.
+    :return: (offset, limit)
+    """
+    offset = offset or 0
+    if (first is not None and first < 0) or offset < 0:
+        raise GraphQLError('Arguments `first` and `offset` must be non-negative integers.')
+    return offset, min(get_setting('PAGE_SIZE') if first is None else first, get_setting('PAGE_SIZE_MAX'))
+
+
+def keyset_filter(ordering, values):
+    """
+    Lookup of the rows following `values` in `ordering`.
+    eg. for ('-published', '-id'): published < v0 OR (published = v0 AND id < v1)
+    """
+    query, equal = Q(), {}
+    for field, value in zip(ordering, values):
+        name = field.lstrip('-')
+        lookup = 'lt' if field.startswith('-') else 'gt'
+        query |= Q(**equal, **{'{}__{}'.format(name, lookup): value})
+        equal[name] = value
+    return query
+
+
+def get_cursor_values(node, ordering):
+    return [getattr(node, field.lstrip('-')) for field in ordering]
+
+
+def encode_cursor(values):
+    # datetimes in full (microseconds), unlike `DjangoJSONEncoder`, lest rows sharing a millisecond be skipped
+    values = [{'datetime': value.isoformat()} if isinstance(value, datetime) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(values, cls=DjangoJSONEncoder).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return [datetime.fromisoformat(value['datetime']) if isinstance(value, dict) else value
+                for value in values]
+    except (ValueError, TypeError, KeyError):
+        raise GraphQLError('Invalid cursor: {}'.format(cursor))
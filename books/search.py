@@ -0,0 +1,189 @@
+"""
+Full-text search over books: title, abstract, ISBN, authors and text of the PDF file.
+
+Books are indexed incrementally (cf. `books.signals`), into either:
+ - an SQLite FTS5 table, ranked with bm25, for the bundled SQLite database, or
+ - an inverted index (`BookSearchTerm` rows: term, book, weight) for any other database,
+   ranked by the sum of weights of the terms matched.
+Either way a search looks up its terms in an index, instead of scanning every book,
+all words of a query matching whole words, but the last one which matches as a prefix
+(eg. 'neural netw' finds 'Neural Networks').
+
+The FTS5 table is created by `migrate` (cf. `books.signals`), or by the `rebuild_search_index` command.
+"""
+import abc
+import re
+import unicodedata
+from collections import Counter
+
+from django.db import connection, connections, DEFAULT_DB_ALIAS
+
+from books.models import Book, BookSearchTerm
+from books.pdf import pdf_text
+from books.settings import get_setting
+
+# Relative weight of matches in each field
+FIELD_WEIGHTS = dict(title=10, isbn=10, authors=5, abstract=3, content=1)
+
+TERM_MAX_LENGTH = 64
+
+
+def tokenize(text):
+    """
+    Lower-cased, unaccented words of `text`, eg. 'Réseaux de neurones' => ['reseaux', 'de', 'neurones']
+    """
+    text = unicodedata.normalize('NFKD', text or '').encode('ascii', 'ignore').decode().lower()
+    return [word[:TERM_MAX_LENGTH] for word in re.findall(r'\w+', text)]
+
+
+def get_book_document(book, with_content=True):
+    """
+    Fields of `book` to index, content being the text of its PDF file.
+    """
+    return dict(
+        title=book.title,
+        isbn=book.isbn,
+        authors=' '.join(str(author) for author in book.authors.all()),
+        abstract=book.abstract,
+        content=pdf_text(book.file.path, get_setting('SEARCH_CONTENT_MAX_CHARS'))
+        if with_content and book.file else '',
+    )
+
+
+class SearchBackend(abc.ABC):
+
+    def setup(self, using=DEFAULT_DB_ALIAS):
+        """
+        Create the tables of this backend missing from database `using`, if any.
+        """
+
+    @abc.abstractmethod
+    def index(self, book_id, document):
+        """
+        (Re)index book `book_id`, given its `document` (cf. `get_book_document()`).
+        """
+
+    @abc.abstractmethod
+    def remove(self, book_id):
+        """
+        Remove book `book_id` from the index.
+        """
+
+    @abc.abstractmethod
+    def clear(self):
+        """
+        Remove all books from the index.
+        """
+
+    @abc.abstractmethod
+    def search(self, query, offset=0, limit=20):
+        """
+        Ids of published books matching all words of `query`, the last one as a prefix, best ranked first.
+        """
+
+
+class FTS5SearchBackend(SearchBackend):
+    """
+    SQLite FTS5 virtual table, whose rowid is the book id.
+    """
+    table = 'books_search'
+
+    def setup(self, using=DEFAULT_DB_ALIAS):
+        fields = ', '.join(FIELD_WEIGHTS)
+        with connections[using].cursor() as cursor:
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {self.table} "
+                f"USING fts5({fields}, tokenize='unicode61 remove_diacritics 2')"
+            )
+
+    def clear(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {self.table}")
+
+    def index(self, book_id, document):
+        fields = list(FIELD_WEIGHTS)
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {self.table} WHERE rowid = %s", [book_id])
+            cursor.execute(
+                "INSERT INTO {} (rowid, {}) VALUES (%s, {})".format(
+                    self.table, ', '.join(fields), ', '.join(['%s'] * len(fields))),
+                [book_id] + [document[field] for field in fields]
+            )
+
+    def remove(self, book_id):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {self.table} WHERE rowid = %s", [book_id])
+
+    def search(self, query, offset=0, limit=20):
+        terms = tokenize(query)
+        if not terms:
+            return []
+
+        # each word quoted (FTS5 syntax is not for end users), the last one as a prefix
+        match = ' '.join('"{}"'.format(term) for term in terms) + '*'
+        weights = ', '.join(str(weight) for weight in FIELD_WEIGHTS.values())
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT s.rowid FROM {self.table} s "
+                f"JOIN {Book._meta.db_table} b ON b.id = s.rowid "
+                f"WHERE {self.table} MATCH %s AND b.published IS NOT NULL "
+                f"ORDER BY bm25({self.table}, {weights}) LIMIT %s OFFSET %s",
+                [match, limit, offset]
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+
+class TermsSearchBackend(SearchBackend):
+    """
+    Inverted index in `BookSearchTerm`, portable to any database.
+    """
+
+    def index(self, book_id, document):
+        weights = Counter()
+        for field, weight in FIELD_WEIGHTS.items():
+            for term in tokenize(document[field]):
+                weights[term] += weight
+
+        BookSearchTerm.objects.filter(book_id=book_id).delete()
+        BookSearchTerm.objects.bulk_create(
+            [BookSearchTerm(book_id=book_id, term=term, weight=weight) for term, weight in weights.items()],
+            batch_size=get_setting('BULK_BATCH_SIZE')
+        )
+
+    def remove(self, book_id):
+        BookSearchTerm.objects.filter(book_id=book_id).delete()
+
+    def clear(self):
+        BookSearchTerm.objects.all().delete()
+
+    def search(self, query, offset=0, limit=20):
+        terms = tokenize(query)
+        if not terms:
+            return []
+
+        # as FTS5 queries (cf. `FTS5SearchBackend.search()`), the last word as a prefix
+        rows = BookSearchTerm.objects.filter(book__published__isnull=False).ranked(set(terms[:-1]), terms[-1])
+        return [row['book_id'] for row in rows[offset:offset + limit]]
+
+
+def get_search_backend(using=DEFAULT_DB_ALIAS):
+    """
+    Backend configured with `BOOKS_SEARCH_BACKEND` ('fts5' or 'terms'),
+    defaults to FTS5 on SQLite, and to the inverted index on other databases.
+    """
+    name = get_setting('SEARCH_BACKEND') or ('fts5' if connections[using].vendor == 'sqlite' else 'terms')
+    return FTS5SearchBackend() if name == 'fts5' else TermsSearchBackend()
+
+
+def index_book(book):
+    get_search_backend().index(book.pk, get_book_document(book))
+
+
+def search_books(query, offset=0, limit=20, queryset=None):
+    """
+    Published books matching `query`, best ranked first.
+    :param queryset: books to fetch matches from, eg. with related objects joined.
+    """
+    ids = get_search_backend().search(query, offset, limit)
+    books = (queryset if queryset is not None else Book.objects.all()).in_bulk(ids)
+    return [books[pk] for pk in ids if pk in books]
@@ -8,6 +8,30 @@ DEFAULT_PREVIEW_FOLDER = 'previews'
 DEFAULT_PREVIEW_PREFIX = 'preview'
 DEFAULT_TMP_DIR = '/tmp'
 DEFAULT_LEASE_DURATION = 7
+DEFAULT_BULK_BATCH_SIZE = 500
+DEFAULT_BULK_MUTATION_MAX_ITEMS = 1000
+DEFAULT_EXPIRY_MIN_INTERVAL = 10
+DEFAULT_EXPIRY_GRACE = 300
+DEFAULT_PREVIEW_CACHE_DIR = '/tmp/books-previews'
+DEFAULT_PREVIEW_CACHE_MAX_SIZE = 512 * 1024 * 1024
+DEFAULT_PREVIEW_CACHE_SCAN_INTERVAL = 3600
+DEFAULT_PREVIEW_LOCK_TIMEOUT = 600
+DEFAULT_PREVIEW_MAX_RETRIES = 3
+DEFAULT_PREVIEW_RETRY_DELAY = 60
+DEFAULT_PAGE_SIZE = 20
+DEFAULT_PAGE_SIZE_MAX = 100
+DEFAULT_SEARCH_BACKEND = None
+DEFAULT_EVENT_BATCH_SIZE = 200
+DEFAULT_CATALOGUE_CACHE_ALIAS = 'default'
+DEFAULT_CATALOGUE_CACHE_TIMEOUT = 300
+DEFAULT_SEARCH_CONTENT_MAX_CHARS = 200000
+DEFAULT_EXPIRY_RUN_INTERVAL = 60
+DEFAULT_TASK_RUN_WARN_RATIO = .8
+DEFAULT_TASK_RUN_HISTORY = 100
+DEFAULT_ARCHIVE_AFTER_DAYS = 90
+DEFAULT_ARCHIVE_BATCH_SIZE = 1000
+DEFAULT_ARCHIVE_MAX_BATCHES = 100
+DEFAULT_HISTORY_OFFSET_MAX = 1000
 
 
 def get_setting(name):
@@ -26,7 +50,33 @@ def get_setting(name):
         'PREVIEW_FOLDER': getattr(settings, 'BOOKS_PREVIEW_FOLDER', DEFAULT_PREVIEW_FOLDER),
         'PREVIEW_PREFIX': getattr(settings, 'BOOKS_PREVIEW_PREFIX', DEFAULT_PREVIEW_PREFIX),
         'TMP_DIR': getattr(settings, 'BOOKS_TMP_DIR', DEFAULT_TMP_DIR),
+        'PREVIEW_CACHE_DIR': getattr(settings, 'BOOKS_PREVIEW_CACHE_DIR', DEFAULT_PREVIEW_CACHE_DIR),
+        'PREVIEW_CACHE_MAX_SIZE': getattr(settings, 'BOOKS_PREVIEW_CACHE_MAX_SIZE', DEFAULT_PREVIEW_CACHE_MAX_SIZE),
+        'PREVIEW_CACHE_SCAN_INTERVAL': getattr(
+            settings, 'BOOKS_PREVIEW_CACHE_SCAN_INTERVAL', DEFAULT_PREVIEW_CACHE_SCAN_INTERVAL),
+        'PREVIEW_LOCK_TIMEOUT': getattr(settings, 'BOOKS_PREVIEW_LOCK_TIMEOUT', DEFAULT_PREVIEW_LOCK_TIMEOUT),
+        'PREVIEW_MAX_RETRIES': getattr(settings, 'BOOKS_PREVIEW_MAX_RETRIES', DEFAULT_PREVIEW_MAX_RETRIES),
+        'PREVIEW_RETRY_DELAY': getattr(settings, 'BOOKS_PREVIEW_RETRY_DELAY', DEFAULT_PREVIEW_RETRY_DELAY),
         'LEASE_DURATION': getattr(settings, 'BOOKS_LEASE_DURATION', DEFAULT_LEASE_DURATION),
+        'BULK_BATCH_SIZE': getattr(settings, 'BOOKS_BULK_BATCH_SIZE', DEFAULT_BULK_BATCH_SIZE),
+        'BULK_MUTATION_MAX_ITEMS': getattr(settings, 'BOOKS_BULK_MUTATION_MAX_ITEMS', DEFAULT_BULK_MUTATION_MAX_ITEMS),
+        'EXPIRY_MIN_INTERVAL': getattr(settings, 'BOOKS_EXPIRY_MIN_INTERVAL', DEFAULT_EXPIRY_MIN_INTERVAL),
+        'EXPIRY_GRACE': getattr(settings, 'BOOKS_EXPIRY_GRACE', DEFAULT_EXPIRY_GRACE),
+        'EXPIRY_RUN_INTERVAL': getattr(settings, 'BOOKS_EXPIRY_RUN_INTERVAL', DEFAULT_EXPIRY_RUN_INTERVAL),
+        'TASK_RUN_WARN_RATIO': getattr(settings, 'BOOKS_TASK_RUN_WARN_RATIO', DEFAULT_TASK_RUN_WARN_RATIO),
+        'TASK_RUN_HISTORY': getattr(settings, 'BOOKS_TASK_RUN_HISTORY', DEFAULT_TASK_RUN_HISTORY),
+        'ARCHIVE_AFTER_DAYS': getattr(settings, 'BOOKS_ARCHIVE_AFTER_DAYS', DEFAULT_ARCHIVE_AFTER_DAYS),
+        'ARCHIVE_BATCH_SIZE': getattr(settings, 'BOOKS_ARCHIVE_BATCH_SIZE', DEFAULT_ARCHIVE_BATCH_SIZE),
+        'ARCHIVE_MAX_BATCHES': getattr(settings, 'BOOKS_ARCHIVE_MAX_BATCHES', DEFAULT_ARCHIVE_MAX_BATCHES),
+        'HISTORY_OFFSET_MAX': getattr(settings, 'BOOKS_HISTORY_OFFSET_MAX', DEFAULT_HISTORY_OFFSET_MAX),
+        'PAGE_SIZE': getattr(settings, 'BOOKS_PAGE_SIZE', DEFAULT_PAGE_SIZE),
+        'PAGE_SIZE_MAX': getattr(settings, 'BOOKS_PAGE_SIZE_MAX', DEFAULT_PAGE_SIZE_MAX),
+        'CATALOGUE_CACHE_ALIAS': getattr(settings, 'BOOKS_CATALOGUE_CACHE_ALIAS', DEFAULT_CATALOGUE_CACHE_ALIAS),
+        'CATALOGUE_CACHE_TIMEOUT': getattr(settings, 'BOOKS_CATALOGUE_CACHE_TIMEOUT', DEFAULT_CATALOGUE_CACHE_TIMEOUT),
+        'EVENT_BATCH_SIZE': getattr(settings, 'BOOKS_EVENT_BATCH_SIZE', DEFAULT_EVENT_BATCH_SIZE),
+        'SEARCH_BACKEND': getattr(settings, 'BOOKS_SEARCH_BACKEND', DEFAULT_SEARCH_BACKEND),
+        'SEARCH_CONTENT_MAX_CHARS': getattr(
+            settings, 'BOOKS_SEARCH_CONTENT_MAX_CHARS', DEFAULT_SEARCH_CONTENT_MAX_CHARS),
         'SYNOPSIS_LEN': core_settings.SYNOPSIS_LEN
 
     }.get(name)
@@ -4,14 +4,36 @@ Signals defined here perform two things, further enhancing Book management:
 a) `*_subscription` handlers here triggers a subscription event when a book/loan changed.
     Using subscriptions with graphene-django thru channels and graphene-subscriptions.
     This is connecting signals for any models we want to create subscriptions for.
-b) `create_file_preview_callback` creates previews from books
+    Events are batched per transaction, cf. `books.events`.
+b) `create_file_preview_callback` queues the creation of previews from books
+c) `schedule_lease_expiry_callback` arms lease expiry for when new leases are due
+d) `extract_pdf_info_callback` introspects PDFs uploaded to filer
+e) `index_book_callback` and `unindex_book_callback` keep the full-text search index up to date,
+    whose tables `setup_search_callback` creates on migrate
+f) `*_subscription` handlers also invalidate the catalogue cache (`books.cache`),
+    alongside m2m changes (authors, topics, levels)
+g) `sync_shelf_book_callback` updates the book details copied to users' shelves (`ShelfItem`)
 
 """
+import logging
+
+from django.db import transaction
 from django.dispatch import receiver
-from django.db.models.signals import post_save, post_delete
-from graphene_subscriptions.events import ModelSubscriptionEvent
+from django.db.models.signals import post_save, post_delete, m2m_changed, post_migrate
+from filer.models import File
+
+from books import cache
+from books.events import publish, book_groups, PayloadEvent
+from books.models import Book, Lease, PDFInfo, ShelfItem, BOOK_EDITED, BOOK_REMOVED
+from books.search import get_search_backend
+from books.settings import get_setting
+from books.tasks import schedule_lease_expiry, queue_book_preview, queue_book_index, queue_pdf_info
+
+logger = logging.getLogger(__name__)
 
-from books.models import Book, BOOK_EDITED, BOOK_REMOVED
+# Book fields in the full-text search index, cf. `books.search.get_book_document()`
+SEARCH_INDEXED_FIELDS = {'title', 'abstract', 'isbn', 'file'}
+SHELF_FIELDS = {'title', 'cover_img'}
 
 
 # whether property x.y is in dict z
@@ -26,8 +48,8 @@ def book_edited_subscription(sender, instance, created, update_fields, **kwargs)
     """
     published, updated = updated_value(instance, 'published', update_fields)
     op = BOOK_REMOVED if updated and not published else BOOK_EDITED
-    event = ModelSubscriptionEvent(operation=op, instance=instance)
-    event.send()
+    publish(PayloadEvent(operation=op, instance=instance, changed=update_fields), book_groups(instance.pk))
+    cache.invalidate()
 
 
 @receiver(post_delete, sender=Book, dispatch_uid="book_post_delete")
@@ -36,18 +58,112 @@ def book_removed_subscription(sender, instance, **kwargs):
     Send subscription event to websocket,
     as given book has just been deleted.
     """
-    event = ModelSubscriptionEvent(operation=BOOK_REMOVED, instance=instance)
-    event.send()
+    publish(PayloadEvent(operation=BOOK_REMOVED, instance=instance), book_groups(instance.pk))
+    cache.invalidate()
 
 
 @receiver(post_save, sender=Book, dispatch_uid='book_create_preview')
 def create_book_preview_callback(sender, instance, created, update_fields, **kwargs):
     """
     Create `instance.file_preview` from `instance.file`,
-    if the user edited the preview page ranges,
+    if the user edited the preview page ranges.
+    Preview is created by a celery worker, outside of the admin request.
     """
     if instance.file:
         preview_pages, preview_pages_updated = updated_value(instance, 'preview_pages', update_fields)
         if created or not instance.file_preview or preview_pages_updated:
-            print(f'*** (re)creating book preview from pages {preview_pages} of {instance.page_count}')
-            instance.get_or_create_file_preview(preview_pages_updated)
+            logger.info(f'queuing book preview from pages {instance.preview_pages} of {instance.page_count}')
+            queue_book_preview(instance, preview_pages_updated)
+
+
+@receiver(post_save, sender=Lease, dispatch_uid='lease_schedule_expiry')
+def schedule_lease_expiry_callback(sender, instance, created, **kwargs):
+    """
+    Arm lease expiry for when the new lease is due (if sooner than the next run),
+    once the lease is committed.
+    """
+    if created:
+        transaction.on_commit(lambda: schedule_lease_expiry(instance.expires_at))
+
+
+@receiver(post_save, sender=File, dispatch_uid='filer_file_extract_pdf_info')
+def extract_pdf_info_callback(sender, instance, **kwargs):
+    """
+    Introspect PDF files (page count, toc, etc.) uploaded to filer, in the background.
+    Previews are skipped: only books' files are read from their introspection.
+    Nota: filer files are polymorphic, PDFs being saved as plain `File` (images as `Image`, etc.).
+    """
+    if instance.file and instance.extension.lower() == 'pdf':
+        if is_preview_file(instance):
+            return
+        if PDFInfo.objects.filter(file_id=instance.pk, sha1=instance.sha1).exists():
+            return
+        queue_pdf_info(instance.pk)
+
+
+def is_preview_file(file):
+    """
+    Whether filer `file` is a book preview, filed under `BOOKS_PREVIEW_FOLDER` when created.
+    """
+    folder = file.folder
+    return bool(folder and folder.name == get_setting('PREVIEW_FOLDER')) or \
+        Book.objects.filter(file_preview=file).exists()
+
+
+@receiver(post_save, sender=Book, dispatch_uid='book_index')
+def index_book_callback(sender, instance, update_fields, **kwargs):
+    """
+    (Re)index the book for full-text search in the background, once committed,
+    unless only fields not indexed were saved (eg. by preview creation).
+    """
+    if update_fields and not SEARCH_INDEXED_FIELDS.intersection(update_fields):
+        return
+    queue_book_index(instance.pk)
+
+
+@receiver(post_save, sender=Book, dispatch_uid='book_sync_shelf')
+def sync_shelf_book_callback(sender, instance, created, update_fields, **kwargs):
+    """
+    Copy the title and cover of the book to the shelf items of its active loans.
+    """
+    if created or (update_fields and not SHELF_FIELDS.intersection(update_fields)):
+        return
+    ShelfItem.objects.sync_book(instance)
+
+
+@receiver(m2m_changed, sender=Book.authors.through, dispatch_uid='book_authors_index')
+def index_book_authors_callback(sender, instance, action, **kwargs):
+    """
+    Reindex the book, and invalidate the catalogue cache, as its authors changed.
+    """
+    if isinstance(instance, Book) and action in ('post_add', 'post_remove', 'post_clear'):
+        queue_book_index(instance.pk)
+        cache.invalidate()
+
+
+@receiver(m2m_changed, sender=Book.topics.through, dispatch_uid='book_topics_cache')
+@receiver(m2m_changed, sender=Book.levels.through, dispatch_uid='book_levels_cache')
+def invalidate_book_relations_callback(sender, instance, action, **kwargs):
+    """
+    Invalidate the catalogue cache, as the topics or levels of a book changed.
+    """
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        cache.invalidate()
+
+
+@receiver(post_migrate, dispatch_uid='books_search_setup')
+def setup_search_callback(sender, using, **kwargs):
+    """
+    Create the tables of the full-text search backend once `books` is migrated (eg. FTS5's),
+    rather than on first use at request time.
+    """
+    if sender.name == 'books':
+        get_search_backend(using).setup(using)
+
+
+@receiver(post_delete, sender=Book, dispatch_uid='book_unindex')
+def unindex_book_callback(sender, instance, **kwargs):
+    """
+    Remove the deleted book from the full-text search index.
+    """
+    get_search_backend().remove(instance.pk)
@@ -1,26 +1,248 @@
+import logging
+import uuid
+from datetime import timedelta
+
 from celery.task import task
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.timezone import now
+
+from books.models import Book, Loan, Lease, PDFInfo, ArchivedLoan
+from books.pdf import PreviewPDFException
+from books.runs import track_run
+from books.search import index_book
+from books.settings import get_setting
+
+logger = logging.getLogger(__name__)
+
+# Next run of `revoke_expired_loans_task` armed by `schedule_lease_expiry()`.
+# Requires a cache shared by web and celery processes to deduplicate runs (cf. `CACHES` setting).
+EXPIRY_SCHEDULE_CACHE_KEY = 'books:lease_expiry:scheduled'
 
-from books.models import Loan
+# Lock deduplicating preview (re)creation per book and page range, while queued.
+PREVIEW_LOCK_CACHE_KEY = 'books:preview:{book_id}:{preview_pages}'
 
 
 @task()
-def revoke_expired_loans_task():
+def revoke_expired_loans_task(bulk=True, token=None):
     """
     Terminate expired all expired loans on system.
     This fires LOAN_EXPIRED signal with every terminated loan,
     which publishes a graphene subscription over websockets.
+
+    Next run is armed for when the next lease is due, unless this run is a stale one
+    (ie. superseded by an earlier run, armed since).
+
+    :param bulk: expire all loans at once with a few set-based queries (default),
+        or loan by loan, with several queries each.
+    :param token: identifies the run armed by `schedule_lease_expiry()`, if any.
+        None when run by celery beat, which also counts all active leases and loans (`with_totals`).
+    """
+
+    with track_run('revoke_expired_loans', interval=get_setting('EXPIRY_RUN_INTERVAL')) as run:
+        active = Loan.objects.active()
+        with_totals = token is None
+
+        if bulk:
+            counts = active.expire_ended(with_totals=with_totals)
+
+        else:
+            counts = dict(leases_due=0, leases_expired=0, loans_expired=0, events=0)
+            if with_totals:
+                counts.update(leases_active=0, loans_active=0)
+            for loan in active:
+                lease_counts = loan.expire_ended()
+                expired = loan.status == Loan.EXPIRED
+                counts['leases_due'] += lease_counts['expired']
+                counts['leases_expired'] += lease_counts['expired']
+                counts['loans_expired'] += expired
+                counts['events'] += expired
+                if with_totals:
+                    counts['leases_active'] += lease_counts['active']
+                    counts['loans_active'] += 1
+
+        run.count(**counts)
+        msg = "Expired {leases_expired}/{leases_due} leases due, on {loans_expired} loans"
+        if with_totals:
+            msg += " ({leases_active} leases active on {loans_active} loans)"
+        logger.info(msg.format(**counts))
+
+        with run.phase('schedule'):
+            scheduled = cache.get(EXPIRY_SCHEDULE_CACHE_KEY)
+            armed = token is not None and scheduled is not None and scheduled['token'] == token
+            if armed or token is None:
+                schedule_lease_expiry(force=armed)
+
+    return counts
+
+
+def schedule_lease_expiry(eta=None, force=False):
     """
+    Arm `revoke_expired_loans_task` to run when the next lease is due,
+    instead of polling for expired leases at regular intervals.
+    A no-op if a run is already armed at or before `eta`, and not overdue.
 
-    active = Loan.objects.active()
-    counts = dict(
-        leases_active=0, leases_expired=0,
-        loans_active=0, loans_expired=0,
-    )
+    :param eta: time the next lease is due, looked up (indexed) if not given.
+    :param force: arm a new run regardless of the one already armed.
+    :return: time the next run is armed for, if any.
+    """
+    eta = eta or Lease.objects.next_expiry()
+    if eta is None:
+        # nothing due: a run armed formerly must not hold back the next one (cf. `EXPIRY_GRACE`)
+        cache.delete(EXPIRY_SCHEDULE_CACHE_KEY)
+        return
+
+    scheduled = cache.get(EXPIRY_SCHEDULE_CACHE_KEY)
+    overdue = now() - timedelta(seconds=get_setting('EXPIRY_GRACE'))
+    if scheduled and not force and overdue < scheduled['eta'] <= eta:
+        return scheduled['eta']
+
+    eta = max(eta, now() + timedelta(seconds=get_setting('EXPIRY_MIN_INTERVAL')))
+    token = uuid.uuid4().hex
+    cache.set(EXPIRY_SCHEDULE_CACHE_KEY, dict(eta=eta, token=token), timeout=None)
+    try:
+        revoke_expired_loans_task.apply_async(kwargs=dict(token=token), eta=eta)
+    except Exception as e:
+        # beat's periodic run re-arms the schedule anyway
+        cache.delete(EXPIRY_SCHEDULE_CACHE_KEY)
+        logger.warning(f'could not schedule lease expiry at {eta}: {e}')
+        return
+
+    return eta
+
+
+@task(bind=True, max_retries=get_setting('PREVIEW_MAX_RETRIES'),
+      default_retry_delay=get_setting('PREVIEW_RETRY_DELAY'))
+def create_book_preview_task(self, book_id, preview_pages, force_create=False):
+    """
+    (Re)create the preview of a book in the background, cf. `queue_book_preview()`.
+    Retried on failure, after which the book's preview is marked as failed.
+    The preview status is always left terminal: ready, failed, or skipped (no file).
+    The lock taken by `queue_book_preview()` lives in the shared cache (cf. `CACHES` setting),
+    so that the worker releases it for web processes.
+    """
+    lock = get_preview_lock_key(book_id, preview_pages)
+    done = retrying = False
+    with track_run('create_book_preview') as run:
+        try:
+            book = Book.objects.filter(pk=book_id).select_related('file', 'file_preview').first()
+            status = Book.PREVIEW_SKIPPED
+            if book and book.file:
+                with run.phase('preview'):
+                    preview = book.get_or_create_file_preview(force_create)
+                run.count(previews=1)
+                # previews existing already (not forced) are kept, as ready
+                status = Book.PREVIEW_READY if preview else Book.PREVIEW_FAILED
+            Book.objects.filter(pk=book_id).update(preview_status=status)
+            done = True
+
+        except PreviewPDFException as e:
+            # nota: once out of retries, `retry()` re-raises `e` instead of `MaxRetriesExceededError`
+            if self.request.retries < self.max_retries:
+                retrying = True
+                raise self.retry(exc=e)
+            run.fail(e)
+            logger.error(f'book #{book_id} preview from pages {preview_pages} failed: {e.error}')
+
+        finally:
+            # whatever the error, unless retried: the preview is failed, and may be queued again
+            if not retrying:
+                if not done:
+                    Book.objects.filter(pk=book_id).update(preview_status=Book.PREVIEW_FAILED)
+                cache.delete(lock)
+
+
+def queue_book_preview(book, force_create=False):
+    """
+    Queue (re)creation of the preview of `book` once the current transaction commits,
+    unless already queued for the same page range. Marks the preview as pending meanwhile.
+    The lock is taken once committed, so that a rolled back save leaves none behind.
+    """
+    # not `save()`, which would fire `post_save` again
+    Book.objects.filter(pk=book.pk).update(preview_status=Book.PREVIEW_PENDING)
+    book.preview_status = Book.PREVIEW_PENDING
+    lock = get_preview_lock_key(book.pk, book.preview_pages)
+    args = (book.pk, book.preview_pages, force_create)
 
-    for loan in active:
-        lease_counts = loan.expire_ended()
-        counts['leases_active'] += lease_counts['active']
-        counts['leases_expired'] += lease_counts['expired']
+    def queue():
+        if not cache.add(lock, True, timeout=get_setting('PREVIEW_LOCK_TIMEOUT')):
+            return
+        try:
+            create_book_preview_task.delay(*args)
+        except Exception as e:
+            cache.delete(lock)
+            Book.objects.filter(pk=book.pk).update(preview_status=Book.PREVIEW_FAILED)
+            logger.warning(f'could not queue book #{book.pk} preview: {e}')
 
-    msg = "Expired {leases_expired}/{leases_active} leases on {loans_active}/{loans_expired} loans"
-    print("-- %s -- " % msg.format(**counts))
+    transaction.on_commit(queue)
+
+
+def get_preview_lock_key(book_id, preview_pages):
+    return PREVIEW_LOCK_CACHE_KEY.format(book_id=book_id, preview_pages=preview_pages.replace(' ', ''))
+
+
+def queue_pdf_info(file_id):
+    """
+    Queue introspection of PDF `file_id` once the current transaction commits.
+    A broker outage leaves the file without `PDFInfo` (read from the PDF itself meanwhile),
+    not the upload failed: the file is queued again when next saved.
+    """
+    def queue():
+        try:
+            extract_pdf_info_task.delay(file_id)
+        except Exception as e:
+            logger.warning(f'could not queue PDF #{file_id} introspection: {e}')
+
+    transaction.on_commit(queue)
+
+
+@task()
+def extract_pdf_info_task(file_id):
+    """
+    Introspect a PDF uploaded to filer, cf. `PDFInfo`.
+    """
+    from filer.models import File
+
+    file = File.objects.filter(pk=file_id).first()
+    if file:
+        PDFInfo.objects.extract(file)
+
+
+def queue_book_index(book_id):
+    """
+    Queue (re)indexing of book `book_id` for full-text search once the current transaction commits.
+    A broker outage leaves the index stale, not the save failed: `rebuild_search_index` catches up.
+    """
+    def queue():
+        try:
+            index_book_task.delay(book_id)
+        except Exception as e:
+            logger.warning(f'could not queue book #{book_id} indexing: {e}')
+
+    transaction.on_commit(queue)
+
+
+@task()
+def index_book_task(book_id):
+    """
+    (Re)index a book for full-text search, cf. `books.search`.
+    """
+    book = Book.objects.filter(pk=book_id).select_related('file').first()
+    if book:
+        index_book(book)
+
+
+@task()
+def archive_loans_task(days=None, max_batches=None):
+    """
+    Move loans ended more than `days` ago (`ARCHIVE_AFTER_DAYS`) to the archive tables,
+    in at most `max_batches` batches (`ARCHIVE_MAX_BATCHES`) per run, the rest being left to the next runs.
+    cf. `ArchivedLoanQuerySet.archive()`
+    """
+    days = days or get_setting('ARCHIVE_AFTER_DAYS')
+    with track_run('archive_loans') as run:
+        counts = ArchivedLoan.objects.archive(
+            now() - timedelta(days=days), max_batches=max_batches or get_setting('ARCHIVE_MAX_BATCHES'))
+        run.count(**counts)
+        logger.info("Archived {loans_archived} loans and {leases_archived} leases".format(**counts))
+    return counts
@@ -1,3 +1,620 @@
-from django.test import TestCase
+import json
+import threading
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock, skipIf
 
-# Create your tests here.
+import fitz
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache as django_cache
+from django.db import connection, connections, transaction, IntegrityError
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils.timezone import now
+from graphene_django.settings import graphene_settings
+from graphql import GraphQLError
+from graphql_jwt.shortcuts import get_token
+from graphene_subscriptions.events import SubscriptionEvent
+from rx.subjects import Subject
+
+from books import cache
+from books.cache import catalogue_cache
+from books.consumers import SubscriptionConsumer, SubscriptionContext
+from books.events import BATCH, PayloadEvent, publish
+from books.payloads import pack, unpack, dump_instance, load_instance
+from books.pdf import copy_pages, get_page_runs
+from books.schema.pagination import encode_cursor, decode_cursor
+from books.models import Book, Loan, Lease, ShelfItem, ArchivedLoan, ArchivedLease, BOOK_EDITED
+from books.search import FTS5SearchBackend, TermsSearchBackend
+from books.settings import get_setting
+from books.tasks import EXPIRY_SCHEDULE_CACHE_KEY, revoke_expired_loans_task, schedule_lease_expiry
+
+BORROWERS = 8
+
+
+def create_book():
+    # bulk_create(): no post_save signals queuing celery tasks (preview, search index)
+    book, = Book.objects.bulk_create([
+        Book(title='Promoted title', abstract='', isbn='978-0-00-000000-0', page_count=10, publication_date=2020)
+    ])
+    return Book.objects.get(pk=book.pk)
+
+
+class LoanTestMixin:
+    """
+    A reader and a book to borrow, lease expiry scheduling (celery) being mocked.
+    """
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch('books.signals.schedule_lease_expiry')
+        self.schedule_lease_expiry = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.user = get_user_model().objects.create_user(username='reader', password='reader')
+        self.book = create_book()
+
+
+class BorrowBookTest(LoanTestMixin, TestCase):
+
+    def test_borrow_creates_loan(self):
+        loan = Loan.borrow_book(self.user, self.book.pk, 7)
+        self.assertEqual(loan.status, Loan.ONGOING)
+        self.assertEqual(Lease.objects.filter(loan=loan).count(), 1)
+
+    def test_borrow_again_extends_loan(self):
+        loan = Loan.borrow_book(self.user, self.book.pk, 7)
+        self.assertEqual(Loan.borrow_book(self.user, self.book.pk, 3).pk, loan.pk)
+        self.assertEqual(Loan.objects.active().filter(user=self.user, book=self.book).count(), 1)
+        self.assertEqual(Lease.objects.filter(loan=loan).count(), 2)
+
+    def test_borrow_books(self):
+        loan = Loan.borrow_book(self.user, self.book.pk, 7)
+        other = create_book()
+        results = Loan.borrow_books(self.user, [(self.book.pk, 3), (other.pk, 7), (0, 7), (other.pk, 0)])
+
+        self.assertEqual([error is None for _, error in results], [True, True, False, False])
+        self.assertEqual(results[0][0].pk, loan.pk)
+        self.assertEqual(Loan.objects.active().filter(user=self.user).count(), 2)
+        self.assertEqual(Lease.objects.filter(loan__user=self.user).count(), 3)
+
+    def test_batch_queries(self):
+        """
+        Batches run as many queries, events included, whatever their size.
+        """
+        def count_queries(run):
+            # events payloads dumped right away, instead of on commit
+            with mock.patch('books.models.publish', side_effect=lambda event, groups: event.to_dict()), \
+                    CaptureQueriesContext(connection) as queries:
+                run()
+            return len(queries)
+
+        one, five = [create_book()], [create_book() for _ in range(5)]
+        borrowed = [count_queries(lambda: Loan.borrow_books(self.user, [(book.pk, 7) for book in books]))
+                    for books in (one, five)]
+        self.assertEqual(borrowed[0], borrowed[1])
+
+        loan_ids = [[str(loan.pk) for loan in Loan.objects.active().filter(book__in=books)] for books in (one, five)]
+        cancelled = [count_queries(lambda: Loan.cancel_loans(self.user, ids)) for ids in loan_ids]
+        self.assertEqual(cancelled[0], cancelled[1])
+
+    def test_cancel_loans(self):
+        loan = Loan.borrow_book(self.user, self.book.pk, 7)
+        results = Loan.cancel_loans(self.user, [str(loan.pk), 'not-a-uuid', str(loan.pk)])
+
+        self.assertEqual([error is None for _, error in results], [True, False, True])
+        loan.refresh_from_db()
+        self.assertEqual(loan.status, Loan.CANCELLED)
+        self.assertIsNotNone(loan.ended)
+        self.assertFalse(Lease.objects.active().filter(loan=loan).exists())
+
+    def test_cancel_revokes_leases(self):
+        loan = Loan.borrow_book(self.user, self.book.pk, 7)
+        Loan.borrow_book(self.user, self.book.pk, 3)
+        loan.cancel()
+
+        self.assertFalse(Lease.objects.active().filter(loan=loan).exists())
+        self.assertEqual(set(Lease.objects.filter(loan=loan).values_list('status', flat=True)), {Lease.CANCELLED})
+
+    def test_cancel_ended_loan(self):
+        """
+        Loans ended already are neither cancelled again, nor announced as such.
+        """
+        for status in (Loan.EXPIRED, Loan.CANCELLED):
+            ended = now() - timedelta(days=1)
+            loan = Loan.objects.create(user=self.user, book=create_book(), status=status, ended=ended)
+            with mock.patch('books.models.publish') as publish:
+                self.assertFalse(loan.cancel())
+
+            publish.assert_not_called()
+            loan.refresh_from_db()
+            self.assertEqual((loan.status, loan.ended), (status, ended))
+
+    def test_cancel_twice(self):
+        loan = Loan.borrow_book(self.user, self.book.pk, 7)
+        self.assertTrue(loan.cancel())
+        ended = Loan.objects.get(pk=loan.pk).ended
+        self.assertFalse(Loan.objects.get(pk=loan.pk).cancel())
+        self.assertEqual(Loan.objects.get(pk=loan.pk).ended, ended)
+
+    def test_ended_loans(self):
+        ongoing = Loan.objects.create(user=self.user, book=self.book)
+        expired = Loan.objects.create(user=self.user, book=self.book, status=Loan.EXPIRED)
+        cancelled = Loan.objects.create(user=self.user, book=self.book, status=Loan.CANCELLED)
+
+        self.assertEqual(set(Loan.objects.ended()), {expired, cancelled})
+        self.assertNotIn(ongoing, Loan.objects.ended())
+
+    def test_borrow_raced(self):
+        """
+        A borrow racing a concurrent one, which created the active loan once read missing,
+        extends that loan (cf. `BorrowBookConcurrencyTest`, on databases running it).
+        """
+        winner = Loan.objects.create(user=self.user, book=self.book)
+        # the active loan was read before the concurrent borrow committed it
+        with mock.patch('books.models.LoanQuerySet.first', return_value=None):
+            loan = Loan.borrow_book(self.user, self.book.pk, 7)
+
+        self.assertEqual(loan.pk, winner.pk)
+        self.assertEqual(Loan.objects.active().filter(user=self.user, book=self.book).count(), 1)
+        self.assertEqual(Lease.objects.filter(loan=winner).count(), 1)
+
+    def test_active_loan_unique(self):
+        Loan.objects.create(user=self.user, book=self.book)
+        Loan.objects.create(user=self.user, book=self.book, status=Loan.EXPIRED)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Loan.objects.create(user=self.user, book=self.book)
+
+
+class ExpiryTest(LoanTestMixin, TestCase):
+
+    def borrow(self, *timed_out):
+        """
+        Loan of a new book with a lease per `timed_out` flag, timed out or not.
+        """
+        loan = Loan.objects.create(user=self.user, book=create_book())
+        for flag in timed_out:
+            lease = Lease.objects.create(loan, 7)
+            if flag:
+                started = now() - timedelta(days=8)
+                Lease.objects.filter(pk=lease.pk).update(started=started, expires_at=started + timedelta(days=7))
+        return loan
+
+    def expire(self, bulk):
+        """
+        Status and active leases count of loans, once expired by `bulk` or per-loan path.
+        """
+        loans = [self.borrow(True), self.borrow(True, False), self.borrow(False), self.borrow()]
+        if bulk:
+            Loan.objects.active().expire_ended()
+        else:
+            for loan in Loan.objects.active():
+                loan.expire_ended()
+        results = [(Loan.objects.get(pk=loan.pk).status, Lease.objects.active().filter(loan=loan).count())
+                   for loan in loans]
+        # not expired by the next run
+        Loan.objects.filter(pk__in=[loan.pk for loan in loans]).delete()
+        return results
+
+    def test_bulk_and_per_loan_alike(self):
+        expected = [(Loan.EXPIRED, 0), (Loan.ONGOING, 1), (Loan.ONGOING, 1), (Loan.ONGOING, 0)]
+        self.assertEqual(self.expire(bulk=True), expected)
+        self.assertEqual(self.expire(bulk=False), expected)
+
+    def test_bulk_counts(self):
+        """
+        Counts of the bulk path, as reported by `revoke_expired_loans_task`.
+        """
+        self.borrow(True), self.borrow(True, False), self.borrow(False), self.borrow()
+        self.assertEqual(Loan.objects.active().expire_ended(with_totals=True), dict(
+            leases_active=4, leases_expired=2, loans_active=4, loans_expired=1, leases_due=2, events=1))
+
+    def test_bulk_counts_due_only(self):
+        """
+        Runs armed for a lease due scan only the leases due, counting no totals.
+        """
+        self.borrow(True), self.borrow(False)
+        with CaptureQueriesContext(connection) as queries:
+            counts = Loan.objects.active().expire_ended()
+        self.assertEqual(counts, dict(leases_due=1, leases_expired=1, loans_expired=1, events=1))
+        self.assertFalse([q for q in queries if 'COUNT(' in q['sql'].upper()])
+
+
+@override_settings(CACHES=dict(default=dict(BACKEND='django.core.cache.backends.locmem.LocMemCache',
+                                            LOCATION='expiry')))
+class ExpiryScheduleTest(LoanTestMixin, TestCase):
+    """
+    Runs of `revoke_expired_loans_task` armed for when leases are due, celery being mocked.
+    """
+
+    def setUp(self):
+        super().setUp()
+        django_cache.clear()
+        patcher = mock.patch.object(revoke_expired_loans_task, 'apply_async')
+        self.apply_async = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_armed_once(self):
+        eta = now() + timedelta(hours=1)
+        self.assertEqual(schedule_lease_expiry(eta), eta)
+        # a later lease is left to the run armed
+        self.assertEqual(schedule_lease_expiry(eta + timedelta(hours=1)), eta)
+        self.assertEqual(self.apply_async.call_count, 1)
+
+        token = self.apply_async.call_args[1]['kwargs']['token']
+        self.assertEqual(schedule_lease_expiry(eta, force=True), eta)
+        self.assertEqual(self.apply_async.call_count, 2)
+        self.assertNotEqual(self.apply_async.call_args[1]['kwargs']['token'], token)
+
+    def test_sooner_lease_armed(self):
+        eta = now() + timedelta(hours=1)
+        schedule_lease_expiry(eta)
+        self.assertEqual(schedule_lease_expiry(eta - timedelta(minutes=30)), eta - timedelta(minutes=30))
+        self.assertEqual(self.apply_async.call_count, 2)
+
+    def test_stale_run(self):
+        """
+        Runs superseded by another one armed since do not arm any run.
+        """
+        schedule_lease_expiry(now() + timedelta(hours=1))
+        scheduled = django_cache.get(EXPIRY_SCHEDULE_CACHE_KEY)
+        self.apply_async.reset_mock()
+
+        with mock.patch('books.tasks.schedule_lease_expiry') as schedule:
+            revoke_expired_loans_task(token='stale')
+        schedule.assert_not_called()
+        self.assertEqual(django_cache.get(EXPIRY_SCHEDULE_CACHE_KEY), scheduled)
+
+        with mock.patch('books.tasks.schedule_lease_expiry') as schedule:
+            revoke_expired_loans_task(token=scheduled['token'])
+        schedule.assert_called_once_with(force=True)
+
+    def test_nothing_due(self):
+        schedule_lease_expiry(now() + timedelta(hours=1))
+        self.assertIsNone(schedule_lease_expiry())
+        self.assertIsNone(django_cache.get(EXPIRY_SCHEDULE_CACHE_KEY))
+
+
+class ShelfTest(LoanTestMixin, TestCase):
+
+    def test_borrow_and_cancel(self):
+        loan = Loan.borrow_book(self.user, self.book.pk, 7)
+        Loan.borrow_book(self.user, self.book.pk, 3)
+        item = ShelfItem.objects.get(user=self.user)
+        self.assertEqual((item.loan_id, item.title, item.duration), (loan.pk, self.book.title, 10))
+
+        loan.cancel()
+        self.assertFalse(ShelfItem.objects.filter(user=self.user).exists())
+
+    def test_book_renamed(self):
+        Loan.borrow_book(self.user, self.book.pk, 7)
+        self.book.title = 'Renamed'
+        ShelfItem.objects.sync_book(self.book)
+        self.assertEqual(ShelfItem.objects.get(user=self.user).title, 'Renamed')
+
+    def test_rebuild(self):
+        Loan.borrow_book(self.user, self.book.pk, 7)
+        ShelfItem.objects.all().delete()
+        self.assertEqual(ShelfItem.objects.rebuild(), 1)
+
+
+class ArchiveTest(LoanTestMixin, TestCase):
+
+    def test_archive_ended(self):
+        old = Loan.borrow_book(self.user, self.book.pk, 7)
+        old.cancel()
+        Loan.objects.filter(pk=old.pk).update(ended=now() - timedelta(days=100))
+        recent = Loan.borrow_book(self.user, self.book.pk, 7)
+        recent.cancel()
+        active = Loan.borrow_book(self.user, self.book.pk, 7)
+
+        counts = ArchivedLoan.objects.archive(now() - timedelta(days=90), batch_size=1)
+        self.assertEqual(counts, dict(loans_archived=1, leases_archived=1))
+        self.assertEqual(set(Loan.objects.values_list('pk', flat=True)), {recent.pk, active.pk})
+        self.assertEqual(ArchivedLease.objects.get().loan_id, old.pk)
+        self.assertEqual(ArchivedLoan.objects.get(pk=old.pk).to_loan().status, Loan.CANCELLED)
+
+
+class PreviewPagesTest(SimpleTestCase):
+
+    def test_page_runs(self):
+        self.assertEqual(get_page_runs([1, 2, 3, 5, 7, 8]), [(1, 3), (5, 5), (7, 8)])
+        self.assertEqual(get_page_runs([]), [])
+
+    def test_copy_pages(self):
+        """
+        Pages are copied by runs, in order, and only them.
+        """
+        input, output = fitz.open(), fitz.open()
+        for p in range(1, 11):
+            input.newPage().insertText((72, 72), f'Page {p}')
+
+        copy_pages(input, output, [1, 2, 3, 5, 7, 8])
+        self.assertEqual([page.getText().strip() for page in output],
+                         [f'Page {p}' for p in (1, 2, 3, 5, 7, 8)])
+
+
+class CursorTest(SimpleTestCase):
+
+    def test_round_trip(self):
+        """
+        Cursors keep datetimes in full, lest rows sharing a millisecond be skipped.
+        """
+        values = [now().replace(microsecond=123456), 42]
+        self.assertEqual(decode_cursor(encode_cursor(values)), values)
+
+    def test_invalid(self):
+        with self.assertRaises(GraphQLError):
+            decode_cursor('not-a-cursor')
+
+
+@override_settings(
+    CACHES=dict(default=dict(BACKEND='django.core.cache.backends.locmem.LocMemCache'),
+                catalogue=dict(BACKEND='django.core.cache.backends.locmem.LocMemCache', LOCATION='catalogue')),
+    BOOKS_CATALOGUE_CACHE_ALIAS='catalogue',
+)
+class CatalogueCacheTest(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        catalogue_cache.cache.clear()
+
+    def publish_books(self, count):
+        books = [create_book() for _ in range(count)]
+        Book.objects.filter(pk__in=[book.pk for book in books]).update(published=now())
+        return books
+
+    def query_titles(self, query='{ books { title fileUrl pageCount } }'):
+        result = graphene_settings.SCHEMA.execute(query, context=SimpleNamespace())
+        self.assertIsNone(result.errors)
+        return [book['title'] for book in result.data['books']]
+
+    def count_queries(self, query):
+        with CaptureQueriesContext(connection) as queries:
+            self.query_titles(query)
+        return len(queries)
+
+    def test_hit_and_miss(self):
+        """
+        Misses run as many queries whatever the number of books, hits none.
+        """
+        self.publish_books(1)
+        one = self.count_queries('{ books(first: 1) { title fileUrl pageCount } }')
+        self.publish_books(4)
+        five = self.count_queries('{ books(first: 5) { title fileUrl pageCount } }')
+        self.assertEqual(one, five)
+
+        with self.assertNumQueries(0):
+            self.query_titles('{ books(first: 5) { title fileUrl pageCount } }')
+
+    def test_invalidation(self):
+        book, = self.publish_books(1)
+        self.assertEqual(self.query_titles(), ['Promoted title'])
+        Book.objects.filter(pk=book.pk).update(title='Renamed')
+        self.assertEqual(self.query_titles(), ['Promoted title'])
+
+        with mock.patch('books.cache.transaction.on_commit', side_effect=lambda callback: callback()):
+            cache.invalidate()
+        self.assertEqual(self.query_titles(), ['Renamed'])
+
+    @override_settings(BOOKS_CATALOGUE_CACHE_TIMEOUT=0)
+    def test_joins_selected_only(self):
+        """
+        Uncached, books are loaded with the relations their selection needs only.
+        """
+        self.publish_books(2)
+        with CaptureQueriesContext(connection) as queries:
+            self.query_titles('{ books { title } }')
+        self.assertFalse([query for query in queries if ' JOIN ' in query['sql']])
+
+    def test_unpaged_books(self):
+        """
+        `books` without `first` nor `offset` lists all published books, unlike its pages.
+        """
+        self.publish_books(get_setting('PAGE_SIZE') + 1)
+        self.assertEqual(len(self.query_titles()), get_setting('PAGE_SIZE') + 1)
+        self.assertEqual(len(self.query_titles('{ books(offset: 0) { title } }')), get_setting('PAGE_SIZE'))
+
+
+class SearchTest(TestCase):
+
+    def test_backends_match_alike(self):
+        """
+        Both backends match all words of a query, the last one as a prefix.
+        """
+        book = create_book()
+        Book.objects.filter(pk=book.pk).update(published=now())
+        document = dict(title='Neural Networks', isbn='', authors='', abstract='Deep learning', content='')
+        backends = [TermsSearchBackend()] + ([FTS5SearchBackend()] if connection.vendor == 'sqlite' else [])
+
+        for backend in backends:
+            backend.index(book.pk, document)
+            self.assertEqual(backend.search('neural netw'), [book.pk], type(backend).__name__)
+            self.assertEqual(backend.search('netw'), [book.pk], type(backend).__name__)
+            self.assertEqual(backend.search('neur networks'), [], type(backend).__name__)
+            self.assertEqual(backend.search('neural networks shallow'), [], type(backend).__name__)
+
+
+class PayloadTest(LoanTestMixin, TestCase):
+
+    def test_round_trip(self):
+        """
+        Loans loaded for events are dumped, packed and loaded back without queries.
+        """
+        Loan.borrow_book(self.user, self.book.pk, 7)
+        Loan.borrow_book(self.user, self.book.pk, 3)
+        loan = Loan.objects.active().for_events().get(user=self.user)
+
+        with self.assertNumQueries(0):
+            loaded = load_instance(unpack(pack(dump_instance(loan, changed=['status']))))
+            values = (loaded.pk, loaded.status, loaded.user_id, loaded.active_duration,
+                      loaded.book.title, loaded.book.cover_img_url, loaded.book.file_url)
+
+        self.assertEqual(values, (loan.pk, Loan.ONGOING, self.user.pk, 10,
+                                  self.book.title, self.book.cover_img.canonical_url, None))
+        self.assertEqual(loaded.active_started, loan.active_started)
+
+    def test_prefetched_round_trip(self):
+        """
+        Relations loaded as prefetched behave as Django's, queried anew once filtered.
+        """
+        author = Book._meta.get_field('authors').related_model.objects.create(first_name='Gilbert', last_name='Strang')
+        self.book.authors.add(author)
+        packed = pack(dump_instance(Book.objects.prefetch_related('authors').get(pk=self.book.pk)))
+
+        with self.assertNumQueries(0):
+            loaded = load_instance(unpack(packed))
+            self.assertEqual([a.last_name for a in loaded.authors.all()], ['Strang'])
+            self.assertEqual(loaded.authors.count(), 1)
+        self.assertEqual(list(loaded.authors.filter(last_name='Strang')), [author])
+
+
+class SubscriptionTest(LoanTestMixin, TestCase):
+
+    def test_loaders_per_event(self):
+        """
+        Subscriptions resolve every event with fresh loaders, not with the objects of previous events.
+        """
+        author = Book._meta.get_field('authors').related_model.objects.create(first_name='Gilbert', last_name='Strang')
+        self.book.authors.add(author)
+        stream = Subject()
+        consumer = mock.Mock(scope=dict(user=self.user), join=mock.Mock(return_value=stream))
+        result = graphene_settings.SCHEMA.execute(
+            'subscription ($bookId: Int) { bookEdited(bookId: $bookId) { authors { lastName } } }',
+            variables=dict(bookId=self.book.pk), context=SubscriptionContext(consumer), allow_subscriptions=True,
+        )
+        names = []
+        result.subscribe(lambda event: names.append([a['lastName'] for a in event.data['bookEdited']['authors']]))
+
+        stream.on_next(PayloadEvent(operation=BOOK_EDITED, instance=Book.objects.get(pk=self.book.pk)))
+        author.last_name = 'Renamed'
+        author.save()
+        stream.on_next(PayloadEvent(operation=BOOK_EDITED, instance=Book.objects.get(pk=self.book.pk)))
+        self.assertEqual(names, [['Strang'], ['Renamed']])
+
+    def connection_init(self, token):
+        consumer = SubscriptionConsumer(dict(type='websocket'))
+        consumer.send = mock.Mock()
+        consumer.websocket_connect({})
+        consumer.send.reset_mock()
+        consumer.websocket_receive(dict(text=json.dumps(dict(type='connection_init', payload=dict(authToken=token)))))
+        return consumer, [args[0] for args, _ in consumer.send.call_args_list]
+
+    def test_connection_authenticated(self):
+        consumer, messages = self.connection_init(get_token(self.user))
+        self.assertEqual(consumer.scope['user'], self.user)
+        self.assertEqual(json.loads(messages[0]['text'])['type'], 'connection_ack')
+
+    def test_connection_of_deleted_user(self):
+        """
+        A valid token of a user deleted since is refused, as invalid tokens are.
+        """
+        token = get_token(self.user)
+        self.user.delete()
+        consumer, messages = self.connection_init(token)
+
+        self.assertEqual(json.loads(messages[0]['text'])['type'], 'connection_error')
+        self.assertEqual(messages[1], {'type': 'websocket.close', 'code': 4401})
+        self.assertIsInstance(consumer.scope['user'], AnonymousUser)
+
+
+class EventBatchTest(TransactionTestCase):
+    """
+    Events published in transactions, as sent over the channel layer (mocked).
+    """
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch('books.events.send_messages')
+        self.send_messages = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def sent(self):
+        """
+        Operations of the events received by each group, message by message.
+        """
+        sent = {}
+        for (messages,), _ in self.send_messages.call_args_list:
+            for group, message in messages:
+                event = message['event']
+                events = event['instance'] if event['operation'] == BATCH else [event]
+                sent.setdefault(group, []).append([ev['operation'] for ev in events])
+        return sent
+
+    def test_batched_per_group(self):
+        with transaction.atomic():
+            for operation in ('a', 'b', 'c'):
+                publish(SubscriptionEvent(operation=operation), ['first', 'second'])
+            publish(SubscriptionEvent(operation='d'), ['second'])
+            self.send_messages.assert_not_called()
+
+        self.assertEqual(self.send_messages.call_count, 1)
+        self.assertEqual(self.sent(), dict(first=[['a', 'b', 'c']], second=[['a', 'b', 'c', 'd']]))
+
+    @override_settings(BOOKS_EVENT_BATCH_SIZE=2)
+    def test_batch_size(self):
+        with transaction.atomic():
+            for operation in ('a', 'b', 'c'):
+                publish(SubscriptionEvent(operation=operation), ['first'])
+        self.assertEqual(self.sent(), dict(first=[['a', 'b'], ['c']]))
+
+    def test_savepoint_rolled_back(self):
+        with transaction.atomic():
+            publish(SubscriptionEvent(operation='a'), ['first'])
+            try:
+                with transaction.atomic():
+                    publish(SubscriptionEvent(operation='b'), ['first', 'second'])
+                    raise IntegrityError
+            except IntegrityError:
+                pass
+            publish(SubscriptionEvent(operation='c'), ['first'])
+
+        self.assertEqual(self.sent(), dict(first=[['a', 'c']]))
+
+    def test_rolled_back(self):
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            publish(SubscriptionEvent(operation='a'), ['first'])
+            raise IntegrityError
+        self.send_messages.assert_not_called()
+
+        # the batch rolled back is not reused by the next transaction
+        with transaction.atomic():
+            publish(SubscriptionEvent(operation='b'), ['first'])
+        self.assertEqual(self.sent(), dict(first=[['b']]))
+
+    def test_outside_transaction(self):
+        publish(SubscriptionEvent(operation='a'), ['first', 'second'])
+        self.assertEqual(self.sent(), dict(first=[['a']], second=[['a']]))
+
+
+# run on PostgreSQL with `--settings=welearn.settings_postgres`
+@skipIf(connection.vendor == 'sqlite', 'SQLite serializes writes, and shares in-memory test databases poorly')
+class BorrowBookConcurrencyTest(LoanTestMixin, TransactionTestCase):
+
+    def test_concurrent_borrows(self):
+        """
+        Borrows of the same book by the same user, all at once, end up in a single active loan.
+        """
+        barrier = threading.Barrier(BORROWERS)
+        errors = []
+
+        def borrow():
+            try:
+                barrier.wait()
+                Loan.borrow_book(self.user, self.book.pk, 7)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=borrow) for _ in range(BORROWERS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        loans = Loan.objects.active().filter(user=self.user, book=self.book)
+        self.assertEqual(loans.count(), 1)
+        self.assertEqual(Lease.objects.filter(loan__in=loans).count(), BORROWERS)
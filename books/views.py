@@ -1,3 +1,12 @@
-from django.shortcuts import render
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import JsonResponse
 
-# Create your views here.
+from books.cache import catalogue_cache
+
+
+@staff_member_required
+def catalogue_cache_stats(request):
+    """
+    Hit rate of the catalogue cache, counted by the process serving this request.
+    """
+    return JsonResponse(dict(catalogue_cache.get_stats(), version=catalogue_cache.get_version()))
@@ -19,9 +19,17 @@ app = Celery('welearn',
 # Optional configuration, see the application user guide.
 app.conf.update(
     beat_schedule={
+        # Leases are expired when due, by runs armed by `books.tasks.schedule_lease_expiry()`.
+        # This is a safety net, expiring leases anyway and re-arming the schedule in case it was lost
+        # (eg. broker or cache flushed): its runs only scan the leases due.
         'revoke-expired-loans': {
             'task': 'books.tasks.revoke_expired_loans_task',
-            'schedule': timedelta(minutes=1),
+            'schedule': timedelta(hours=1),
+        },
+        # Loans ended long ago are moved to archive tables, cf. `books.tasks.archive_loans_task`.
+        'archive-loans': {
+            'task': 'books.tasks.archive_loans_task',
+            'schedule': timedelta(hours=6),
         },
         'collect-vouchers': {
             'task': 'tess_pay.tasks.collect_vouchers_task'
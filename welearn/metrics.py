@@ -0,0 +1,212 @@
+"""
+Instrumentation of the GraphQL endpoint: wall time and SQL queries of resolvers, by field.
+
+a) `ResolverMetricsMiddleware` (graphene middleware) times resolvers, and attributes the SQL queries
+   they run to their field (eg. `LoanType.duration`). Lazy querysets returned by resolvers are
+   evaluated within their resolver, so as to count their queries. Queries run by data loaders
+   (batched, cf. `books.schema.loaders`) are counted apart, as `(dataloader)`.
+b) `track_request()` counts the queries of a whole request by field (cf. `welearn.views.GraphQLView`),
+   and flags N+1 patterns: fields running more than `GRAPHQL_N_PLUS_ONE_THRESHOLD` queries in a request.
+c) `metrics()` exposes aggregated histograms in the Prometheus text format, at `metrics/`,
+   alongside the last runs of background tasks (cf. `books.runs`).
+
+Metrics are aggregated per process.
+"""
+import logging
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict, Counter
+from contextlib import contextmanager
+from functools import partial
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import QuerySet
+from django.http import HttpResponse, HttpResponseForbidden
+from graphene.types.resolver import dict_or_attr_resolver
+from promise import is_thenable, Promise
+
+from books import runs
+from books.cache import catalogue_cache
+
+BATCHED = '(dataloader)'
+
+SECONDS_BUCKETS = (.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5)
+QUERIES_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class Histogram:
+    """
+    Prometheus-style histogram, by label value.
+    """
+
+    def __init__(self, name, help, label, buckets):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        self.counts = defaultdict(lambda: [0] * (len(buckets) + 1))
+        self.sums = defaultdict(float)
+
+    def observe(self, label, value):
+        self.counts[label][bisect_left(self.buckets, value)] += 1
+        self.sums[label] += value
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for label, counts in sorted(self.counts.items()):
+            cumulative = 0
+            for bucket, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{self.label}="{label}",le="{bucket}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{self.label}="{label}"}} {self.sums[label]}')
+            lines.append(f'{self.name}_count{{{self.label}="{label}"}} {cumulative}')
+        return lines
+
+
+class ResolverMetrics:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.seconds = Histogram(
+            'graphql_resolver_seconds', 'Wall time of GraphQL resolvers, by field.', 'field', SECONDS_BUCKETS)
+        self.queries = Histogram(
+            'graphql_resolver_queries', 'SQL queries run by GraphQL resolvers, by field.', 'field', QUERIES_BUCKETS)
+        self.request_queries = Histogram(
+            'graphql_request_field_queries', 'SQL queries run by a field in a GraphQL request.', 'field',
+            QUERIES_BUCKETS)
+        self.n_plus_one = Counter()
+
+    def observe(self, field, seconds, queries):
+        with self.lock:
+            if seconds is not None:
+                self.seconds.observe(field, seconds)
+            if queries is not None:
+                self.queries.observe(field, queries)
+
+    def observe_request(self, queries):
+        """
+        :param queries: SQL queries run by field in a request.
+        """
+        threshold = getattr(settings, 'GRAPHQL_N_PLUS_ONE_THRESHOLD', 10)
+        with self.lock:
+            for field, count in queries.items():
+                self.request_queries.observe(field, count)
+                if count > threshold:
+                    self.n_plus_one[field] += 1
+                    logger.warning(f'N+1 queries? {field} ran {count} SQL queries in one request')
+
+    def expose(self):
+        with self.lock:
+            lines = self.seconds.expose() + self.queries.expose() + self.request_queries.expose()
+            lines += [
+                '# HELP graphql_n_plus_one_total Requests in which a field ran more queries than the threshold.',
+                '# TYPE graphql_n_plus_one_total counter',
+            ]
+            lines += [f'graphql_n_plus_one_total{{field="{field}"}} {count}'
+                      for field, count in sorted(self.n_plus_one.items())]
+        return lines
+
+
+resolver_metrics = ResolverMetrics()
+
+
+class QueryCounter:
+    """
+    Database execute wrapper counting queries by the field being resolved.
+    """
+
+    def __init__(self):
+        self.field = None
+        self.queries = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        self.queries[self.field or BATCHED] += 1
+        return execute(sql, params, many, context)
+
+
+@contextmanager
+def track_request():
+    """
+    Count the SQL queries run by each field, while resolving a GraphQL request.
+    """
+    counter = QueryCounter()
+    _local.counter = counter
+    try:
+        with connection.execute_wrapper(counter):
+            yield counter
+    finally:
+        _local.counter = None
+        resolver_metrics.observe_request(counter.queries)
+
+
+class ResolverMetricsMiddleware:
+    """
+    Resolvers of every field are timed, but for those resolved by graphene's default resolver
+    (ie. attributes read), only recorded if they ran SQL queries (eg. FKs lazy loaded).
+    """
+
+    def __init__(self):
+        self.default_resolved = {}
+
+    def resolve(self, next, root, info, **args):
+        field = f'{info.parent_type.name}.{info.field_name}'
+        counter = getattr(_local, 'counter', None)
+        queries = previous = None
+        if counter is not None:
+            previous, counter.field = counter.field, field
+            queries = counter.queries[field]
+
+        started = time.perf_counter()
+        try:
+            result = next(root, info, **args)
+            if isinstance(result, QuerySet):
+                result._fetch_all()
+        finally:
+            if counter is not None:
+                counter.field = previous
+                queries = counter.queries[field] - queries
+
+        if is_thenable(result):
+            return Promise.resolve(result).then(partial(self._record_promise, field, started, queries))
+
+        seconds = time.perf_counter() - started
+        if not self._is_default_resolved(info) or queries:
+            resolver_metrics.observe(field, seconds, queries)
+        return result
+
+    def _record_promise(self, field, started, queries, value):
+        resolver_metrics.observe(field, time.perf_counter() - started, queries)
+        return value
+
+    def _is_default_resolved(self, info):
+        key = (info.parent_type.name, info.field_name)
+        if key not in self.default_resolved:
+            resolver = info.parent_type.fields[info.field_name].resolver
+            self.default_resolved[key] = resolver is None or \
+                getattr(resolver, 'func', resolver) is dict_or_attr_resolver
+        return self.default_resolved[key]
+
+
+def metrics(request):
+    """
+    Prometheus scrape endpoint, allowed from `METRICS_ALLOWED_IPS` (none by default) and to staff users.
+    Nota: behind a reverse proxy, `REMOTE_ADDR` is the proxy's: its address must not be listed.
+    """
+    allowed_ips = getattr(settings, 'METRICS_ALLOWED_IPS', [])
+    if request.META.get('REMOTE_ADDR') not in allowed_ips and not request.user.is_staff:
+        return HttpResponseForbidden()
+
+    lines = resolver_metrics.expose()
+    stats = catalogue_cache.get_stats()
+    for name in ('hits', 'misses', 'invalidations'):
+        lines += [f'# TYPE books_catalogue_cache_{name}_total counter',
+                  f'books_catalogue_cache_{name}_total {stats[name]}']
+    lines += runs.expose()
+
+    return HttpResponse('\n'.join(lines) + '\n', content_type='text/plain; version=0.0.4')
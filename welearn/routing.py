@@ -3,7 +3,7 @@ from channels.auth import AuthMiddlewareStack
 from django.conf.urls import url
 from django.urls import path
 
-from graphene_subscriptions.consumers import GraphqlSubscriptionConsumer
+from books.consumers import SubscriptionConsumer
 
 
 application = ProtocolTypeRouter({
@@ -11,7 +11,7 @@ application = ProtocolTypeRouter({
     "websocket": AuthMiddlewareStack(
         URLRouter([
             # identical to path expected by graphene in urls.py
-            path('graphql/', GraphqlSubscriptionConsumer)
+            path('graphql/', SubscriptionConsumer)
         ])
     ),
 })
@@ -78,25 +78,81 @@ GRAPHENE = {
     'SCHEMA': 'welearn.schema.schema',
     'MIDDLEWARE': [
         'graphql_jwt.middleware.JSONWebTokenMiddleware',
+        'welearn.metrics.ResolverMetricsMiddleware',
     ],
 }
 
+# Cache shared by web and celery processes, as required by the lease expiry schedule and preview locks
+# (cf. `books.tasks`), and persisted queries. Django's default (local memory) is per process.
+# Database table by default, to be created with `python manage.py createcachetable`.
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('WELEARN_CACHE_BACKEND', 'django.core.cache.backends.db.DatabaseCache'),
+        'LOCATION': os.environ.get('WELEARN_CACHE_LOCATION', 'welearn_cache'),
+    },
+}
+
+# GraphQL endpoint, cf. `welearn.views`:
+# cache storing automatic persisted queries (shared by all processes), for how long (None: forever),
+# and count of parsed and validated documents kept per process.
+GRAPHQL_PERSISTED_QUERIES_CACHE = 'default'
+GRAPHQL_PERSISTED_QUERIES_TIMEOUT = None
+GRAPHQL_DOCUMENT_CACHE_SIZE = 500
+
+# Resolver metrics, cf. `welearn.metrics`: queries run by a field in a request flagged as N+1 beyond,
+# and clients allowed to scrape `metrics/` (besides staff users), by `REMOTE_ADDR`.
+# Never list the address of a reverse proxy (eg. 127.0.0.1 for one on the same host):
+# all requests it forwards would be allowed.
+GRAPHQL_N_PLUS_ONE_THRESHOLD = 10
+METRICS_ALLOWED_IPS = []
+
 # Configure Graphene support for graphql-ws on django-channels
 # https://github.com/graphql-python/graphql-ws
 # pip install channels graphene-subscriptions
 # pip install -U channels_redis
 ASGI_APPLICATION = 'welearn.routing.application'
 CHANNELS_WS_PROTOCOLS = ["graphql-ws", ]
-CHANNEL_LAYERS = {
-    # "default": {
-    #     "BACKEND": "channels_redis.tess_core.RedisChannelLayer",
-    #     "CONFIG": {
-    #         "hosts": [("127.0.0.1", 6379)],
-    #     },
-    # },
-    "default": {
+
+# Channel layer profile, from the environment, eg. WELEARN_CHANNEL_LAYER=redis
+# `memory`: single ASGI process only, events sent by other processes (eg. celery workers) are lost.
+# `redis`: several ASGI processes, and celery workers publishing events (cf. `books.events`).
+#   Connections are pooled by channels_redis (per event loop, cf. `books.events.send_messages()`).
+#   `capacity`: messages queued per channel (ie. websocket client) before `ChannelFull`,
+#       batched events making a burst a few messages only.
+#   `expiry`: seconds an undelivered message lives (eg. client gone).
+#   `group_expiry`: seconds a client stays in a group without re-joining, a safety net for
+#       clients dropped without `websocket.disconnect`. Must outlive websocket connections.
+CHANNEL_LAYER = os.environ.get('WELEARN_CHANNEL_LAYER', 'memory')
+REDIS_URL = os.environ.get('WELEARN_REDIS_URL', 'redis://127.0.0.1:6379/0')
+CHANNEL_LAYER_PROFILES = {
+    'memory': {
         "BACKEND": "channels.layers.InMemoryChannelLayer"
     },
+    'redis': {
+        "BACKEND": "channels_redis.core.RedisChannelLayer",
+        "CONFIG": {
+            "hosts": [REDIS_URL],
+            "prefix": "welearn",
+            "capacity": 1000,
+            "expiry": 30,
+            "group_expiry": 24 * 60 * 60,
+        },
+    },
+}
+CHANNEL_LAYERS = {
+    "default": CHANNEL_LAYER_PROFILES[CHANNEL_LAYER],
+}
+
+# Logging of background tasks (cf. `books.runs`): timings, counters and failures of runs.
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'books': {'handlers': ['console'], 'level': os.environ.get('WELEARN_BOOKS_LOG_LEVEL', 'INFO')},
+    },
 }
 
 # TESS CORE
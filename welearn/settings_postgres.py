@@ -0,0 +1,18 @@
+"""
+Settings on PostgreSQL, eg. to run the tests SQLite can't (concurrent borrows):
+
+    pip install -r requirements/postgres.txt
+    python manage.py test books --settings=welearn.settings_postgres
+"""
+from .settings import *
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': os.environ.get('WELEARN_DB_NAME', 'welearn'),
+        'USER': os.environ.get('WELEARN_DB_USER', 'welearn'),
+        'PASSWORD': os.environ.get('WELEARN_DB_PASSWORD', ''),
+        'HOST': os.environ.get('WELEARN_DB_HOST', 'localhost'),
+        'PORT': os.environ.get('WELEARN_DB_PORT', '5432'),
+    }
+}
@@ -0,0 +1,67 @@
+import hashlib
+import json
+from collections import Counter
+
+from django.core.cache import caches
+from django.test import SimpleTestCase, override_settings
+from graphql.error import GraphQLError
+
+from welearn.metrics import ResolverMetrics
+from welearn.views import GraphQLView
+
+QUERY = '{ books { title } }'
+
+
+class ResolverMetricsTest(SimpleTestCase):
+
+    @override_settings(GRAPHQL_N_PLUS_ONE_THRESHOLD=2)
+    def test_n_plus_one(self):
+        """
+        Fields running more queries than the threshold in a request are flagged, once per request.
+        """
+        metrics = ResolverMetrics()
+        with self.assertLogs('welearn.metrics', 'WARNING') as logs:
+            metrics.observe_request(Counter({'LoanType.book': 3, 'Query.loans': 2}))
+            metrics.observe_request(Counter({'LoanType.book': 5}))
+
+        self.assertEqual(metrics.n_plus_one, {'LoanType.book': 2})
+        self.assertEqual(len(logs.records), 2)
+        self.assertIn('graphql_n_plus_one_total{field="LoanType.book"} 2', metrics.expose())
+
+
+@override_settings(
+    CACHES=dict(default=dict(BACKEND='django.core.cache.backends.locmem.LocMemCache'),
+                apq=dict(BACKEND='django.core.cache.backends.locmem.LocMemCache', LOCATION='apq')),
+    GRAPHQL_PERSISTED_QUERIES_CACHE='apq',
+)
+class PersistedQueryTest(SimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        caches['apq'].clear()
+
+    @staticmethod
+    def extensions(sha256_hash):
+        return dict(persistedQuery=dict(version=1, sha256Hash=sha256_hash))
+
+    def assertRaisesCode(self, code, query, extensions):
+        with self.assertRaises(GraphQLError) as raised:
+            GraphQLView.get_persisted_query(query, extensions)
+        self.assertEqual(raised.exception.extensions['code'], code)
+
+    def test_not_found_then_stored(self):
+        sha256_hash = hashlib.sha256(QUERY.encode()).hexdigest()
+        self.assertRaisesCode('PERSISTED_QUERY_NOT_FOUND', None, self.extensions(sha256_hash))
+
+        self.assertEqual(GraphQLView.get_persisted_query(QUERY, self.extensions(sha256_hash)), QUERY)
+        # as sent by GET requests
+        extensions = json.dumps(self.extensions(sha256_hash))
+        self.assertEqual(GraphQLView.get_persisted_query(None, extensions), QUERY)
+
+    def test_hash_mismatch(self):
+        sha256_hash = hashlib.sha256(b'{ loans { id } }').hexdigest()
+        self.assertRaisesCode('BAD_REQUEST', QUERY, self.extensions(sha256_hash))
+        self.assertRaisesCode('PERSISTED_QUERY_NOT_FOUND', None, self.extensions(sha256_hash))
+
+    def test_without_persisted_query(self):
+        self.assertEqual(GraphQLView.get_persisted_query(QUERY, {}), QUERY)
@@ -19,7 +19,10 @@ from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import path, include
 from django.views.decorators.csrf import csrf_exempt
-from graphene_django.views import GraphQLView
+
+from books.views import catalogue_cache_stats
+from welearn.metrics import metrics
+from welearn.views import GraphQLView
 
 
 urlpatterns = [
@@ -29,6 +32,8 @@ urlpatterns = [
 
     path('admin/', admin.site.urls),
     path("graphql/", csrf_exempt(GraphQLView.as_view(graphiql=True))),
+    path('books/cache/stats/', catalogue_cache_stats),
+    path('metrics/', metrics),
 
 ]
 
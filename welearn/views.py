@@ -0,0 +1,141 @@
+"""
+GraphQL endpoint with automatic persisted queries, and parsed documents cached.
+
+a) Automatic persisted queries (Apollo's protocol): clients send the SHA-256 hash of a query
+   (`extensions.persistedQuery.sha256Hash`) instead of the query itself. Unknown hashes get
+   a `PersistedQueryNotFound` error, upon which clients send the query alongside its hash,
+   stored for the next requests (`GRAPHQL_PERSISTED_QUERIES_CACHE`).
+b) `CachedDocumentBackend` keeps documents parsed and validated against the schema
+   in an LRU cache (`GRAPHQL_DOCUMENT_CACHE_SIZE`), so that a given query is only
+   parsed and validated once, instead of on every request.
+c) SQL queries of each request are counted by field, cf. `welearn.metrics`.
+"""
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from functools import partial
+
+from django.conf import settings
+from django.core.cache import caches
+from graphene_django.views import GraphQLView as BaseGraphQLView
+from graphql import parse, validate, execute
+from graphql.backend.base import GraphQLDocument
+from graphql.backend.core import GraphQLCoreBackend
+from graphql.error import GraphQLError
+from graphql.execution import ExecutionResult
+
+from welearn.metrics import track_request
+
+PERSISTED_QUERY_CACHE_KEY = 'graphql:persisted_query:{hash}'
+PERSISTED_QUERY_VERSION = 1
+
+
+def execute_validated(schema, document_ast, validation_errors, *args, **kwargs):
+    """
+    Execute a document validated already, cf. `graphql.backend.core.execute_and_validate()`.
+    """
+    if validation_errors:
+        return ExecutionResult(errors=validation_errors, invalid=True)
+    kwargs.pop('validate', None)
+    return execute(schema, document_ast, *args, **kwargs)
+
+
+class CachedDocumentBackend(GraphQLCoreBackend):
+    """
+    Core backend, with the `max_size` last used documents kept parsed and validated.
+    """
+
+    def __init__(self, max_size, executor=None):
+        super().__init__(executor=executor)
+        self.max_size = max_size
+        self.documents = OrderedDict()
+        self.lock = threading.Lock()
+
+    def document_from_string(self, schema, document_string):
+        if not isinstance(document_string, str):
+            return super().document_from_string(schema, document_string)
+
+        key = (id(schema), document_string)
+        with self.lock:
+            document = self.documents.get(key)
+            if document is not None:
+                self.documents.move_to_end(key)
+                return document
+
+        # syntax errors raised, as by the core backend
+        document_ast = parse(document_string)
+        document = GraphQLDocument(
+            schema=schema,
+            document_string=document_string,
+            document_ast=document_ast,
+            execute=partial(
+                execute_validated, schema, document_ast, validate(schema, document_ast), **self.execute_params
+            ),
+        )
+        with self.lock:
+            self.documents[key] = document
+            while len(self.documents) > self.max_size:
+                self.documents.popitem(last=False)
+        return document
+
+
+document_backend = CachedDocumentBackend(getattr(settings, 'GRAPHQL_DOCUMENT_CACHE_SIZE', 500))
+
+
+class GraphQLView(BaseGraphQLView):
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('backend', document_backend)
+        super().__init__(*args, **kwargs)
+
+    def get_response(self, request, data, show_graphiql=False):
+        extensions = request.GET.get('extensions') or data.get('extensions')
+        if extensions:
+            try:
+                query = self.get_persisted_query(request.GET.get('query') or data.get('query'), extensions)
+            except GraphQLError as e:
+                return self.json_encode(request, {'errors': [self.format_error(e)]}), 200
+
+            data = data.copy()
+            data['query'] = query
+
+        return super().get_response(request, data, show_graphiql)
+
+    def execute_graphql_request(self, *args, **kwargs):
+        with track_request():
+            return super().execute_graphql_request(*args, **kwargs)
+
+    @staticmethod
+    def get_persisted_query(query, extensions):
+        """
+        Query text of an automatic persisted query, stored if sent alongside its hash.
+        :param query: query text sent, if any.
+        :param extensions: request extensions, as sent (JSON string from GET requests).
+        """
+        if isinstance(extensions, str):
+            try:
+                extensions = json.loads(extensions)
+            except ValueError:
+                raise GraphQLError('Extensions are invalid JSON.')
+
+        persisted_query = extensions.get('persistedQuery')
+        if not persisted_query:
+            return query
+        if persisted_query.get('version') != PERSISTED_QUERY_VERSION:
+            raise GraphQLError('PersistedQueryNotSupported', extensions=dict(code='PERSISTED_QUERY_NOT_SUPPORTED'))
+
+        sha256_hash = persisted_query.get('sha256Hash')
+        cache = caches[getattr(settings, 'GRAPHQL_PERSISTED_QUERIES_CACHE', 'default')]
+        key = PERSISTED_QUERY_CACHE_KEY.format(hash=sha256_hash)
+
+        if not query:
+            query = cache.get(key)
+            if query is None:
+                raise GraphQLError('PersistedQueryNotFound', extensions=dict(code='PERSISTED_QUERY_NOT_FOUND'))
+            return query
+
+        if hashlib.sha256(query.encode()).hexdigest() != sha256_hash:
+            raise GraphQLError('Provided sha does not match query.', extensions=dict(code='BAD_REQUEST'))
+        cache.set(key, query, timeout=getattr(settings, 'GRAPHQL_PERSISTED_QUERIES_TIMEOUT', None))
+        return query